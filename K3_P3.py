@@ -14,104 +14,615 @@
 ##    May 22 -- Added REF and Scale adjusters
 ##    May 24 -- changed cursor when in the window for better picking
 ##    Jun 2 -- improved poll loop format and slider (scale/ref) connection with P3
+##    Oct 16 -- video capture moved to its own thread, UI only shows the newest frame
+##    Oct 16 -- display path reuses its buffers and a single PhotoImage
+##    Oct 16 -- replies are framed on ';' and every one of them is handled
+##    Oct 16 -- serial port runs on its own thread, user commands go ahead of polls
+##    Oct 16 -- auto-info (AI2) for FA/BN/MD, batched and adaptive polling for the rest
+##    Oct 16 -- logging instead of print, optional metrics (F2 overlay / metrics_file)
+##    Oct 16 -- capture format negotiation (MJPEG, 800x600, fps, 1 frame buffer)
+##    Oct 16 -- device discovery runs in the background and is cached, capture opens off the UI thread
+##    Oct 16 -- unchanged frames are skipped, only the changed rows get redrawn
+##    Oct 16 -- spectrum trace is read from the picture, clicks snap to the nearest signal
+##    Oct 16 -- optional spectrum history in a fixed-size ring file (history.py)
+##    Oct 16 -- session record/replay of frames and serial traffic (session.py)
+##    Oct 16 -- rigctld compatible TCP server so other programs can share the K3 (rigctld.py)
+##    Oct 16 -- P3 display streamed over HTTP with click/wheel control (p3_stream.py)
+##    Oct 16 -- one rig state instead of globals, clicks/wheel/sliders apply at once and reconcile with the radio
+##    Oct 16 -- wheel spins and slider drags are coalesced, one FA per tick with acceleration
+##    Oct 16 -- display follows the capture rate within a CPU budget and pauses while the window can't be seen
+##    Oct 16 -- radio side split out into k3_rig.py (no GUI), headless k3_service.py with a control API,
+##              optional features imported only when they're turned on
+##    Oct 16 -- SWEEP steps across the whole band and stitches the spectra into one panorama (panorama.py)
+##    Oct 16 -- activity detector on the capture thread, alerts when a watchlist frequency lights up (activity.py)
+##    Oct 16 -- the CW readout finally reads: TB polled at the decode speed, text in a ring buffer, appended in batches
+##    Oct 16 -- optional readout overlay: frequency grid, levels, markers and the frequency under the pointer (overlay.py)
+##    Oct 16 -- optional frame analysis in worker processes, frames handed over in shared memory (analysis.py)
+
+import time
+STARTED = time.perf_counter()   # for time-to-first-frame
 
 import cv2
+import numpy as np
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-import serial
-import time
-import re
-import json
-import os
+import math
+import logging
+import multiprocessing
+import queue
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 from serial.tools import list_ports
 from ttkthemes import ThemedTk
+from spectrum import SpectrumTrace, SPECTRUM_REGION
+from k3_rig import (K3Rig, save_config, config, metrics, BANDS, MODES, POLL_TICK, SERIAL_PUMP_TIME,
+                    W_WIDTH, W_HEIGHT)
+
+log = logging.getLogger("K3_P3")
 
 MY_VERSION = "WR9R V1.6"
-MY_POLL_TIME = 500
-CONFIG_FILE = "config.json"
-
-frequency = 0
-checker = 0
-Scale = 50000
-whichMarker = "N"
-L_slider_ready = 0
-R_slider_ready = 0
-
-# Load saved settings
-def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)            
-    return {
-        "video_source": 0,
-        "k3_port": "COM4",
-        "baud_rate": "38400",
-        "stay_on_top": False,
-        "window_x": 100,
-        "window_y": 100,
-        "window_width": W_WIDTH,
-        "window_height": W_HEIGHT,
-        "slider_value": -117.0,  # default slider position
-        "left_slider_value": 60.0
-    }
-
-def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
-            
-config = load_config()
+FRAME_POLL_TIME = 5     # ms between checks for a fresh capture frame, until the capture rate is known
+DISPLAY_BUDGET = 0.25   # share of one core the display may use before it shows fewer frames
+LAG_TICK = 100          # ms between Tk event-loop lag samples (metrics only)
+STATS_TIME = 1000       # ms between stats overlay / metrics file updates
+STREAM_EVENT_TIME = 50  # ms between checks for clicks from remote viewers
+CONTROL_TIME = 50       # ms between checks for control API commands
+PANORAMA_TIME = 100     # ms between panorama window updates
+PANORAMA_HEIGHT = 200
+ALERT_POLL_TIME = 200   # ms between checks for watchlist alerts
+READOUT_TIME = 250      # ms between appends of decoded text to the readout
+READOUT_KEEP = 2000     # characters the readout widget holds before the oldest go
+ANALYSIS_TIME = 50      # ms between checks for results from the analysis workers
+DISCOVERY_MAX_AGE = 30          # s before an opened dropdown triggers a fresh device scan
+DISCOVERY_STALE_AGE = 3600      # s before the cached device lists get rescanned at startup
+DISCOVERY_POLL_TIME = 200       # ms between checks for discovery results
+MAX_VIDEO_SOURCES = 5
+CHANGE_THRESHOLD = 16   # pixel difference (0-255) that counts as a change, 0 draws every frame
+CHANGE_REFRESH = 2.0    # s -- redraw everything at least this often
+SNAP_RADIUS = 8         # label pixels -- a click this close to a signal lands on its peak
+
 MY_VIDEO_SOURCE = config.get("video_source", 0)
 MY_K3_COMM_PORT = config.get("comm_port", "COM4")
 MY_COMM_RATE = config.get("comm_rate", "38400")
 STAY_ON_TOP = config.get("stay_on_top", False)
-W_WIDTH = 750
-W_HEIGHT = 615
-
-K3ser = serial.Serial(MY_K3_COMM_PORT, baudrate=int(MY_COMM_RATE), timeout=0.1)
-K3ser.rts = False
-K3ser.dtr = False
-K3ser.write(b"#SPN001000;")
-K3ser.write(b"#SCL;")
-K3ser.write(b"#REF;")
-
-def extract_fa_string(k):
-    match = re.search(r'FA0[^;]*;', k)
-    return match.group(0) if match else None
-
-def extract_bn_string(k):
-    match = re.search(r'BN[^;]*;', k)
-    return match.group(0) if match else None
-
-def extract_ref_string(k):
-    match = re.search(r'#REF[^;]*;', k)
-    return match.group(0) if match else None
-
-def extract_scl_string(k):
-    match = re.search(r'#SCL[^;]*;', k)
-    return match.group(0) if match else None
-
-def extract_md_string(k):
-    match = re.search(r'MD[^;]*;', k)
-    return match.group(0) if match else None
-
-def extract_tb_data(k):
-    match = re.match(r'TB(\d{3})(.*);', k)
-    if match:
-        byte_count = int(match.group(1))
-        data = match.group(2)
-        if len(data) >= byte_count:
-            return data[:byte_count]
+
+# Capture modes tried in order until the device delivers frames in one of them.
+# The P3 SVGA output is 800x600; MJPEG keeps USB dongles off their slow raw modes and a
+# one-frame buffer stops the driver queueing stale frames. {} takes the driver defaults.
+CAPTURE_MODES = [
+    {"fourcc": "MJPG", "width": 800, "height": 600, "fps": 60, "buffer_size": 1},
+    {"fourcc": "MJPG", "width": 800, "height": 600, "fps": 30, "buffer_size": 1},
+    {"fourcc": "YUY2", "width": 800, "height": 600, "fps": 30, "buffer_size": 1},
+    {"fourcc": "MJPG", "width": 1280, "height": 720, "fps": 30, "buffer_size": 1},
+    {},
+]
+
+
+def fourcc_str(value):
+    value = int(value)
+    return "".join(chr((value >> 8 * i) & 0xFF) for i in range(4)).strip("\0")
+
+
+def apply_capture_mode(cap, mode):
+    # FOURCC has to go in before the frame size on some backends (DirectShow)
+    if mode.get("fourcc"):
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*mode["fourcc"]))
+    if mode.get("width") and mode.get("height"):
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, mode["width"])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, mode["height"])
+    if mode.get("fps"):
+        cap.set(cv2.CAP_PROP_FPS, mode["fps"])
+    if mode.get("buffer_size"):
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, mode["buffer_size"])
+
+
+def read_capture_mode(cap, frame):
+    return {"fourcc": fourcc_str(cap.get(cv2.CAP_PROP_FOURCC)),
+            "width": frame.shape[1], "height": frame.shape[0],
+            "fps": round(cap.get(cv2.CAP_PROP_FPS), 1),
+            "buffer_size": int(cap.get(cv2.CAP_PROP_BUFFERSIZE))}
+
+
+def negotiate_capture(cap, modes):
+    """
+    Applies the first mode the device accepts (it delivers frames at the asked size and
+    format) and returns what the device actually runs at, or None if nothing works.
+    """
+    for mode in modes:
+        apply_capture_mode(cap, mode)
+        ret, frame = cap.read()
+        if not ret:
+            log.info("Capture mode %s: no frames", mode)
+            continue
+        actual = read_capture_mode(cap, frame)
+        size_ok = not mode.get("width") or (actual["width"], actual["height"]) == (mode["width"], mode["height"])
+        fourcc_ok = not mode.get("fourcc") or actual["fourcc"] in ("", mode["fourcc"])
+        if size_ok and fourcc_ok:
+            log.info("Capture mode %s", actual)
+            return actual
+        log.info("Capture mode %s not supported, got %s", mode, actual)
     return None
 
+
+def open_capture(source):
+    """
+    Accepts a device index, a file path/URL, or an already open capture-like object.
+    Devices get their capture format negotiated; the result is kept in config.json
+    and tried first next time.
+    """
+    if hasattr(source, "read"):
+        return source
+    cap = cv2.VideoCapture(source)
+    if isinstance(source, int) and cap.isOpened():
+        saved = config.get("capture_mode")
+        modes = config.get("capture_modes", CAPTURE_MODES)
+        if saved:
+            modes = [saved] + [m for m in modes if m != saved]
+        actual = negotiate_capture(cap, modes)
+        if actual and actual != saved:
+            config["capture_mode"] = actual
+            save_config(config)
+    return cap
+
+
+class FrameGrabber:
+    """
+    Opens and reads the capture device on its own thread and keeps only the newest frame.
+    Opening a device can take seconds, so the window doesn't wait for it; if it fails,
+    error holds the reason. Frames that get overwritten before the Tk side picks them up
+    are counted as dropped.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.cap = None
+        self.error = None
+        self.dropped = 0
+        self.captured = 0
+        self.interval = 0.0     # s between captured frames, smoothed
+        self.paused = False     # nobody is looking -- frames are only decoded for listeners
+        self.listeners = []     # called as listener(frame, stamp) on the capture thread
+        self.display_listeners = []     # the same, but only while not paused (the click snap trace)
+        self._lock = threading.Lock()
+        self._frame = None
+        self._stamp = 0.0
+        self._taken = 0
+        self._running = False
+        self._thread = None
+        self._generation = 0
+
+    def start(self):
+        self._running = True
+        self._generation += 1
+        self._thread = threading.Thread(target=self._run, args=(self._generation,), name="capture", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def release(self):
+        self.stop()
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    def reopen(self, source):
+        self.release()
+        self.source = source
+        self.error = None
+        self.interval = 0.0
+        self.start()
+
+    def _open(self, generation):
+        try:
+            cap = open_capture(self.source)
+        except cv2.error as e:
+            cap, self.error = None, str(e)
+        if generation != self._generation or not self._running:
+            # reopened or stopped while the device was still opening
+            if cap is not None:
+                cap.release()
+            return None
+        if cap is None or not cap.isOpened():
+            self.error = self.error or f"Could not start video capture ({self.source})"
+            log.warning("%s", self.error)
+            return None
+        self.cap = cap
+        return cap
+
+    def _run(self, generation):
+        cap = self.cap if self.cap is not None else self._open(generation)
+        if cap is None:
+            return
+        last = None
+        while self._running and generation == self._generation:
+            if self.paused and not self.listeners:
+                # grab() keeps the device drained without decoding, so the first frame
+                # after a resume is a current one
+                started = time.perf_counter()
+                if cap.grab():
+                    # a file or stand-in doesn't wait for the next frame like a device does
+                    time.sleep(max(0.0, (self.interval or 1 / 30) - (time.perf_counter() - started)))
+                else:
+                    time.sleep(0.01)
+                last = None
+                continue
+            ret, frame = cap.read()
+            if not ret:
+                time.sleep(0.01)    # no device / end of stream -- don't spin
+                continue
+            stamp = time.perf_counter()
+            if last is not None:
+                gap = stamp - last
+                self.interval = self.interval + 0.1 * (gap - self.interval) if self.interval else gap
+            last = stamp
+            with self._lock:
+                if self.captured != self._taken:
+                    self.dropped += 1     # previous frame was never displayed
+                self._frame = frame
+                self._stamp = stamp
+                self.captured += 1
+            for listener in self.listeners if self.paused else self.listeners + self.display_listeners:
+                try:
+                    listener(frame, stamp)
+                except Exception:
+                    log.exception("Frame listener %r failed", listener)
+
+    def latest(self):
+        """
+        Returns (frame, capture_time) if a frame arrived since the last call, otherwise None.
+        """
+        with self._lock:
+            if self.captured == self._taken:
+                return None
+            self._taken = self.captured
+            return self._frame, self._stamp
+
+
+def probe_video_source(index):
+    cap = cv2.VideoCapture(index)
+    try:
+        return cap.isOpened()
+    finally:
+        cap.release()
+
+
+class DeviceDiscovery:
+    """
+    Finds video devices and serial ports in the background so the window never waits on them.
+    Every video index is probed on its own worker (a missing device can take seconds to
+    time out) and the port list is fetched alongside. Results are queued for the Tk side
+    as ("video", [indices]) / ("ports", [names]); the index in use is never probed but
+    always listed.
+    """
+    def __init__(self, max_sources=MAX_VIDEO_SOURCES):
+        self.max_sources = max_sources
+        self.results = queue.SimpleQueue()
+        self.last_scan = 0.0
+        self._busy = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_sources + 1, thread_name_prefix="discovery")
+
+    def refresh(self, in_use=None, force=False):
+        """Starts a scan unless one is running or the last one is younger than DISCOVERY_MAX_AGE."""
+        if not force and time.monotonic() - self.last_scan < DISCOVERY_MAX_AGE:
+            return False
+        if not self._busy.acquire(blocking=False):
+            return False
+        self.last_scan = time.monotonic()
+        threading.Thread(target=self._scan, args=(in_use,), name="discovery", daemon=True).start()
+        return True
+
+    def _scan(self, in_use):
+        started = time.perf_counter()
+        try:
+            port_scan = self._pool.submit(lambda: [port.device for port in list_ports.comports()])
+            probes = {i: self._pool.submit(probe_video_source, i)
+                      for i in range(self.max_sources) if i != in_use}
+            try:
+                self.results.put(("ports", port_scan.result()))
+            except Exception as e:
+                log.warning("Serial port scan failed: %s", e)
+            found = []
+            for i in range(self.max_sources):
+                if i == in_use:
+                    found.append(i)
+                    continue
+                try:
+                    if probes[i].result():
+                        found.append(i)
+                except Exception as e:
+                    log.debug("Video source %d probe failed: %s", i, e)
+            self.results.put(("video", found))
+            log.info("Device scan took %.0f ms", (time.perf_counter() - started) * 1000)
+        finally:
+            self._busy.release()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ChangeDetector:
+    """
+    Compares each frame with the last one drawn and returns the source row bands that
+    changed -- [] when nothing did. Most of the P3 screen is static (scale, labels, a quiet
+    spectrum), so most frames don't need drawing, and the rest usually only change in a
+    band or two. The compare is one absdiff plus a per-row max, well under a millisecond
+    at SVGA; a decimated grid is cheaper but misses the trace moving by a pixel.
+    """
+    GAP = 16            # rows -- changes closer than this are drawn as one band
+    MAX_BANDS = 4
+    MAX_DIRTY = 0.6     # above this fraction of the height just draw the whole frame
+
+    def __init__(self, threshold=CHANGE_THRESHOLD, refresh=CHANGE_REFRESH):
+        self.threshold = threshold
+        self.refresh = refresh
+        self._ref = None        # copy of the last frame drawn
+        self._diff = None
+        self._valid = False
+        self._drawn_at = 0.0
+
+    def reset(self):
+        self._valid = False
+
+    def check(self, frame):
+        h = frame.shape[0]
+        if self._ref is None or self._ref.shape != frame.shape:
+            self._ref = np.empty_like(frame)
+            self._diff = np.empty_like(frame)
+            self._valid = False
+        now = time.monotonic()
+        if not self._valid or now - self._drawn_at > self.refresh:
+            bands = [(0, h)]
+        else:
+            cv2.absdiff(frame, self._ref, dst=self._diff)
+            row_max = self._diff.reshape(h, -1).max(axis=1)
+            rows = np.flatnonzero(row_max > self.threshold)
+            if not len(rows):
+                return []
+            splits = np.flatnonzero(np.diff(rows) > self.GAP) + 1
+            starts = rows[np.r_[0, splits]]
+            ends = rows[np.r_[splits - 1, len(rows) - 1]] + 1
+            bands = list(zip(starts.tolist(), ends.tolist()))
+            if len(bands) > self.MAX_BANDS or sum(b - a for a, b in bands) > self.MAX_DIRTY * h:
+                bands = [(0, h)]
+        np.copyto(self._ref, frame)
+        self._valid = True
+        self._drawn_at = now
+        return bands
+
+
+def merge_bands(bands):
+    """Row bands sorted, with the overlapping ones joined."""
+    merged = []
+    for y0, y1 in sorted(bands):
+        if merged and y0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(y1, merged[-1][1]))
+        else:
+            merged.append((y0, y1))
+    return merged
+
+
+class DisplayPipeline:
+    """
+    Pushes capture frames into the video label without allocating anything per frame.
+    The resize/colour buffers and the PhotoImage are only rebuilt when the label size changes.
+    With a ChangeDetector unchanged frames are skipped, and with dirty_regions only the
+    changed rows are resized and converted (the PhotoImage upload is still the whole image).
+    An Overlay is blended into the RGB buffer after the colour conversion; when it changes
+    the whole frame is drawn, changed or not.
+    """
+    MIN_PERIODS = 8     # coarser row scales than 1/8 of the height aren't worth drawing in bands
+
+    def __init__(self, label, detector=None, dirty_regions=False, overlay=None):
+        self.label = label
+        self.detector = detector
+        self.dirty_regions = dirty_regions
+        self.overlay = overlay
+        self.size = None
+        self.photo = None
+        self.skipped = 0
+        self.partial = 0
+        self._source = None
+        self._resized = None
+        self._rgb = None
+        self._image = None
+        self._overlay_version = None
+        self._overlay_view = None
+
+    def _rebuild(self, w, h):
+        self.size = (w, h)
+        if self.detector is not None:
+            self.detector.reset()
+        self._resized = np.empty((h, w, 3), np.uint8)
+        self._rgb = np.empty((h, w, 3), np.uint8)
+        self._image = Image.new("RGB", (w, h))
+        self._new_photo(w, h)
+
+    def _new_photo(self, w, h):
+        self.photo = ImageTk.PhotoImage("RGB", (w, h))
+        self.label.imgtk = self.photo       # keep a reference or Tk drops the image
+        self.label.config(image=self.photo)
+
+    def resize(self, frame, w, h):
+        if (w, h) != self.size:
+            self._rebuild(w, h)
+        if frame.shape[0] == h and frame.shape[1] == w:
+            return frame
+        return cv2.resize(frame, (w, h), dst=self._resized)
+
+    def convert(self, frame):
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        if self.overlay is not None:
+            self.overlay.composite(rgb)
+        return rgb
+
+    def wrap(self, rgb):
+        self._image.frombytes(rgb)
+        return self._image
+
+    def handoff(self, image):
+        self.photo.paste(image)
+
+    def draw_bands(self, frame, bands, w, h):
+        """
+        Resizes and converts just the given source row bands into the persistent image.
+        Bands are widened to whole periods of the row scale (5 source rows -> 6 label rows
+        for 600 -> 720) so cv2.resize samples the same positions it does for the whole
+        frame, plus one period either side so the edge rows get their real neighbours.
+        """
+        src_h = frame.shape[0]
+        periods = math.gcd(src_h, h)
+        p, q = src_h // periods, h // periods
+        for y0, y1 in bands:
+            # rows next to a changed one are interpolated from it too
+            k0, k1 = max(0, y0 - 1) // p, -(-min(src_h, y1 + 1) // p)
+            d0, d1 = k0 * q, k1 * q
+            if (frame.shape[1], src_h) == (w, h):
+                band = frame[d0:d1]
+            else:
+                m0, m1 = max(0, k0 - 1), min(periods, k1 + 1)
+                cv2.resize(frame[m0 * p:m1 * p], (w, (m1 - m0) * q), dst=self._resized[m0 * q:m1 * q])
+                band = self._resized[d0:d1]
+            rgb = cv2.cvtColor(band, cv2.COLOR_BGR2RGB, dst=self._rgb[d0:d1])
+            if self.overlay is not None:
+                self.overlay.composite(self._rgb, d0, d1)
+            self._image.paste(Image.frombuffer("RGB", (w, d1 - d0), rgb, "raw", "RGB", 0, 1), (0, d0))
+        self.handoff(self._image)
+
+    def draw(self, frame, w, h):
+        """Draws frame at w x h; returns False if it was skipped as unchanged."""
+        if (w, h) != self.size:
+            self._rebuild(w, h)
+        if frame.shape != self._source:
+            self._source = frame.shape
+            if self.detector is not None:
+                self.detector.reset()
+        bands = self.detector.check(frame) if self.detector is not None else [(0, frame.shape[0])]
+        if self.overlay is not None and self.overlay.version != self._overlay_version:
+            # the readouts changed, the picture may not have
+            if self.overlay.view_version != self._overlay_view:
+                bands = [(0, frame.shape[0])]
+            else:
+                bands = merge_bands(bands + [self.overlay.pointer_rows(frame.shape[0])])
+            self._overlay_version, self._overlay_view = self.overlay.version, self.overlay.view_version
+        if not bands:
+            self.skipped += 1
+            return False
+        if (self.dirty_regions and bands != [(0, frame.shape[0])]
+                and math.gcd(frame.shape[0], h) >= self.MIN_PERIODS):
+            self.partial += 1
+            self.draw_bands(frame, bands, w, h)
+        else:
+            self.handoff(self.wrap(self.convert(self.resize(frame, w, h))))
+        return True
+
+    def show(self, frame):
+        # Resize to current label size
+        w = self.label.winfo_width()
+        h = self.label.winfo_height()
+        if w <= 1 or h <= 1:
+            h, w = frame.shape[:2]
+        return self.draw(frame, w, h)
+
+
+class DisplayScheduler:
+    """
+    Decides when update_video looks for the next frame. Rather than polling it wakes just
+    after the next frame is due at the measured capture rate. Drawing is held to budget of
+    one core: draw time is wall time, so on a loaded machine fewer frames get shown while
+    the serial, poll and capture threads carry on as before. While the window can't be seen
+    it doesn't run at all.
+    """
+    LATE = 2            # ms after a frame is due before looking for it
+
+    def __init__(self, budget=DISPLAY_BUDGET):
+        self.budget = budget
+        self.draw_time = 0.0    # s per frame drawn, smoothed
+        self.hidden = set()     # why the window can't be seen: "iconified", "obscured"
+        self.paused_time = 0.0
+        self._paused_at = 0.0
+        self._stamp = 0.0
+        self._drawn = 0.0
+
+    @property
+    def paused(self):
+        return bool(self.hidden)
+
+    def set_visible(self, reason, visible):
+        """True when this pauses or resumes the display."""
+        was = self.paused
+        if visible:
+            self.hidden.discard(reason)
+        else:
+            self.hidden.add(reason)
+        if self.paused == was:
+            return False
+        now = time.perf_counter()
+        if self.paused:
+            self._paused_at = now
+        else:
+            self.paused_time += now - self._paused_at
+        return True
+
+    def drawn(self, stamp, seconds):
+        self._stamp = stamp
+        self._drawn = time.perf_counter()
+        self.draw_time = self.draw_time + 0.1 * (seconds - self.draw_time) if self.draw_time else seconds
+
+    def max_fps(self):
+        return self.budget / self.draw_time if self.budget and self.draw_time else float("inf")
+
+    def delay(self, interval):
+        """ms until update_video should run again, interval being the capture's frame interval."""
+        if not interval:
+            return FRAME_POLL_TIME
+        now = time.perf_counter()
+        due = self._stamp + interval
+        if self.budget and self.draw_time:
+            # the next draw starts no sooner than draw_time / budget after the last one did
+            due = max(due, self._drawn + self.draw_time / self.budget - self.draw_time)
+        if due <= now:
+            # the frame is late, or the device stalled -- look again, but not flat out
+            return max(FRAME_POLL_TIME, int(interval * 250))
+        return int((due - now) * 1000) + self.LATE
+
+
 class VideoApp:
-    def __init__(self, root):
+    def __init__(self, root, video_source=None, comm_port=None, comm_rate=None):
         self.root = root
         self.root.resizable(True, True)
         self.root.title("Elecraft P3 " + MY_VERSION)
         self.root.configure(bg='#2e2e2e')
         self.root.protocol("WM_DELETE_WINDOW", self.exit_app)
-        self.root.after(MY_POLL_TIME, self.periodic_task)
+        self.radio = K3Rig(comm_port or MY_K3_COMM_PORT, comm_rate or MY_COMM_RATE, self.show_rig)
+        self.rig, self.tuner, self.k3, self.poller = self.radio.rig, self.radio.tuner, self.radio.k3, self.radio.poller
+        self.cat_handlers = self.radio.handlers
+        self.session = None
+        if config.get("record_session"):
+            from session import SessionRecorder
+            self.session = SessionRecorder(config["record_session"], {
+                "version": MY_VERSION, "comm_port": str(self.k3.port), "comm_rate": str(self.k3.rate),
+                "video_source": str(MY_VIDEO_SOURCE if video_source is None else video_source)}).start()
+            self.k3.listeners.append(self.session.serial)
+        if config.get("rigctld_port"):
+            self.radio.start_rigctld(config.get("rigctld_host", "127.0.0.1"), config["rigctld_port"])
+        self.radio.start()
+        self.control = None
+        if config.get("control_port"):
+            from control import ControlServer
+            try:
+                self.control = ControlServer(self.radio, config.get("control_host", "127.0.0.1"),
+                                             config["control_port"]).start()
+            except OSError as e:
+                log.warning("Can't serve the control API on port %s: %s", config["control_port"], e)
+            else:
+                self.root.after(CONTROL_TIME, self.pump_control)
+        self.root.after(POLL_TICK, self.periodic_task)
+        self.root.after(SERIAL_PUMP_TIME, self.pump_serial)
         # Set window position and size
         window_width = config.get("window_width", W_WIDTH)
         window_height = config.get("window_height", W_HEIGHT)
@@ -150,9 +661,66 @@ class VideoApp:
 
         self.root.attributes('-topmost', self.stay_on_top_var.get())
 
-        self.cap = cv2.VideoCapture(MY_VIDEO_SOURCE)
-        if not self.cap.isOpened():
-            raise RuntimeError("Could not start video capture.")
+        # the device opens (and negotiates its format) on the capture thread
+        self.grabber = FrameGrabber(MY_VIDEO_SOURCE if video_source is None else video_source)
+        self.snap_radius = config.get("snap_radius", SNAP_RADIUS)
+        self.trace = SpectrumTrace(config.get("spectrum_region", SPECTRUM_REGION), config.get("trace_color"))
+        self.history = None
+        if config.get("history_file"):
+            from history import HistoryRecorder, DEFAULT_ROWS
+            self.history = HistoryRecorder(config["history_file"], capacity=config.get("history_rows", DEFAULT_ROWS),
+                                           rate=config.get("history_rate", 5)).start()
+        self.activity = None
+        if config.get("watchlist") or config.get("activity_detector"):
+            from activity import ActivityDetector
+            region = config.get("spectrum_region", SPECTRUM_REGION)
+            self.activity = ActivityDetector(config.get("watchlist"), (region[0], region[2]))
+        self.analysis = None
+        if self.snap_radius or self.history or self.activity:
+            # history and the watchlist need every frame; for click snapping alone the
+            # trace can wait until the window is seen again
+            needs_trace = self.grabber.listeners if self.history or self.activity else self.grabber.display_listeners
+            if config.get("analysis_workers"):
+                # trace extraction in worker processes; pump_analysis feeds the results on
+                from analysis import AnalysisPool, TraceAnalyzer
+                self.analysis = AnalysisPool({"trace": TraceAnalyzer.like(self.trace)}, config["analysis_workers"])
+                needs_trace.append(self.analysis.offer)
+                self.root.after(ANALYSIS_TIME, self.pump_analysis)
+            else:
+                needs_trace.append(self.trace.update)
+        if self.history and not self.analysis:
+            self.grabber.listeners.append(self.record_history)
+        if self.activity:
+            if not self.analysis:
+                self.grabber.listeners.append(self.watch_activity)
+            self.root.bind("<FocusIn>", self.clear_alert, add="+")
+            self.root.after(ALERT_POLL_TIME, self.pump_alerts)
+        if self.session:
+            self.grabber.listeners.append(self.session.frame)
+        self.sweep = None
+        self.pan_window = None
+        self.stream = None
+        if config.get("stream_port"):
+            from p3_stream import FrameEncoder, StreamServer, STREAM_QUALITY, STREAM_FPS
+            encoder = FrameEncoder(config.get("stream_quality", STREAM_QUALITY), config.get("stream_fps", STREAM_FPS))
+            try:
+                self.stream = StreamServer(encoder, config.get("stream_host", "127.0.0.1"), config["stream_port"],
+                                           config.get("stream_token"))
+            except OSError as e:
+                log.warning("Can't stream on port %s: %s", config["stream_port"], e)
+            else:
+                encoder.start()
+                self.stream.start()
+                self.grabber.listeners.append(encoder.offer)
+                self.root.after(STREAM_EVENT_TIME, self.pump_stream_events)
+        self.grabber.start()
+        self.error_shown = False
+        self.frames_shown = 0
+        self.max_frame_age = 0.0
+        self.scheduler = DisplayScheduler(config.get("display_budget", DISPLAY_BUDGET))
+        self._video_job = None
+        self.root.bind("<Map>", self.on_window_state, add="+")
+        self.root.bind("<Unmap>", self.on_window_state, add="+")
 
         # set up mouse configuration -- point / target zones
         self.video_label = tk.Label(self.root, bg='#2e2e2e', cursor="target")
@@ -160,6 +728,27 @@ class VideoApp:
         self.video_label.bind("<Motion>", self.mouse_move)
         self.video_label.bind("<Button-1>", self.mouse_click)
         self.video_label.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.video_label.bind("<Visibility>", self.on_visibility)
+
+        # optional stats overlay on top of the video, F2 toggles it
+        self.stats_label = tk.Label(self.root, fg="#00ff00", bg="#000000", justify="left",
+                                    anchor="nw", font=("Consolas", 9))
+        self.root.bind("<F2>", self.toggle_stats)
+        if config.get("stats_overlay", False):
+            self.stats_label.place(in_=self.video_label, x=4, y=4)
+        self._lag_due = 0.0
+        if metrics.enabled:
+            self.start_metrics()
+        # optional readouts drawn into the video: frequency grid, levels, markers, pointer frequency
+        self.overlay = None
+        self._hover_x = None
+        if config.get("overlay", False):
+            from overlay import Overlay
+            self.overlay = Overlay(config.get("spectrum_region", SPECTRUM_REGION))
+            self.video_label.bind("<Leave>", self.mouse_leave)
+        threshold = config.get("change_threshold", CHANGE_THRESHOLD)
+        self.display = DisplayPipeline(self.video_label, ChangeDetector(threshold) if threshold else None,
+                                       config.get("dirty_regions", True), self.overlay)
 
         # add slider to scale the RF display (left side)
         self.left_slider = ttk.Scale(
@@ -194,25 +783,18 @@ class VideoApp:
         self.comm_port_var = tk.StringVar(value=MY_K3_COMM_PORT)
         self.comm_rate_var = tk.StringVar(value=MY_COMM_RATE)
 
-        sources = self.detect_video_sources()
-        ports = self.detect_serial_ports()
+        # start with the devices found last time, the background scan fills in the rest
+        cache = config.get("device_cache", {})
+        sources = cache.get("video") or [MY_VIDEO_SOURCE]
+        ports = cache.get("ports") or [MY_K3_COMM_PORT]
+        self.discovery = DeviceDiscovery()
+        self.discovery.refresh(self.video_in_use(),
+                               force=time.time() - cache.get("time", 0) > DISCOVERY_STALE_AGE)
         rates = ["9600", "19200", "38400", "57600", "115200"]
 
         # Band selector (this must be BEFORE self.band_var.set(...))
         self.band_var = tk.StringVar()
-        self.band_mapping = {
-            "160 M": 0,
-            "80 M": 1,
-            "60 M": 2,
-            "40 M": 3,
-            "30 M": 4,
-            "20 M": 5,
-            "17 M": 6,
-            "15 M": 7,
-            "12 M": 8,
-            "10 M": 9,
-            "6 M": 10
-        }
+        self.band_mapping = BANDS
         # Band select setup
         self.band_var = tk.StringVar(value="20 M")  # Set the variable first
         self.band_dropdown = ttk.Combobox(
@@ -227,13 +809,7 @@ class VideoApp:
         self.band_dropdown.bind("<<ComboboxSelected>>", self.on_band_select)
 
         # Mode select setup
-        self.mode_mapping = {
-            "LSB": 1,
-            "USB": 2,
-            "CW": 3,
-            "FM": 4,
-            "AM": 5
-        }
+        self.mode_mapping = MODES
         self.mode_var = tk.StringVar(value="USB")
         mode_options = list(self.mode_mapping.keys())
 
@@ -249,11 +825,13 @@ class VideoApp:
         self.mode_dropdown.bind("<<ComboboxSelected>>", self.on_mode_select)
         
         ttk.Label(self.root, text="VID Input:").grid(row=2, column=0)
-        self.source_dropdown = ttk.Combobox(self.root, values=sources, textvariable=self.video_source_var, style='TCombobox', width=9)
+        self.source_dropdown = ttk.Combobox(self.root, values=sources, textvariable=self.video_source_var, style='TCombobox', width=9,
+                                            postcommand=self.refresh_devices)
         self.source_dropdown.grid(row=2, column=1)
 
         ttk.Label(self.root, text="COM Port:").grid(row=2, column=2)
-        self.port_dropdown = ttk.Combobox(self.root, values=ports, textvariable=self.comm_port_var, style='TCombobox', width=9)
+        self.port_dropdown = ttk.Combobox(self.root, values=ports, textvariable=self.comm_port_var, style='TCombobox', width=9,
+                                          postcommand=self.refresh_devices)
         self.port_dropdown.grid(row=2, column=3)
 
         ttk.Label(self.root, text="Baud Rate:").grid(row=2, column=4)
@@ -267,6 +845,7 @@ class VideoApp:
         ttk.Button(self.root, text="50K", command=lambda: self.button_action("50K")).grid(row=3, column=2)
         ttk.Button(self.root, text="100K", command=lambda: self.button_action("100K")).grid(row=3, column=3)
         ttk.Button(self.root, text="200K", command=lambda: self.button_action("200K")).grid(row=3, column=4)
+        ttk.Button(self.root, text="SWEEP", command=self.sweep_action).grid(row=3, column=5)
 
         ttk.Button(self.root, text="MKR A", command=lambda: self.marker_action("MKR A")).grid(row=4, column=1)
         ttk.Button(self.root, text="MKR B", command=lambda: self.marker_action("MKR B")).grid(row=4, column=2)
@@ -292,30 +871,26 @@ class VideoApp:
 
         for i in range(5):  # Rows 0 to 5
             self.root.rowconfigure(i, weight=1)
+
+        # CW/data text the K3 decodes, under everything else
+        self.readout_text = None
+        if config.get("cw_readout", False):
+            self.readout = self.radio.start_readout()
+            self.readout_pos = 0
+            self.readout_chars = 0
+            self.readout_text = tk.Text(self.root, height=3, wrap="char", bg="#000000", fg="#00ff00",
+                                        font=("Consolas", 10), state="disabled", takefocus=0)
+            self.readout_text.grid(row=6, column=0, columnspan=8, sticky="ew", padx=10, pady=(0, 5))
+            self.root.after(READOUT_TIME, self.update_readout)
             
         self.update_video()
+        self.poll_discovery()
 
     def on_left_slider_change(self, val):   # adjust RF scales
-        global L_slider_ready
-        
-        if L_slider_ready:
-            value = int(float(val))
-            print(f"L_Slider: {value}")
-            formatted = f"#SCL{value:03d};"
-            print(formatted)
-            byte_data = bytearray(formatted.encode("utf-8"))
-            K3ser.write(byte_data)
+        self.tuner.slider("scl", int(float(val)))     # written on the next tick, latest value wins
         
     def on_slider_change(self, val):        # adjust RF offset (REF)
-        global R_slider_ready
-        
-        if R_slider_ready:
-            value = int(float(val))
-            print(f"R_Slider: {value}")
-            formatted = f"#REF{value:03d};"
-            print(formatted)
-            byte_data = bytearray(formatted.encode("utf-8"))
-            K3ser.write(byte_data)
+        self.tuner.slider("ref", int(float(val)))
 
     def set_left_slider_value(self, value):
         """
@@ -334,24 +909,20 @@ class VideoApp:
 
     def on_band_select(self, event):
         selected_band = self.band_dropdown.get()
-        print(f"BAND selected: {selected_band}")
+        log.debug("BAND selected: %s", selected_band)
         
         # You can reverse lookup the band_map if needed
         band_id = self.band_mapping.get(selected_band)
         if band_id is not None:
             # Set band_var to the selected band name, not band_id
             self.band_var.set(selected_band)
-            formatted = f"BN{band_id:02d};"
-            print(formatted)
-            byte_data = bytearray(formatted.encode("utf-8"))
-            K3ser.write(byte_data)
+            self.radio.set_band(band_id)
         
     def on_mode_select(self, event):
         selected_mode = self.mode_var.get()
         mode_code = self.mode_mapping[selected_mode]
-        print(f"Selected MODE: {selected_mode} → Code: {mode_code}")
-        # Send command to device, e.g.:
-        K3ser.write(f"MD{mode_code};".encode())
+        log.debug("Selected MODE: %s -> Code: %s", selected_mode, mode_code)
+        self.radio.set_mode(mode_code)
 
     def set_mode_by_id(self, mode_id):
         for mode_label, mode_value in self.mode_mapping.items():
@@ -364,6 +935,20 @@ class VideoApp:
             if band_value == band_id:
                 self.band_var.set(band_label)
                 break
+
+    def show_rig(self, field, value):
+        # every change of the rig state, optimistic, confirmed or rolled back, ends up here
+        if value is None:
+            return
+        match field:
+            case "band":
+                self.set_band_by_id(value)
+            case "mode":
+                self.set_mode_by_id(value)
+            case "scl":
+                self.set_left_slider_value(value)
+            case "ref":
+                self.set_right_slider_value(value)
             
     def toggle_stay_on_top(self):
         is_on_top = self.stay_on_top_var.get()
@@ -373,20 +958,34 @@ class VideoApp:
         STAY_ON_TOP = is_on_top  # keep in sync
         save_config(config)
 
-    def detect_video_sources(self, max_sources=5):
-        available = []
-        for i in range(max_sources):
-            cap = cv2.VideoCapture(i)
-            if cap.isOpened():
-                available.append(i)
-                cap.release()
-        return available
+    def video_in_use(self):
+        # the open device can't be probed again, discovery lists it as is
+        return self.grabber.source if isinstance(self.grabber.source, int) else None
+
+    def refresh_devices(self):
+        self.discovery.refresh(self.video_in_use())
 
-    def detect_serial_ports(self):
-        return [port.device for port in list_ports.comports()]
+    def poll_discovery(self):
+        cache = config.setdefault("device_cache", {})
+        changed = False
+        while True:
+            try:
+                kind, found = self.discovery.results.get_nowait()
+            except queue.Empty:
+                break
+            dropdown = self.source_dropdown if kind == "video" else self.port_dropdown
+            dropdown.config(values=found)
+            if cache.get(kind) != found:
+                cache[kind] = found
+                changed = True
+            cache["time"] = time.time()
+            log.debug("Discovered %s: %s", kind, found)
+        if changed:
+            save_config(config)
+        self.root.after(DISCOVERY_POLL_TIME, self.poll_discovery)
 
     def save_settings(self):
-        global MY_VIDEO_SOURCE, MY_K3_COMM_PORT, MY_COMM_RATE, K3ser
+        global MY_VIDEO_SOURCE, MY_K3_COMM_PORT, MY_COMM_RATE
         MY_VIDEO_SOURCE = self.video_source_var.get()
         MY_K3_COMM_PORT = self.comm_port_var.get()
         MY_COMM_RATE = self.comm_rate_var.get()
@@ -401,231 +1000,315 @@ class VideoApp:
         config["left_slider_value"] = self.left_slider.get()
         save_config(config)
 
-        self.cap.release()
-        self.cap = cv2.VideoCapture(MY_VIDEO_SOURCE)
-        K3ser.close()
-        K3ser = serial.Serial(MY_K3_COMM_PORT, baudrate=int(MY_COMM_RATE), timeout=0.1)
-        K3ser.rts = False
-        K3ser.dtr = False
-        print(f"Saved settings: source {MY_VIDEO_SOURCE}, port {MY_K3_COMM_PORT}, rate {MY_COMM_RATE}")
+        self.grabber.reopen(MY_VIDEO_SOURCE)
+        self.error_shown = False
+        self.video_label.config(text="")
+        self.k3.reopen(MY_K3_COMM_PORT, MY_COMM_RATE)
+        log.info("Saved settings: source %s, port %s, rate %s", MY_VIDEO_SOURCE, MY_K3_COMM_PORT, MY_COMM_RATE)
 
 
     def update_video(self):
-        ret, frame = self.cap.read()
-        if ret:
-            # Resize to current label size
-            w = self.video_label.winfo_width()
-            h = self.video_label.winfo_height()
-            if w > 0 and h > 0:
-                frame = cv2.resize(frame, (w, h))
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            img = Image.fromarray(frame)
-            imgtk = ImageTk.PhotoImage(image=img)
-            self.video_label.imgtk = imgtk
-            self.video_label.config(image=imgtk)
-        self.root.after(10, self.update_video)
+        self._video_job = None
+        if self.scheduler.paused:
+            return      # set_visible() starts it again
+        latest = self.grabber.latest()
+        if latest:
+            frame, captured_at = latest
+            started = time.perf_counter()
+            if self.overlay is not None:
+                self.update_overlay()
+            shown = self.display.show(frame)
+            self.scheduler.drawn(captured_at, time.perf_counter() - started)
+            if shown:
+                self.frame_shown(captured_at)
+            elif metrics.enabled:
+                metrics.count("frames_skipped")     # unchanged, nothing to draw
+        elif self.grabber.error and not self.error_shown:
+            self.video_label.config(text=self.grabber.error, fg="#ff6060")
+            self.error_shown = True
+        self._video_job = self.root.after(self.scheduler.delay(self.grabber.interval), self.update_video)
+
+    def on_window_state(self, event):
+        # bound on the root, so every child's Map/Unmap comes through here as well
+        if event.widget is self.root:
+            self.set_visible("iconified", event.type == tk.EventType.Map)
+
+    def on_visibility(self, event):
+        # X11 only -- Windows and compositing desktops don't report obscured windows
+        self.set_visible("obscured", event.state != "VisibilityFullyObscured")
+
+    def set_visible(self, reason, visible):
+        if not self.scheduler.set_visible(reason, visible):
+            return
+        self.grabber.paused = self.scheduler.paused
+        log.debug("Display %s (%s)", "paused" if self.scheduler.paused else "resumed", reason)
+        if not self.scheduler.paused and self._video_job is None:
+            self.update_video()
+
+    def frame_shown(self, captured_at):
+        if not self.frames_shown:
+            first = time.perf_counter() - STARTED
+            log.info("Time to first frame: %.0f ms", first * 1000)
+            metrics.gauge("time_to_first_frame_ms", first * 1000)
+        self.frames_shown += 1
+        age = time.perf_counter() - captured_at
+        self.max_frame_age = max(self.max_frame_age, age)
+        if metrics.enabled:
+            metrics.count("frames_displayed")
+            metrics.observe("capture_to_display", age)
+
+    def pump_stream_events(self):
+        # clicks and wheel steps from remote viewers, as if they happened on the video label
+        while True:
+            try:
+                kind, *values = self.stream.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "click":
+                x, y = values
+                self.mouse_click(SimpleNamespace(x=int(x * self.video_label.winfo_width()),
+                                                 y=int(y * self.video_label.winfo_height())))
+            elif kind == "wheel":
+                self.on_mouse_wheel(SimpleNamespace(x=0, y=0, delta=values[0]))
+        self.root.after(STREAM_EVENT_TIME, self.pump_stream_events)
+
+    def pump_control(self):
+        self.control.run_pending()
+        self.root.after(CONTROL_TIME, self.pump_control)
+
+    def sweep_action(self):
+        # the first press sweeps the band in the band box, later ones only what changed since
+        if self.sweep is None:
+            from panorama import BandSweep, SWEEP_SPAN, SETTLE_TIME
+            self.sweep = BandSweep(self.radio, self.trace, config.get("sweep_span", SWEEP_SPAN),
+                                   settle=config.get("sweep_settle", SETTLE_TIME))
+        if self.pan_window is None:
+            self.sweep.attach(self.grabber)
+            self.pan_window = tk.Toplevel(self.root, bg='#2e2e2e')
+            self.pan_window.protocol("WM_DELETE_WINDOW", self.close_panorama)
+            self.pan_label = tk.Label(self.pan_window, bg='#000000', cursor="target")
+            self.pan_label.pack(fill="both", expand=True)
+            self.pan_label.bind("<Button-1>", self.panorama_click)
+            self.pan_window.geometry(f"{self.root.winfo_width()}x{PANORAMA_HEIGHT}")
+            self._pan_shown = None
+            self.root.after(PANORAMA_TIME, self.update_panorama)
+        band = self.band_var.get()
+        if self.sweep.running:
+            return
+        if self.sweep.band != band or self.sweep.panorama is None:
+            self.sweep.start(band)
+        elif not self.sweep.resweep():
+            # same band again: only the steps that changed or went stale, and none did
+            log.info("Panorama of %s is current, nothing swept again", band)
+
+    def update_panorama(self):
+        if self.pan_window is None:
+            return
+        from panorama import render
+
+        w, h = self.pan_label.winfo_width(), self.pan_label.winfo_height()
+        shown = (self.sweep.poll(), self.rig.freq, w, h)
+        if self.sweep.panorama is not None and shown != self._pan_shown and w > 1 and h > 1:
+            self._pan_shown = shown
+            rgb = cv2.cvtColor(render(self.sweep.panorama, w, h, self.rig.freq), cv2.COLOR_BGR2RGB)
+            self.pan_label.imgtk = ImageTk.PhotoImage(Image.fromarray(rgb))
+            self.pan_label.config(image=self.pan_label.imgtk)
+            self.pan_window.title(f"Panorama {self.sweep.band}" + (" -- sweeping" if self.sweep.running else ""))
+        self.root.after(PANORAMA_TIME, self.update_panorama)
+
+    def panorama_click(self, event):
+        # tunes like a click on the P3 picture; a running sweep stops there
+        if self.sweep.panorama is not None:
+            self.radio.tune(self.sweep.panorama.freq_at(event.x, self.pan_label.winfo_width()))
+
+    def close_panorama(self):
+        self.sweep.cancel()
+        self.sweep.detach()
+        self.pan_window.destroy()
+        self.pan_window = None
+
+    def record_history(self, frame, stamp):
+        # capture thread -- right after self.trace.update() has seen the same frame (or pump_analysis)
+        amp, _, _ = self.trace.snapshot()
+        if amp is not None:
+            self.history.add(amp, self.rig.freq or 0, self.rig.span or 0)
+
+    def watch_activity(self, frame, stamp):
+        # capture thread, after self.trace.update() (or pump_analysis) -- keeps working while the display is paused
+        amp, _, _ = self.trace.snapshot()
+        self.activity.update(amp, self.rig.freq, self.rig.span, stamp)
+
+    def pump_analysis(self):
+        # traces from the worker processes, oldest first -- the listeners get them without the frame
+        for stamp, result in self.analysis.results():
+            amp, peaks, width = result["trace"]
+            self.trace.set(amp, peaks, stamp, width)
+            if self.history:
+                self.record_history(None, stamp)
+            if self.activity:
+                self.watch_activity(None, stamp)
+        self.root.after(ANALYSIS_TIME, self.pump_analysis)
+
+    def pump_alerts(self):
+        while True:
+            try:
+                alert = self.activity.alerts.get_nowait()
+            except queue.Empty:
+                break
+            log.info("Activity on %s: %d Hz, level %.2f", alert["name"], alert["freq"], alert["level"])
+            self.root.bell()
+            self.root.title(f"* {alert['name']} active -- Elecraft P3 {MY_VERSION}")
+        self.root.after(ALERT_POLL_TIME, self.pump_alerts)
 
-    def mouse_move(self, event):
-        global frequency, Scale
+    def clear_alert(self, event=None):
+        self.root.title("Elecraft P3 " + MY_VERSION)
 
+    def click_freq(self, x):
+        # frequency under label x: the picture is centered on the VFO and span Hz wide
         widget_width = self.video_label.winfo_width()
-        center_x = widget_width / 2  # Current center of the widget
+        center_x = widget_width / 2
+        return self.rig.freq + int(self.rig.span * (x - center_x) / widget_width)
 
-        # Scale per pixel (Scale is total width in Hz)
-        scale_per_pixel = Scale / widget_width
+    def mouse_move(self, event):
+        # only noted here -- update_overlay reads it once per frame drawn, however fast the events come
+        self._hover_x = event.x
 
-        offset = int(scale_per_pixel * (event.x - center_x)) * 2
-        newFreq = frequency + offset
+    def mouse_leave(self, event):
+        self._hover_x = None
 
-        # Optional: Update UI or status bar
-        # self.status_label.config(text=f"Freq: {newFreq:08d}")
+    def update_overlay(self):
+        self.overlay.set_view(self.rig.freq, self.rig.span, self.rig.ref, self.rig.scl, self.radio.markers)
+        if self._hover_x is None or self.rig.freq is None or not self.rig.span:
+            self.overlay.set_hover(None)
+            return
+        # where a click would land, snapping included
+        x = self.trace.snap_x(self._hover_x, self.video_label.winfo_width(), self.snap_radius)
+        self.overlay.set_hover(x, f"{self.click_freq(x) / 1000:.2f} kHz")
 
     # mouse click will move VFO-A or MARKER-A or MARKER-B, depending on what is active
     def mouse_click(self, event):
-        global frequency, Scale, whichMarker
-
-        widget_width = self.video_label.winfo_width()
-        center_x = widget_width / 2
-
-        scale_per_pixel = Scale / widget_width
-        offset = int(scale_per_pixel * (event.x - center_x)) * 2
-        newFreq = frequency + offset
-
-        if whichMarker == "A":
-            formatted = f"#MFA 000{newFreq:08d};"
-        elif whichMarker == "B":
-            formatted = f"#MFB 000{newFreq:08d};"
-        else:
-            formatted = f"FA000{newFreq:08d};"
-
-        print(formatted)
-        byte_data = bytearray(formatted.encode("utf-8"))
-        K3ser.write(byte_data)
-        K3ser.write(b"FA;")  # Trigger display update
+        if self.rig.freq is None or not self.rig.span:
+            log.debug("Click ignored, no frequency or span from the radio yet")
+            return
+        x = self.trace.snap_x(event.x, self.video_label.winfo_width(), self.snap_radius)
+        if x != event.x:
+            log.debug("Click at %d snapped to signal at %d", event.x, x)
+        self.radio.tune(self.click_freq(x))
 
     
     def on_mouse_wheel(self, event):  # MOUSE UP/DOWN ACTIVE VFO (A)
         if event.delta > 0:
-            print("Mouse wheel scrolled up")
+            log.debug("Mouse wheel scrolled up")
             self.on_wheel_up()
-            K3ser.write(b"UP3;FA;")
+            self.tuner.wheel(1)
         else:
-            print("Mouse wheel scrolled down")
+            log.debug("Mouse wheel scrolled down")
             self.on_wheel_down()
-            K3ser.write(b"DN3;FA;")
+            self.tuner.wheel(-1)
 
     def on_wheel_up(self):
-        print("Wheel up action")
+        log.debug("Wheel up action")
 
     def on_wheel_down(self):
-        print("Wheel down action")
+        log.debug("Wheel down action")
 
     def button_action(self, label):
-        global Scale
-        print(f"Button pressed: {label}")
-        match label:
-            case "2K":
-                Scale = 1000
-                K3ser.write(b"#SPN000020;")
-            case "10K":
-                Scale = 5000
-                K3ser.write(b"#SPN000100;")
-            case "50K":
-                Scale = 25000
-                K3ser.write(b"#SPN000500;")
-            case "100K":
-                Scale = 50000
-                K3ser.write(b"#SPN001000;")
-            case "200K":
-                Scale = 100000
-                K3ser.write(b"#SPN002000;")
-            case _:
-                print(f"Unknown label: {label}")
+        log.debug("Button pressed: %s", label)
+        self.radio.span_action(label)
 
     def marker_action(self, label):
-        global whichMarker
-        print(f"Button pressed: {label}")
-        match label:
-            case "MKR A":
-                print("Marker A action triggered")
-                K3ser.write(b"#MKA1;#MKB0;")
-                whichMarker = "A"
-            case "MKR B":
-                print("Marker B action triggered")
-                K3ser.write(b"#MKA0;#MKB1;")
-                whichMarker = "B"
-            case "QSY":
-                print("QSY action triggered")
-                K3ser.write(b"#QSY1;")             
-            case "OFF":
-                print("Markers OFF action triggered")
-                K3ser.write(b"#MKA0;#MKB0;#QSY0;")
-                whichMarker = "N"
-            case _:
-                print(f"Unknown marker button: {label}")
+        log.debug("Button pressed: %s", label)
+        self.radio.marker_action(label)
 
     def VFO_action(self, label):
-        print(f"Button pressed: {label}")
-        match label:
-            case "A/B":
-                print("VFO A/B action triggered")
-                K3ser.write(b"SWT11;")
-            case "SUB":
-                print("VFO REV action triggered")
-                K3ser.write(b"SWT48;")
-            case "A>B":
-                print("VFO A=B action triggered")
-                K3ser.write(b"SWT13;")
-            case "SPLIT":
-                print("SPLIT action triggered")
-                K3ser.write(b"SWH13;")
-            case _:
-                print(f"Unknown marker button: {label}")
+        log.debug("Button pressed: %s", label)
+        self.radio.vfo_action(label)
+
+    def send_user(self, data):
+        self.radio.send_user(data)
+
+    def pump_serial(self):
+        """
+        Hands everything the serial worker has read to the CAT handlers, on the Tk thread.
+        Every complete reply in the input is handed to its handler in cat_handlers.
+        """
+        self.radio.pump()
+        self.root.after(SERIAL_PUMP_TIME, self.pump_serial)
 
     def periodic_task(self):
         """
         Polls the K3 for status of Freq, band, mode, pan-ref, and pan-scale
-        Frequency gets sampled more frequently than anything else -- for feel
-        """        
-        global frequency, checker, L_slider_ready, R_slider_ready
-
-        if K3ser.in_waiting:
-            data = K3ser.read(K3ser.in_waiting)
-            s = data.decode("utf-8")
-
-            match True:
-                case _ if (result := extract_fa_string(s)):
-                    number_str = result[5:-1]
-                    try:
-                        frequency = int(number_str)
-                        print("FREQ:", frequency)
-                    except ValueError:
-                        print(f"Ignored bad Freq: '{number_str}'")
-
-                case _ if (result := extract_bn_string(s)):
-                    number_str = result[2:-1]
-                    try:
-                        bandid = int(number_str)
-                        print("BAND:", bandid)
-                        self.set_band_by_id(bandid)
-                    except ValueError:
-                        print(f"Ignored bad band data: '{number_str}'")
-
-                case _ if (result := extract_md_string(s)):
-                    number_str = result[2:-1]
-                    try:
-                        mode_id = int(number_str)
-                        self.set_mode_by_id(mode_id)
-                        print("MODE:", mode_id)
-                    except ValueError:
-                        print(f"Ignored bad mode data: '{number_str}'")
-
-                case _ if (result := extract_scl_string(s)):
-                    number_str = result[4:-1]
-                    try:
-                        sclval = int(number_str)
-                        self.set_left_slider_value(sclval)      # Sets left slider safely
-                        print("SCALE:", sclval)
-                        L_slider_ready = 1
-                    except ValueError:
-                        print(f"Ignored bad scale data: '{number_str}'")
-
-                case _ if (result := extract_ref_string(s)):
-                    number_str = result[4:-1]
-                    try:
-                        refval = int(number_str)
-                        self.set_right_slider_value(refval)   # Sets right slider safely
-                        print("REF:", refval)
-                        R_slider_ready = 1
-                    except ValueError:
-                        print(f"Ignored bad ref data: '{number_str}'")
-                        
-            K3ser.flush()
-        else:
-            checker += 1
-            match checker:
-                case 2:
-                    K3ser.write(b"#REF;")
-                    print("Sent: ;")
-                case 4:
-                    K3ser.write(b"#SCL;")
-                    print("Sent: #SCL;")
-                case 6:
-                    K3ser.write(b"BN;")
-                    print("Sent: BN;")
-                case 8:
-                    K3ser.write(b"MD;")
-                    print("Sent: MD;")
-                    checker = 0
-                case _:
-                    K3ser.write(b"FA;")
-                    print("Sent: FA;")
-            
-        self.root.after(MY_POLL_TIME, self.periodic_task)
+        PollScheduler decides what is due -- pushed state only gets a slow resync
+        """
+        self.radio.tick()
+        self.root.after(POLL_TICK, self.periodic_task)
+
+    def update_readout(self):
+        # everything decoded since last time goes in as one insert, the oldest text goes once there's too much
+        text, self.readout_pos = self.readout.since(self.readout_pos)
+        if text:
+            widget = self.readout_text
+            widget.config(state="normal")
+            widget.insert("end", text)
+            self.readout_chars += len(text)
+            if self.readout_chars > READOUT_KEEP:
+                widget.delete("1.0", f"1.0 + {self.readout_chars - READOUT_KEEP} chars")
+                self.readout_chars = READOUT_KEEP
+            widget.config(state="disabled")
+            widget.see("end")
+        self.root.after(READOUT_TIME, self.update_readout)
+
+    def start_metrics(self):
+        metrics.enabled = True
+        self._lag_due = time.perf_counter() + LAG_TICK / 1000
+        self.root.after(LAG_TICK, self.measure_lag)
+        self.root.after(STATS_TIME, self.update_stats)
+
+    def measure_lag(self):
+        # how late this callback ran is how long the Tk loop was busy
+        now = time.perf_counter()
+        metrics.observe("tk_loop_lag", max(0.0, now - self._lag_due))
+        self._lag_due = now + LAG_TICK / 1000
+        self.root.after(LAG_TICK, self.measure_lag)
+
+    def update_stats(self):
+        metrics.gauge("frames_captured", self.grabber.captured)
+        metrics.gauge("frames_dropped", self.grabber.dropped)
+        metrics.gauge("serial_bytes_out", self.k3.bytes_out)
+        metrics.gauge("serial_bytes_in", self.k3.bytes_in)
+        metrics.gauge("poll_bytes_per_s", self.poller.bandwidth())
+        metrics.gauge("capture_fps", 1 / self.grabber.interval if self.grabber.interval else 0)
+        metrics.gauge("display_max_fps", min(self.scheduler.max_fps(), 999))
+        if self.activity and self.activity.frames:
+            metrics.gauge("activity_ms_per_frame", 1000 * self.activity.busy_time / self.activity.frames)
+            metrics.gauge("active_columns", int(self.activity.active.sum()))
+        if self.analysis:
+            stats = self.analysis.stats()
+            metrics.gauge("analysis_dropped", stats["dropped"])
+            metrics.gauge("analysis_latency_ms", stats["latency_ms"])
+        if self.overlay and self.overlay.frames:
+            metrics.gauge("overlay_ms_per_frame", 1000 * self.overlay.busy_time / self.overlay.frames)
+            metrics.gauge("overlay_rebuilds", self.overlay.rebuilds)
+        if self.stats_label.winfo_ismapped():
+            self.stats_label.config(text=metrics.summary())
+        if config.get("metrics_file"):
+            try:
+                metrics.dump(config["metrics_file"])
+            except OSError as e:
+                log.warning("Could not write metrics file: %s", e)
+        self.root.after(STATS_TIME, self.update_stats)
+
+    def toggle_stats(self, event=None):
+        if self.stats_label.winfo_ismapped():
+            self.stats_label.place_forget()
+            return
+        if not metrics.enabled:
+            self.start_metrics()
+        self.stats_label.config(text=metrics.summary())
+        self.stats_label.place(in_=self.video_label, x=4, y=4)
 
-        
     def exit_app(self):
-        print("Exiting...")
+        log.info("Exiting...")
         # Save window position and size
         config['window_x'] = self.root.winfo_x()
         config['window_y'] = self.root.winfo_y()
@@ -634,12 +1317,43 @@ class VideoApp:
         config["slider_value"] = self.slider.get()
         config["left_slider_value"] = self.left_slider.get()
         save_config(config)
-        self.cap.release()
+        self.grabber.stop()
+        if self.sweep and self.sweep.running:
+            self.sweep.cancel()     # puts the radio back where it was
+            self.k3.drain()
+        if self.control:
+            self.control.stop()
+        self.radio.stop()
+        log.info("Frames: shown %d (%d partial), unchanged %d, dropped %d, worst capture-to-display %.1f ms",
+                 self.frames_shown, self.display.partial, self.display.skipped, self.grabber.dropped,
+                 self.max_frame_age * 1000)
+        log.info("Display: %.1f ms a frame, budget allows %.0f fps, paused %.0f s",
+                 self.scheduler.draw_time * 1000, min(self.scheduler.max_fps(), 999), self.scheduler.paused_time)
+        self.grabber.release()
+        if self.stream:
+            self.stream.stop()
+            self.stream.encoder.stop()
+            log.info("Stream: %s", self.stream.stats()["encoder"])
+        if self.session:
+            self.session.stop()
+        if self.history:
+            self.history.stop()
+            log.info("History: %d rows written, %d dropped", self.history.written, self.history.dropped)
+        if self.analysis:
+            self.analysis.stop()
+            log.info("Analysis: %s", self.analysis.stats())
+        if self.activity:
+            log.info("Activity: %d frames at %.2f ms, %d alerts", self.activity.frames,
+                     1000 * self.activity.busy_time / max(1, self.activity.frames), self.activity.alerted)
+        self.discovery.shutdown()
         self.root.quit()
         self.root.destroy()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()    # the analysis workers of a PyInstaller build start through here
+    logging.basicConfig(level=config.get("log_level", "WARNING"), filename=config.get("log_file"),
+                        format="%(asctime)s %(levelname)s %(message)s")
     root = ThemedTk(theme="black")
     app = VideoApp(root)
     root.mainloop()
@@ -0,0 +1,251 @@
+##
+##    Signal activity detector for the P3 interface
+##    Watches the spectrum trace frame after frame, also while nobody looks at the window:
+##    a noise floor per column (follows the trace down fast and up slowly, and never sits
+##    far above the median of the whole trace), a threshold from that floor and its spread,
+##    and per-column statistics -- active since when, last seen when, and the share of the
+##    last minutes it was active. A watchlist frequency that lights up raises an alert.
+##    It's whole-array NumPy per frame on the capture thread, so the display never waits on it.
+##
+##    "watchlist": [14074000, {"freq": 7030000, "width": 500, "name": "QRP CW"}] in config.json
+##    python activity.py                                      (cost per frame, alert latency, false alerts)
+##    python activity.py --history history.p3h --watch 14074000,14230000
+##
+
+import logging
+import queue
+import time
+
+import numpy as np
+
+log = logging.getLogger("K3_P3.activity")
+
+WATCH_WIDTH = 1000      # Hz around a watchlist frequency that count, unless the entry says otherwise
+MIN_SNR = 0.1           # a column is active this far above its floor (0..1 of the spectrum height) ...
+SPREAD_K = 4.0          # ... or this many times its noise spread, whichever is more
+FLOOR_FALL = 0.2        # per frame, how fast the floor follows the trace down ...
+FLOOR_RISE = 0.01       # ... and up
+FLOOR_SLACK = 0.1       # the floor stays within this of the trace's median, so a carrier can't lift it
+SPREAD_RATE = 0.05      # per frame, how fast the noise spread follows quiet columns
+SPREAD_START = 0.02
+WARMUP = 10             # frames after a new view before alerts, while the floor settles
+ALERT_TIME = 0.3        # s a watched column has to stay active before it alerts
+QUIET_TIME = 5.0        # s without activity before a watched frequency counts as quiet again
+REALERT_TIME = 60.0     # s between alerts for the same watchlist entry
+ACTIVITY_TAU = 300.0    # s -- activity is the decaying share of time a column was active
+
+
+def parse_watchlist(entries):
+    """Watchlist from config: bare frequencies in Hz or dicts with freq, and optionally width and name."""
+    watch = []
+    for entry in entries or ():
+        if not isinstance(entry, dict):
+            entry = {"freq": entry}
+        try:
+            freq = int(entry["freq"])
+        except (KeyError, TypeError, ValueError):
+            log.warning("Ignored watchlist entry %r", entry)
+            continue
+        watch.append({"freq": freq, "width": int(entry.get("width", WATCH_WIDTH)),
+                      "name": str(entry.get("name", f"{freq / 1000:.1f} kHz"))})
+    return watch
+
+
+def _shift(a, k, fill):
+    """a moved k places to the left (k < 0: right), the places uncovered set to fill."""
+    if k > 0:
+        a[:-k] = a[k:]
+        a[-k:] = fill
+    elif k < 0:
+        a[-k:] = a[:k]
+        a[:-k] = fill
+
+
+class ActivityDetector:
+    """
+    Per-column noise floor, thresholding and activity statistics for one view (VFO, span,
+    trace width). update() takes a trace (0..1 per column) with the VFO and span it was
+    taken at; a new view shifts the statistics along when only the VFO moved and starts
+    over otherwise. Alerts go into the alerts queue as dicts, for whoever owns the UI.
+    region is the x0, x1 part of the picture the trace comes from.
+    """
+    def __init__(self, watchlist=(), region=(0.0, 1.0), snr=MIN_SNR, alert_time=ALERT_TIME, tau=ACTIVITY_TAU):
+        self.watchlist = parse_watchlist(watchlist)
+        self.x0, self.x1 = region
+        self.snr = snr
+        self.alert_time = alert_time
+        self.tau = tau
+        self.alerts = queue.SimpleQueue()
+        self.view = None
+        self.frames = 0
+        self.alerted = 0
+        self.busy_time = 0.0
+        self._state = [{"on": False, "last_on": 0.0, "alerted": -REALERT_TIME} for _ in self.watchlist]
+        self._watch = []
+        self._fresh = 0
+        self._last = None
+
+    def _reset(self, n):
+        self.floor = None
+        self.spread = np.full(n, SPREAD_START, np.float32)
+        self.active = np.zeros(n, bool)
+        self.since = np.zeros(n)          # when the current run of activity started
+        self.last_seen = np.zeros(n)
+        self.activity = np.zeros(n, np.float32)
+        self._fresh = 0
+
+    def _retune(self, view):
+        old, self.view = self.view, view
+        freq, span, n = view
+        hz_per_column = (self.x1 - self.x0) * span / n
+        if old is not None and old[1:] == view[1:] and self.floor is not None:
+            k = int(round((freq - old[0]) / hz_per_column))
+            if abs(k) < n:
+                _shift(self.floor, k, float(np.median(self.floor)))
+                _shift(self.spread, k, SPREAD_START)
+                _shift(self.active, k, False)
+                _shift(self.since, k, 0.0)
+                _shift(self.last_seen, k, 0.0)
+                _shift(self.activity, k, 0.0)
+            else:
+                self._reset(n)
+        else:
+            self._reset(n)
+        # watchlist entries as column ranges of this view
+        self._watch = []
+        for entry in self.watchlist:
+            c0, c1 = (int(np.floor(self.column(entry["freq"] + d) + 0.5)) for d in (-entry["width"] / 2, entry["width"] / 2))
+            self._watch.append((max(0, c0), min(n, max(c1, c0 + 1))))
+
+    def column(self, freq):
+        """Column of the current view a frequency falls on (may be outside 0..n)."""
+        vfo, span, n = self.view
+        return ((freq - vfo) / span + 0.5 - self.x0) / (self.x1 - self.x0) * n - 0.5
+
+    def freq(self, column):
+        vfo, span, n = self.view
+        return int(vfo + span * (self.x0 + (column + 0.5) / n * (self.x1 - self.x0) - 0.5))
+
+    def update(self, amp, freq, span, stamp=None):
+        if not freq or not span or amp is None:
+            return
+        started = time.perf_counter()
+        stamp = started if stamp is None else stamp
+        view = (freq, span, len(amp))
+        if view != self.view:
+            self._retune(view)
+        if self.floor is None:
+            self.floor = np.array(amp, np.float32)
+        dt = stamp - self._last if self._last is not None else 0.0
+        self._last = stamp
+
+        floor = self.floor
+        floor += np.where(amp < floor, FLOOR_FALL, FLOOR_RISE) * (amp - floor)
+        np.minimum(floor, np.median(amp) + FLOOR_SLACK, out=floor)
+        excess = amp - floor
+        active = excess > np.maximum(self.snr, SPREAD_K * self.spread)
+        self.spread = np.where(active, self.spread, self.spread + SPREAD_RATE * (np.abs(excess) - self.spread))
+        self.since[active & ~self.active] = stamp
+        self.last_seen[active] = stamp
+        self.active = active
+        decay = np.float32(np.exp(-max(0.0, dt) / self.tau))
+        self.activity *= decay
+        self.activity[active] += 1 - decay
+        self._fresh += 1
+        if self._fresh > WARMUP:
+            self._check_watch(amp, excess, stamp)
+        self.frames += 1
+        self.busy_time += time.perf_counter() - started
+
+    def _check_watch(self, amp, excess, stamp):
+        for entry, state, (c0, c1) in zip(self.watchlist, self._state, self._watch):
+            if c1 <= c0:
+                continue    # not in the picture
+            on = self.active[c0:c1] & (stamp - self.since[c0:c1] >= self.alert_time)
+            if on.any():
+                state["last_on"] = stamp
+                if not state["on"]:
+                    state["on"] = True
+                    if stamp - state["alerted"] >= REALERT_TIME:
+                        state["alerted"] = stamp
+                        col = c0 + int(np.argmax(np.where(on, excess[c0:c1], -1.0)))
+                        self.alerted += 1
+                        self.alerts.put({"name": entry["name"], "watch": entry["freq"], "freq": self.freq(col),
+                                         "level": float(amp[col]), "stamp": stamp})
+            elif state["on"] and stamp - state["last_on"] > QUIET_TIME:
+                state["on"] = False
+
+    def watching(self):
+        """Names of the watchlist entries that are active right now."""
+        return [entry["name"] for entry, state in zip(self.watchlist, self._state) if state["on"]]
+
+    def busiest(self, count=5):
+        """(frequency, activity) of the count most active columns of the current view."""
+        if self.view is None:
+            return []
+        top = np.argsort(self.activity)[::-1][:count]
+        return [(self.freq(c), float(self.activity[c])) for c in top if self.activity[c] > 0]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Activity detector cost and alerts")
+    parser.add_argument("--history", help="run over the rows of a spectrum history file instead")
+    parser.add_argument("--watch", default="14074000,14230000", help="watchlist frequencies, Hz")
+    parser.add_argument("--frames", type=int, default=3000, help="synthetic frames (at 30 fps of stamps)")
+    args = parser.parse_args()
+    watch = [int(f) for f in args.watch.split(",") if f]
+
+    if args.history:
+        from history import HistoryReader
+
+        rows = HistoryReader(args.history).window()
+        detector = ActivityDetector(watch)
+        for row in rows:
+            detector.update(row["amp"] / np.float32(255), int(row["freq"]), int(row["span"]), float(row["time"]))
+            while not detector.alerts.empty():
+                alert = detector.alerts.get()
+                print(f"{time.ctime(alert['stamp'])}  {alert['name']} active at {alert['freq']} Hz")
+        print(f"{len(rows)} rows, {detector.busy_time / max(1, detector.frames) * 1e6:.0f} us a row")
+        for freq, share in detector.busiest():
+            print(f"{freq} Hz active {share * 100:.0f}% of the time")
+        return
+
+    from k3_emulator import SyntheticP3Capture, P3_SPECTRUM_REGION, P3_TRACE_BGR
+    from spectrum import SpectrumTrace
+
+    # 14074 comes and goes (keyed 2 s on, 6 s off), 14230 stays quiet, the rest of the band is busy
+    synth = SyntheticP3Capture(800, 600, fps=0)
+    synth.view = lambda: (14150000, 200000)
+    steady = [(14100000, 0.7, 2400), (14195000, 0.9, 2400), (14180000, 0.5, 150)]
+    trace = SpectrumTrace(P3_SPECTRUM_REGION, P3_TRACE_BGR)
+    detector = ActivityDetector(watch, (P3_SPECTRUM_REGION[0], P3_SPECTRUM_REGION[2]))
+    keyed_at, latencies, extract = [], [], 0.0
+    for i in range(args.frames):
+        stamp = i / 30
+        keyed = stamp % 8 >= 6
+        if keyed and (not keyed_at or keyed_at[-1] < stamp - 2.1):
+            keyed_at.append(stamp)
+        synth.signals = steady + ([(14074000, 0.6, 400)] if keyed else [])
+        frame = synth.read()[1]
+        started = time.perf_counter()
+        trace.update(frame, stamp)
+        extract += time.perf_counter() - started
+        detector.update(trace.amp, 14150000, 200000, stamp)
+        while not detector.alerts.empty():
+            alert = detector.alerts.get()
+            latencies.append(alert["stamp"] - keyed_at[-1] if keyed_at else None)
+            if alert["name"] != "14074.0 kHz":
+                print(f"false alert: {alert}")
+    per_frame = detector.busy_time / detector.frames
+    print(f"{detector.frames} frames: detector {per_frame * 1e6:.0f} us a frame, trace extraction "
+          f"{extract / detector.frames * 1000:.2f} ms -- {per_frame * 30 * 100:.2f}% of a core at 30 fps")
+    print(f"{detector.alerted} alerts for {len(keyed_at)} key-downs (one per {REALERT_TIME:.0f} s at most), "
+          f"latency {min(latencies) * 1000:.0f}-{max(latencies) * 1000:.0f} ms" if latencies else "no alerts")
+    for freq, share in detector.busiest(4):
+        print(f"{freq} Hz active {share * 100:.0f}% of the time")
+
+
+if __name__ == "__main__":
+    main()
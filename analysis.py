@@ -0,0 +1,425 @@
+##
+##    Frame analysis in worker processes for the P3 interface
+##    Trace extraction and whatever else looks at the pictures runs in a process pool
+##    instead of on the capture thread, so it can't hold the GIL while the Tk thread wants
+##    to draw. Each frame is copied once into a shared memory ring; the workers look at it
+##    in place and send back only their small results (a trace, some numbers). A frame is
+##    handed to the pool only while a ring slot is free, so when the workers fall behind it's
+##    analysis frames that get dropped -- the display never waits on them. The workers run
+##    at a lower priority, so on a busy machine the window gets the CPU first.
+##
+##    "analysis_workers": 2 in config.json
+##    python analysis.py                       (display fps as analysis load grows, thread vs. pool)
+##    python analysis.py --loads 0,20,60 --workers 2 --seconds 5
+##
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from spectrum import extract_trace, find_peaks, SPECTRUM_REGION, TRACE_TOLERANCE, TRACE_LEVEL, PEAK_PROMINENCE
+
+log = logging.getLogger("K3_P3.analysis")
+
+ANALYSIS_WORKERS = 2
+SLOTS_PER_WORKER = 2    # one frame being looked at and one waiting, per worker
+WORKER_NICE = 10        # how much lower the workers' priority is than the app's
+RESTART_DELAY = 5.0     # s before another try when the workers didn't start
+
+
+class TraceAnalyzer:
+    """SpectrumTrace.update() for a worker: returns (amp, peaks, frame width)."""
+    def __init__(self, region=SPECTRUM_REGION, color=None, tolerance=TRACE_TOLERANCE, level=TRACE_LEVEL,
+                 prominence=PEAK_PROMINENCE):
+        self.region = tuple(region)
+        self.color = color
+        self.tolerance = tolerance
+        self.level = level
+        self.prominence = prominence
+
+    @classmethod
+    def like(cls, trace):
+        """One with the settings of a SpectrumTrace."""
+        return cls(trace.region, trace.color, trace.tolerance, trace.level, trace.prominence)
+
+    def __call__(self, frame):
+        amp = extract_trace(frame, self.region, self.color, self.tolerance, self.level)
+        return amp, find_peaks(amp, self.prominence), frame.shape[1]
+
+
+class BusyAnalyzer:
+    """Stand-in for heavier analysis: ms of CPU in pure Python per frame, the kind that holds the GIL."""
+    def __init__(self, ms):
+        self.ms = ms
+
+    def __call__(self, frame):
+        end = time.thread_time() + self.ms / 1000
+        n = 0
+        while time.thread_time() < end:
+            n += 1
+        return n
+
+
+class FrameRing:
+    """
+    slots frames of one shape in a block of shared memory. The creating process owns it
+    (close() unlinks it); workers attach() by name. Nothing in here says which slot is in
+    use -- AnalysisPool keeps track of that on its side.
+    """
+    def __init__(self, shape, slots, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.frame_size = int(np.prod(self.shape))
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.frame_size * slots)
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self._frames = [np.ndarray(self.shape, np.uint8, self.shm.buf, i * self.frame_size) for i in range(slots)]
+
+    @classmethod
+    def attach(cls, name, shape, slots):
+        return cls(shape, slots, name)
+
+    def frame(self, slot):
+        return self._frames[slot]
+
+    def close(self):
+        self._frames = []       # views into the buffer have to go before it can be closed
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)     # Python 3.13+
+    except TypeError:
+        # spawned workers share the app's resource tracker, so their registering it too is harmless
+        return shared_memory.SharedMemory(name)
+
+
+def _lower_priority(nice):
+    try:
+        if hasattr(os, "nice"):
+            os.nice(nice)
+        else:
+            import psutil
+            psutil.Process().nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+    except (ImportError, OSError):
+        pass
+
+
+# worker process side: the ring and the analyzers, set up once per worker
+_ring = None
+_analyzers = None
+
+
+def _init_worker(name, shape, slots, analyzers, nice):
+    global _ring, _analyzers
+    _lower_priority(nice)
+    _ring = FrameRing.attach(name, shape, slots)
+    _analyzers = analyzers
+
+
+def _ready():
+    return True
+
+
+def _analyse(slot):
+    started = time.perf_counter()
+    frame = _ring.frame(slot)       # no copy -- the slot stays ours until this returns
+    result = {name: analyzer(frame) for name, analyzer in _analyzers.items()}
+    return result, time.perf_counter() - started
+
+
+class AnalysisPool:
+    """
+    Runs analyzers ({name: picklable callable taking a frame}) on frames in worker processes.
+    offer() is a FrameGrabber listener: it copies the frame into a free ring slot and queues
+    it for the pool, or drops it if every slot is still being worked on. results() is for the
+    owner's loop: (stamp, {name: result}) for the frames done since the last call, oldest first,
+    leaving out any that finished after a newer one. The ring follows the frame size. The
+    workers are started -- and started over, for a new size or after one died -- on a helper
+    thread, since spawning them takes a while; frames offered until they're up are dropped.
+    """
+    def __init__(self, analyzers, workers=ANALYSIS_WORKERS, slots=None, nice=WORKER_NICE):
+        self.analyzers = analyzers
+        self.workers = workers
+        self.slots = slots or workers * SLOTS_PER_WORKER
+        self.nice = nice
+        self.offered = 0
+        self.analysed = 0
+        self.dropped = 0        # no free slot or no workers yet, never analysed
+        self.stale = 0          # finished after a newer frame, not passed on
+        self.failed = 0
+        self.busy_time = 0.0    # s of analysis in the workers
+        self.latency = 0.0      # s from offer() to the result, smoothed
+        self._ring = None
+        self._pool = None
+        self._free = deque()
+        self._lock = threading.Condition()
+        self._copying = 0       # offer()s writing into the ring right now
+        self._opening = None    # the helper thread starting the workers
+        self._retry_at = 0.0
+        self._done = queue.SimpleQueue()
+        self._seq = 0
+        self._last = 0
+        self._stopped = False
+
+    @property
+    def ready(self):
+        return self._pool is not None
+
+    def start(self, shape=None):
+        if shape is not None:
+            with self._lock:
+                self._reopen(shape)
+        return self
+
+    def _reopen(self, shape):
+        # with the lock held: hands the current workers and ring to a helper thread to shut
+        # down, and has it start new ones
+        if self._opening is not None or self._stopped:
+            return
+        old = self._pool, self._ring
+        self._pool = self._ring = None
+        self._free = deque()
+        self._opening = threading.Thread(target=self._open, args=(shape, old), name="analysis-start", daemon=True)
+        self._opening.start()
+
+    def _open(self, shape, old):
+        with self._lock:
+            self._lock.wait_for(lambda: not self._copying)
+        self._shut(*old)
+        ring = FrameRing(shape, self.slots)
+        # spawn everywhere: a fork of a process with Tk and a capture thread in it is asking for trouble
+        pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"), _init_worker,
+                                   (ring.name, ring.shape, self.slots, self.analyzers, self.nice))
+        try:
+            # one task per worker gets them all spawned; wait until they're through their imports
+            for future in [pool.submit(_ready) for _ in range(self.workers)]:
+                future.result()
+        except Exception as e:
+            log.warning("Analysis workers didn't start, trying again in %.0f s: %r", RESTART_DELAY, e)
+            self._shut(pool, ring)
+            pool = ring = None
+            self._retry_at = time.monotonic() + RESTART_DELAY
+        with self._lock:
+            self._opening = None
+            stopped = self._stopped
+            if not stopped:
+                self._pool, self._ring, self._free = pool, ring, deque(range(self.slots))
+        if stopped:
+            self._shut(pool, ring)      # not under the lock: the pool's result thread takes it
+        elif ring is not None:
+            log.debug("Analysis ring %s: %d x %s", ring.name, self.slots, shape)
+
+    def offer(self, frame, stamp=None):
+        """Hands a frame to the pool; False if it was dropped."""
+        stamp = time.perf_counter() if stamp is None else stamp
+        with self._lock:
+            if self._stopped:
+                return False
+            self.offered += 1
+            if self._ring is None or frame.shape != self._ring.shape:
+                if self._opening is None and time.monotonic() >= self._retry_at:
+                    self._reopen(frame.shape)
+                self.dropped += 1
+                return False
+            if not self._free:
+                self.dropped += 1
+                return False
+            slot = self._free.popleft()
+            ring, pool = self._ring, self._pool
+            self._copying += 1
+        try:
+            np.copyto(ring.frame(slot), frame)
+            self._seq += 1
+            future = pool.submit(_analyse, slot)
+        except RuntimeError as e:
+            # a worker died (BrokenProcessPool) -- start over, off this thread
+            log.warning("Analysis pool failed, restarting it: %r", e)
+            self.failed += 1
+            with self._lock:
+                self._copying -= 1
+                self._lock.notify_all()
+                if pool is self._pool:
+                    self._reopen(frame.shape)
+            return False
+        with self._lock:
+            self._copying -= 1
+            self._lock.notify_all()
+        future.add_done_callback(lambda f, slot=slot, seq=self._seq, stamp=stamp, ring=ring,
+                                 offered=time.perf_counter(): self._finished(f, slot, seq, stamp, ring, offered))
+        return True
+
+    def _finished(self, future, slot, seq, stamp, ring, offered):
+        # the pool's result thread
+        with self._lock:
+            if ring is self._ring:
+                self._free.append(slot)
+        if future.cancelled():
+            return
+        try:
+            result, busy = future.result()
+        except Exception as e:
+            self.failed += 1
+            log.warning("Analysis of a frame failed: %r", e)
+            return
+        self.analysed += 1
+        self.busy_time += busy
+        took = time.perf_counter() - offered
+        self.latency = self.latency + 0.1 * (took - self.latency) if self.latency else took
+        self._done.put((seq, stamp, result))
+
+    def results(self):
+        done = []
+        while True:
+            try:
+                done.append(self._done.get_nowait())
+            except queue.Empty:
+                break
+        fresh = []
+        for seq, stamp, result in sorted(done, key=lambda d: d[0]):
+            if seq < self._last:
+                self.stale += 1
+                continue
+            self._last = seq
+            fresh.append((stamp, result))
+        return fresh
+
+    @staticmethod
+    def _shut(pool, ring):
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if ring is not None:
+            ring.close()
+
+    def stop(self):
+        """Shuts the workers down, once any offer() still copying a frame is done with the ring."""
+        with self._lock:
+            self._stopped = True
+            self._lock.wait_for(lambda: not self._copying)
+            pool, ring, opening = self._pool, self._ring, self._opening
+            self._pool = self._ring = None
+        if opening is not None:
+            opening.join()      # it shuts down what it started itself, seeing _stopped
+        self._shut(pool, ring)
+
+    def stats(self):
+        return {"offered": self.offered, "analysed": self.analysed, "dropped": self.dropped,
+                "stale": self.stale, "failed": self.failed,
+                "ms_per_frame": 1000 * self.busy_time / max(1, self.analysed), "latency_ms": 1000 * self.latency}
+
+
+def _display_run(frames, seconds, fps, listener, display_size):
+    """
+    The app's frame path in miniature: a capture thread at fps calling listener(frame, stamp)
+    the way FrameGrabber does, and this thread drawing the newest frame (resize + colour
+    conversion + PIL wrap, as DisplayPipeline does) whenever there is one.
+    Returns (frames drawn per second, worst capture-to-draw ms, frames captured per second).
+    """
+    import cv2
+    from PIL import Image
+
+    latest = [None]
+    captured = [0]
+    running = True
+
+    def capture():
+        due = time.perf_counter()
+        i = 0
+        while running:
+            due += 1 / fps
+            frame = frames[i % len(frames)]
+            i += 1
+            stamp = time.perf_counter()
+            latest[0] = (frame, stamp)
+            captured[0] += 1
+            if listener is not None:
+                listener(frame, stamp)
+            time.sleep(max(0.0, due - time.perf_counter()))
+
+    w, h = display_size
+    resized = np.empty((h, w, 3), np.uint8)
+    rgb = np.empty((h, w, 3), np.uint8)
+    image = Image.new("RGB", (w, h))
+    thread = threading.Thread(target=capture, daemon=True)
+    thread.start()
+    drawn, worst, taken = 0, 0.0, None
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        item = latest[0]
+        if item is None or item is taken:
+            time.sleep(0.002)
+            continue
+        taken = item
+        cv2.resize(item[0], (w, h), dst=resized)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=rgb)
+        image.frombytes(rgb)
+        drawn += 1
+        worst = max(worst, time.perf_counter() - item[1])
+    elapsed = time.perf_counter() - started
+    running = False
+    thread.join()
+    return drawn / elapsed, worst * 1000, captured[0] / elapsed
+
+
+def main():
+    import argparse
+    from k3_emulator import SyntheticP3Capture, P3_SPECTRUM_REGION, P3_TRACE_BGR
+
+    parser = argparse.ArgumentParser(description="Display fps with frame analysis on the capture thread vs. in a process pool")
+    parser.add_argument("--loads", default="0,10,30,60", help="ms of extra (GIL holding) analysis per frame")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS)
+    parser.add_argument("--seconds", type=float, default=4.0, help="per run")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--display", default="1426x720")
+    args = parser.parse_args()
+    display = tuple(int(v) for v in args.display.split("x"))
+
+    synth = SyntheticP3Capture(800, 600, fps=0)
+    frames = [synth.read()[1] for _ in range(16)]
+    trace = TraceAnalyzer(P3_SPECTRUM_REGION, P3_TRACE_BGR)
+    print(f"{args.fps:.0f} fps 800x600 capture -> display {display[0]}x{display[1]}, {args.seconds:.0f} s a run, "
+          f"{os.cpu_count()} CPUs, {args.workers} workers")
+    fps, worst, _ = _display_run(frames, args.seconds, args.fps, None, display)
+    print(f"no analysis          display {fps:5.1f} fps, worst {worst:6.1f} ms")
+    for load in (int(v) for v in args.loads.split(",")):
+        analyzers = {"trace": trace, "busy": BusyAnalyzer(load)}
+        done = [0]
+
+        def in_thread(frame, stamp):
+            for analyzer in analyzers.values():
+                analyzer(frame)
+            done[0] += 1
+
+        fps, worst, captured = _display_run(frames, args.seconds, args.fps, in_thread, display)
+        print(f"+{load:3d} ms  thread      display {fps:5.1f} fps, worst {worst:6.1f} ms, "
+              f"capture {captured:5.1f} fps, analysed {done[0] / args.seconds:5.1f} fps")
+
+        pool = AnalysisPool(analyzers, args.workers).start(frames[0].shape)
+        while not pool.ready:           # workers up before the clock starts
+            time.sleep(0.01)
+        pool.analysed = pool.offered = pool.dropped = 0
+        fps, worst, captured = _display_run(frames, args.seconds, args.fps, pool.offer, display)
+        time.sleep(0.2)
+        stats = pool.stats()
+        pool.stop()
+        print(f"+{load:3d} ms  pool        display {fps:5.1f} fps, worst {worst:6.1f} ms, "
+              f"capture {captured:5.1f} fps, analysed {stats['analysed'] / args.seconds:5.1f} fps, "
+              f"dropped {stats['dropped']:4d}, result latency {stats['latency_ms']:5.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+##
+##    CAT latency benchmark for the P3 interface (Linux only -- uses k3_emulator)
+##    Builds a real VideoApp against the K3 emulator and a synthetic P3 picture,
+##    drives the click, wheel and slider handlers, and reports the command
+##    round-trip distribution and the serial throughput. Bursts of clicks faster
+##    than the radio answers check that each one builds on the one before.
+##
+##    python bench_cat.py --count 200 --delay 0.002 --chunk 0
+##    python bench_cat.py --json results.json
+##    python bench_cat.py --gestures --work 0.02      (wheel spin / slider drag, no window needed)
+##    python bench_cat.py --readout --wpm 40          (CW text readout vs. VFO push latency, no window)
+##
+
+import argparse
+import contextlib
+import io
+import json
+import queue
+import random
+import time
+import tkinter as tk
+from types import SimpleNamespace
+
+import K3_P3
+import k3_rig
+from k3_emulator import K3Emulator, SyntheticP3Capture
+
+
+def percentiles(samples):
+    if not samples:
+        return {"n": 0}
+    xs = sorted(samples)
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+    return {"n": len(xs), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99),
+            "max_ms": xs[-1] * 1000}
+
+
+class CatBench:
+    def __init__(self, root, app, emu, timeout=2.0):
+        self.root = root
+        self.app = app
+        self.emu = emu
+        self.timeout = timeout
+        self.fa_applied = 0.0
+        handler = app.cat_handlers[b"FA"]
+
+        def timed_fa(body):
+            handler(body)
+            self.fa_applied = time.perf_counter()
+        app.cat_handlers[b"FA"] = timed_fa
+
+    def pump(self, until, timeout=None):
+        end = time.perf_counter() + (timeout or self.timeout)
+        while time.perf_counter() < end:
+            self.root.update()
+            if until():
+                return True
+            time.sleep(0.0005)
+        return False
+
+    def written_since(self, t0, prefix):
+        """Arrival time at the radio of the first command after t0 starting with prefix."""
+        found = None
+        for t, cmd in reversed(list(self.emu.log)):
+            if t < t0:
+                break
+            if cmd.startswith(prefix):
+                found = t
+        return found
+
+    def tune_round_trip(self, action, prefix):
+        """Handler call -> command at the radio -> matching FA reply applied in the app."""
+        t0 = time.perf_counter()
+        action()
+        if not self.pump(lambda: self.written_since(t0, prefix) is not None):
+            return None, None
+        wrote = self.written_since(t0, prefix)
+        target = self.emu.freq
+        if not self.pump(lambda: self.fa_applied > wrote and self.app.rig.confirmed["freq"] == target):
+            return wrote - t0, None
+        return wrote - t0, self.fa_applied - t0
+
+    def clicks(self, count):
+        writes, trips = [], []
+        width = self.app.video_label.winfo_width()
+        for _ in range(count):
+            event = SimpleNamespace(x=random.randint(0, width - 1), y=20)
+            w, rt = self.tune_round_trip(lambda: self.app.mouse_click(event), b"FA0")
+            writes += [w] if w is not None else []
+            trips += [rt] if rt is not None else []
+        return writes, trips
+
+    def wheel(self, count):
+        writes, trips = [], []
+        for i in range(count):
+            event = SimpleNamespace(x=0, y=0, delta=120 if i % 2 else -120)
+            w, rt = self.tune_round_trip(lambda: self.app.on_mouse_wheel(event), b"FA0")
+            writes += [w] if w is not None else []
+            trips += [rt] if rt is not None else []
+        return writes, trips
+
+    def sliders(self, count):
+        writes = []
+        for i in range(count):
+            t0 = time.perf_counter()
+            if i % 2:
+                self.app.on_slider_change(-100 - i % 40)
+                prefix = b"#REF"
+            else:
+                self.app.on_left_slider_change(20 + i % 40)
+                prefix = b"#SCL"
+            if self.pump(lambda: self.written_since(t0, prefix) is not None):
+                writes.append(self.written_since(t0, prefix) - t0)
+        return writes
+
+    def front_panel(self, count):
+        trips = []
+        for i in range(count):
+            t0 = time.perf_counter()
+            self.emu.turn_vfo(10 if i % 2 else -10)
+            target = self.emu.freq
+            if self.pump(lambda: self.app.rig.confirmed["freq"] == target):
+                trips.append(time.perf_counter() - t0)
+        return trips
+
+    def bursts(self, count, clicks=3):
+        """
+        clicks right of center with no pumping in between, as fast as a user double-clicks;
+        the radio must end up clicks steps away, and the app agree once the replies are in.
+        """
+        width = self.app.video_label.winfo_width()
+        event = SimpleNamespace(x=width * 3 // 4, y=20)
+        landed, settle = 0, []
+        for _ in range(count):
+            start = self.app.rig.freq
+            step = self.app.click_freq(event.x) - start
+            t0 = time.perf_counter()
+            for _ in range(clicks):
+                self.app.mouse_click(event)
+            target = start + clicks * step
+            if self.pump(lambda: self.emu.freq == target and self.app.rig.confirmed["freq"] == target
+                         and not self.app.rig.pending):
+                landed += 1
+                settle.append(time.perf_counter() - t0)
+            self.emu.turn_vfo(-clicks * step)       # back to where the burst started
+            self.pump(lambda: self.app.rig.freq == self.emu.freq)
+        return landed, settle
+
+    def busy(self, count):
+        """Clicks while the poll queue is being flooded."""
+        polls = [b"FA;", b"BN;", b"MD;", b"#REF;", b"#SCL;", b"IF;", b"AI;", b"#SPN;"]
+        flood = lambda: [self.app.k3.send(p, k3_rig.PRIORITY_POLL) for p in polls]
+        writes = []
+        width = self.app.video_label.winfo_width()
+        for _ in range(count):
+            flood()
+            event = SimpleNamespace(x=random.randint(0, width - 1), y=20)
+            t0 = time.perf_counter()
+            self.app.mouse_click(event)
+            if self.pump(lambda: self.written_since(t0, b"FA0") is not None):
+                writes.append(self.written_since(t0, b"FA0") - t0)
+        return writes
+
+
+def gesture(emu, baud, kind, engine, inputs=60, length=1.0):
+    """
+    One standard gesture straight through SerialWorker to the emulator, no window: a wheel
+    spin ("spin", inputs notches up) or a slider drag ("drag", #SCL 20 -> 60), evenly spread
+    over length seconds. engine=False sends one command per input like the handlers used to.
+    Returns bytes each way and the lag from the last input until the radio got there.
+    """
+    replies = queue.SimpleQueue()
+    k3 = k3_rig.SerialWorker(emu.port_name, str(baud), replies.put)
+    rig = k3_rig.RigState()
+    tuner = k3_rig.TuningEngine(rig, lambda data: k3.send(data, k3_rig.PRIORITY_USER))
+    framer = k3_rig.CatFramer()
+    fields = {b"FA": "freq", b"#SCL": "scl"}
+    k3.start()
+    k3.send(b"FA;#SCL;")
+
+    def pump():
+        while True:
+            try:
+                data = replies.get_nowait()
+            except queue.Empty:
+                return
+            for frame in framer.feed(data):
+                field = fields.get(k3_rig.cat_key(frame))
+                if field:
+                    rig.confirm(field, int(frame[len(k3_rig.cat_key(frame)):]))
+
+    deadline = time.perf_counter() + 5.0
+    while not (rig.ready("freq") and rig.ready("scl")) and time.perf_counter() < deadline:
+        pump()
+        time.sleep(0.001)
+    emu.scl = 20
+    rig.confirm("scl", 20)
+    out0, in0, commands0 = k3.bytes_out, k3.bytes_in, emu.commands
+    start = time.perf_counter()
+    next_tick = start
+    target = None
+    for i in range(inputs):
+        due = start + length * i / max(1, inputs - 1)
+        while True:
+            now = time.perf_counter()
+            if engine and now >= next_tick:
+                tuner.tick()
+                next_tick += k3_rig.POLL_TICK / 1000
+            pump()
+            if now >= due:
+                break
+            time.sleep(0.0005)
+        if kind == "spin":
+            if engine:
+                tuner.wheel(1)
+            else:
+                rig.adjust("freq", k3_rig.WHEEL_STEP)
+                k3.send(b"UP3;FA;")
+        else:
+            value = 20 + round(40 * i / max(1, inputs - 1))
+            if engine:
+                tuner.slider("scl", value)
+            else:
+                rig.expect("scl", value)
+                k3.send(f"#SCL{value:03d};".encode())
+    last_input = time.perf_counter()
+    target = rig.freq if kind == "spin" else rig.scl
+    reached = lambda: (emu.freq if kind == "spin" else emu.scl) == target
+    lag = None
+    while time.perf_counter() - last_input < 30.0:
+        now = time.perf_counter()
+        if engine and now >= next_tick:
+            tuner.tick()
+            next_tick += k3_rig.POLL_TICK / 1000
+        pump()
+        if reached():
+            lag = now - last_input
+            break
+        time.sleep(0.0005)
+    time.sleep(0.2)     # the last replies
+    k3.stop()
+    return {"bytes_to_radio": k3.bytes_out - out0, "bytes_from_radio": k3.bytes_in - in0,
+            "commands": emu.commands - commands0, "lag_ms": lag * 1000 if lag is not None else None}
+
+
+def gestures(args):
+    results = {"baud": args.baud, "work_s": args.work}
+    for kind in ("spin", "drag"):
+        for engine in (False, True):
+            emu = K3Emulator(delay=args.delay, chunk=args.chunk, baud=args.baud, work=args.work).start()
+            name = f"{kind}_{'engine' if engine else 'per_input'}"
+            results[name] = result = gesture(emu, args.baud, kind, engine)
+            emu.stop()
+            lag = f"{result['lag_ms']:7.0f} ms" if result["lag_ms"] is not None else "  never"
+            print(f"{name:16s} {result['bytes_to_radio']:5d} B to radio, {result['bytes_from_radio']:5d} B back, "
+                  f"{result['commands']:4d} commands, radio there {lag} after the hand stopped")
+    return results
+
+
+def readout(emu, tb, seconds=15.0):
+    """
+    The headless radio side with the TB text readout off ("off"), polled at the decode speed
+    ("adaptive") or every poll tick ("tick"), while the front panel VFO moves every 0.25 s.
+    Returns how long the VFO push took to come in, the serial traffic and the text shown.
+    """
+    from k3_rig import K3Rig
+    from k3_service import run
+
+    emu.mode = 3
+    radio = K3Rig(emu.port_name, "38400")
+    shown = radio.start_readout() if tb != "off" else None
+    if tb == "tick":
+        shown.poll_interval = lambda: k3_rig.POLL_TICK / 1000
+    pushes, waiting = [], {}
+    tail = bytearray()
+
+    def heard(direction, data):
+        # serial thread: when the pushed frequency arrives
+        if direction == "in":
+            tail.extend(data)
+            for freq, moved in list(waiting.items()):
+                if f"FA{freq:011d};".encode() in tail:
+                    pushes.append(time.perf_counter() - moved)
+                    del waiting[freq]
+            del tail[:-32]
+    radio.k3.listeners.append(heard)
+    radio.start()
+    run(radio, duration=1.0)
+    out0, in0, tb0 = radio.k3.bytes_out, radio.k3.bytes_in, emu.tb_sent
+    lost0, commands0 = emu.tb_lost, emu.commands
+    start = time.perf_counter()
+    position = shown.total if shown else 0
+    text = []
+    while time.perf_counter() - start < seconds:
+        waiting[emu.freq + 50] = time.perf_counter()
+        emu.turn_vfo(50)
+        run(radio, duration=0.25)
+        if shown:
+            got, position = shown.since(position)
+            text.append(got)
+    elapsed = time.perf_counter() - start
+    run(radio, duration=0.5)
+    radio.stop()
+    return {"readout": tb, "vfo_push": percentiles(pushes), "bytes_to_radio_per_s": (radio.k3.bytes_out - out0) / elapsed,
+            "bytes_from_radio_per_s": (radio.k3.bytes_in - in0) / elapsed,
+            "commands_per_s": (emu.commands - commands0) / elapsed,
+            "chars_decoded": emu.tb_sent - tb0 + emu.tb_lost - lost0, "chars_shown": len("".join(text)),
+            "chars_lost": emu.tb_lost - lost0, "sample": "".join(text)[-40:]}
+
+
+def readouts(args):
+    results = {"wpm": args.wpm}
+    for tb in ("off", "adaptive", "tick"):
+        emu = K3Emulator(delay=args.delay, chunk=args.chunk, baud=args.baud, work=args.work, cw_wpm=args.wpm).start()
+        results[tb] = r = readout(emu, tb, args.seconds)
+        emu.stop()
+        push = r["vfo_push"]
+        print(f"readout {tb:8s} VFO push p50 {push['p50_ms']:6.2f} p99 {push['p99_ms']:6.2f} ms  "
+              f"{r['bytes_to_radio_per_s']:5.1f} B/s to radio {r['bytes_from_radio_per_s']:6.1f} B/s back "
+              f"{r['commands_per_s']:5.1f} cmd/s  text {r['chars_shown']}/{r['chars_decoded']} shown, "
+              f"{r['chars_lost']} lost")
+    print(f"last text: {results['adaptive']['sample']!r}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CAT round-trip benchmark against the K3 emulator")
+    parser.add_argument("--count", type=int, default=100, help="actions per test")
+    parser.add_argument("--delay", type=float, default=0.002, help="emulator reply delay in seconds")
+    parser.add_argument("--chunk", type=int, default=0, help="emulator reply chunk size in bytes")
+    parser.add_argument("--baud", type=int, default=38400)
+    parser.add_argument("--work", type=float, default=0.0, help="emulator time spent on each command")
+    parser.add_argument("--gestures", action="store_true",
+                        help="only the wheel spin / slider drag comparison, without a window")
+    parser.add_argument("--readout", action="store_true",
+                        help="only the CW text readout cost on the VFO push latency, without a window")
+    parser.add_argument("--wpm", type=int, default=40, help="CW speed the emulator decodes for --readout")
+    parser.add_argument("--seconds", type=float, default=15.0, help="length of each --readout run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.gestures or args.readout:
+        results = gestures(args) if args.gestures else readouts(args)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    emu = K3Emulator(delay=args.delay, chunk=args.chunk, baud=args.baud, work=args.work).start()
+    root = tk.Tk()
+    root.geometry("1000x700+0+0")
+    results = {"delay_s": args.delay, "chunk": args.chunk, "baud": args.baud}
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = K3_P3.VideoApp(root, video_source=SyntheticP3Capture(emulator=emu), comm_port=emu.port_name,
+                             comm_rate=str(args.baud))
+        bench = CatBench(root, app, emu)
+        bench.pump(lambda: app.k3.connected and app.poller.auto_info and app.rig.ready("ref")
+                   and app.rig.ready("scl") and app.rig.ready("freq"), timeout=10.0)
+        start = time.perf_counter()
+        in0, out0 = emu.bytes_in, emu.bytes_out
+        for name, test in (("click", bench.clicks), ("wheel", bench.wheel)):
+            writes, trips = test(args.count)
+            results[name + "_write"] = percentiles(writes)
+            results[name + "_round_trip"] = percentiles(trips)
+        results["slider_write"] = percentiles(bench.sliders(args.count))
+        results["front_panel_push"] = percentiles(bench.front_panel(args.count))
+        results["click_write_polls_busy"] = percentiles(bench.busy(args.count))
+        results["click_bursts"] = max(1, args.count // 5)
+        landed, settle = bench.bursts(results["click_bursts"])
+        results["click_burst_settle"] = percentiles(settle)
+        results["click_bursts_landed"] = landed
+        results["rig_rollbacks"] = app.rig.rollbacks
+        elapsed = time.perf_counter() - start
+        results["serial"] = {"seconds": elapsed,
+                             "bytes_to_radio_per_s": (emu.bytes_in - in0) / elapsed,
+                             "bytes_from_radio_per_s": (emu.bytes_out - out0) / elapsed,
+                             "commands": emu.commands}
+        app.grabber.stop()
+        app.k3.stop()
+        root.destroy()
+    emu.stop()
+
+    for name, value in results.items():
+        if isinstance(value, dict) and "n" in value:
+            if value["n"]:
+                print(f"{name:24s} n={value['n']:4d}  p50 {value['p50_ms']:7.2f}  p90 {value['p90_ms']:7.2f}  "
+                      f"p99 {value['p99_ms']:7.2f}  max {value['max_ms']:7.2f} ms")
+            else:
+                print(f"{name:24s} no samples")
+    s = results["serial"]
+    print(f"serial: {s['bytes_to_radio_per_s']:.0f} B/s to radio, {s['bytes_from_radio_per_s']:.0f} B/s back, "
+          f"{s['commands']} commands in {s['seconds']:.1f} s")
+    print(f"click bursts landed: {results['click_bursts_landed']} of {results['click_bursts']}, "
+          f"rig state rollbacks: {results['rig_rollbacks']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
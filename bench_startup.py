@@ -0,0 +1,130 @@
+##
+##    Startup cost of the P3 interface: headless service vs. the full GUI app
+##    Every measurement runs in a fresh interpreter, so nothing is already imported:
+##    import time, peak RSS and which heavy modules got loaded, and then -- against the
+##    K3 emulator (Linux only) -- time until the rig state is known, RSS and CPU while
+##    running. The GUI run needs a display and is skipped without one.
+##
+##    python bench_startup.py
+##    python bench_startup.py --repeat 5 --run 5 --json startup.json
+##
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY = ("cv2", "numpy", "PIL", "tkinter", "ttkthemes")
+
+# runs in the child; MODE, PORT and RUN are filled in
+CHILD = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+if MODE == "headless":
+    import k3_service
+else:
+    import K3_P3
+imported = time.perf_counter() - t0
+
+def rss_mb():
+    try:
+        # VmHWM starts over at exec; ru_maxrss would include the parent that forked us
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 2 ** 10
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    except ImportError:         # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+result = {"import_s": imported, "import_rss_mb": rss_mb(),
+          "heavy_modules": [m for m in HEAVY if m in sys.modules], "modules": len(sys.modules)}
+if PORT:
+    t1 = time.perf_counter()
+    if MODE == "headless":
+        radio = k3_service.K3Rig(PORT, "38400").start()
+        ready = lambda: radio.rig.ready("freq") and radio.rig.ready("scl")
+        step = lambda: k3_service.run(radio, duration=0.01)
+    else:
+        from ttkthemes import ThemedTk
+        from k3_emulator import SyntheticP3Capture
+        root = ThemedTk(theme="black")
+        app = K3_P3.VideoApp(root, video_source=SyntheticP3Capture(), comm_port=PORT)
+        radio = app.radio
+        ready = lambda: radio.rig.ready("freq") and radio.rig.ready("scl") and app.frames_shown
+        step = lambda: (root.update(), time.sleep(0.005))
+    while not ready() and time.perf_counter() - t1 < 10:
+        step()
+    result["ready_s"] = time.perf_counter() - t1 if ready() else None
+    cpu, wall = time.process_time(), time.perf_counter()
+    while time.perf_counter() - wall < RUN:
+        step()
+    result["running_cpu_percent"] = 100 * (time.process_time() - cpu) / (time.perf_counter() - wall)
+    result["running_rss_mb"] = rss_mb()
+    radio.stop()
+print(json.dumps(result))
+"""
+
+
+def child(mode, port=None, run=0.0):
+    code = f"MODE = {mode!r}\nPORT = {port!r}\nRUN = {run!r}\nHEAVY = {HEAVY!r}\n" + CHILD
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    if out.returncode:
+        return {"error": (out.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 2] if xs else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and memory, headless vs. GUI")
+    parser.add_argument("--repeat", type=int, default=5, help="import runs per mode (the median is shown)")
+    parser.add_argument("--run", type=float, default=3.0, help="seconds to run against the emulator, 0 to skip")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    emu = None
+    if args.run and sys.platform != "win32":
+        from k3_emulator import K3Emulator
+        emu = K3Emulator().start()
+
+    results = {}
+    for mode in ("headless", "gui"):
+        runs = [child(mode) for _ in range(args.repeat)]
+        good = [r for r in runs if "error" not in r]
+        if not good:
+            results[mode] = runs[0]
+            print(f"{mode:9s} import failed: {runs[0]['error']}")
+            continue
+        result = results[mode] = {"import_s": median([r["import_s"] for r in good]),
+                                  "import_rss_mb": median([r["import_rss_mb"] for r in good]),
+                                  "heavy_modules": good[0]["heavy_modules"], "modules": good[0]["modules"]}
+        print(f"{mode:9s} import {result['import_s'] * 1000:7.1f} ms  RSS {result['import_rss_mb']:6.1f} MB  "
+              f"{result['modules']:4d} modules  heavy: {', '.join(result['heavy_modules']) or 'none'}")
+        if emu is not None:
+            running = child(mode, emu.port_name, args.run)
+            result["running"] = running
+            if "error" in running:
+                print(f"{'':9s} running: skipped ({running['error']})")
+            else:
+                ready = f"{running['ready_s'] * 1000:.0f} ms" if running["ready_s"] is not None else "never"
+                print(f"{'':9s} rig state known after {ready}, then {running['running_cpu_percent']:.1f}% CPU, "
+                      f"RSS {running['running_rss_mb']:.1f} MB")
+    if emu is not None:
+        emu.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
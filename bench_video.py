@@ -0,0 +1,506 @@
+##
+##    Capture-to-display benchmark for the P3 interface
+##    Feeds synthetic (or file-backed) frames through DisplayPipeline without a
+##    camera and times each stage: read, resize, colour conversion, PIL wrapping
+##    and the Tk handoff. Reports fps, per-stage p50/p99 and peak RSS as JSON so
+##    a regression in the display loop can be caught automatically.
+##
+##    python bench_video.py                                  (720p, 1080p and P3 SVGA)
+##    python bench_video.py --resolutions 1080p --json now.json --baseline last.json
+##    python bench_video.py --file capture.mp4
+##    python bench_video.py --session session.p3s            (frames of a recorded session)
+##    python bench_video.py --compare                        (old per-frame path vs. DisplayPipeline)
+##    python bench_video.py --probe-capture 0                (fps and latency of each capture mode)
+##    python bench_video.py --detect                         (change detection / dirty rows on and off)
+##    python bench_video.py --schedule                       (fixed poll vs. capture-locked vs. paused display loop)
+##    python bench_video.py --overlay --display 1920x1080    (readout overlay on and off, pointer still and moving)
+##    add --no-tk on machines without a display
+##
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+import K3_P3
+from k3_emulator import SyntheticP3Capture, P3_SPECTRUM_REGION, P3_TRACE_BGR
+from session import SessionPlayer
+from spectrum import SpectrumTrace
+
+RESOLUTIONS = {"svga": (800, 600), "720p": (1280, 720), "1080p": (1920, 1080)}
+STAGES = ("read", "resize", "convert", "wrap", "handoff")
+
+
+def synthetic_frame(width, height):
+    frame = np.random.randint(0, 40, (height, width, 3), np.uint8)
+    frame[height // 2:, :, 0] = 180       # something that looks a bit like a waterfall
+    return frame
+
+
+class FrameLoop:
+    """
+    Replays pre-rendered frames as a capture device. read() hands out a fresh copy
+    like a real capture does, so the read stage costs what a buffer fill costs.
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)].copy()
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+class FileLoop:
+    """File-backed capture that rewinds at the end of the file."""
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise RuntimeError(f"Could not open {path}")
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+        return ret, frame
+
+    def release(self):
+        self.cap.release()
+
+
+class _NullLabel:
+    """Stand-in for the video label when running without Tk."""
+    def config(self, **kw):
+        pass
+
+
+class _BufferOnlyPipeline(K3_P3.DisplayPipeline):
+    """DisplayPipeline minus the PhotoImage, for machines without a display."""
+    def _new_photo(self, w, h):
+        pass
+
+    def handoff(self, image):
+        pass
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:         # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2 ** 20
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def stage_stats(samples):
+    xs = np.sort(np.asarray(samples)) * 1000
+    return {"mean_ms": float(xs.mean()), "p50_ms": float(np.percentile(xs, 50)),
+            "p99_ms": float(np.percentile(xs, 99)), "max_ms": float(xs[-1])}
+
+
+def run_stages(cap, pipeline, root, size, count):
+    """One frame at a time through the same stages DisplayPipeline.show() runs."""
+    clock = time.perf_counter
+    times = {stage: [] for stage in STAGES}
+    for i in range(count + 5):
+        t0 = clock()
+        ret, frame = cap.read()
+        t1 = clock()
+        w, h = (frame.shape[1], frame.shape[0]) if size == "native" else size
+        resized = pipeline.resize(frame, w, h)
+        t2 = clock()
+        rgb = pipeline.convert(resized)
+        t3 = clock()
+        image = pipeline.wrap(rgb)
+        t4 = clock()
+        pipeline.handoff(image)
+        if root is not None:
+            root.update_idletasks()     # let Tk actually redraw the label
+        t5 = clock()
+        if i >= 5:                      # first frames build the buffers
+            for stage, dt in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)):
+                times[stage].append(dt)
+    return times
+
+
+def suite(args, root, label):
+    runs = []
+    for name in args.resolutions.split(","):
+        if args.file:
+            cap = FileLoop(args.file)
+            source = args.file
+        elif args.session:
+            cap = SessionPlayer(args.session, speed=0, loop=True).capture()
+            source = args.session
+        else:
+            sw, sh = RESOLUTIONS[name] if name in RESOLUTIONS else (int(v) for v in name.split("x"))
+            synth = SyntheticP3Capture(sw, sh, fps=0)
+            cap = FrameLoop([synth.read()[1] for _ in range(30)])
+            source = f"{sw}x{sh}"
+        size = "native" if args.display == "native" else tuple(int(v) for v in args.display.split("x"))
+        pipeline = K3_P3.DisplayPipeline(label) if root is not None else _BufferOnlyPipeline(label)
+        wall = time.perf_counter()
+        times = run_stages(cap, pipeline, root, size, args.frames)
+        wall = time.perf_counter() - wall
+        cap.release()
+        total = [sum(parts) for parts in zip(*times.values())]
+        runs.append({"source": source, "display": args.display, "frames": args.frames,
+                     "fps": args.frames / sum(total), "wall_fps": (args.frames + 5) / wall,
+                     "stages": {stage: stage_stats(times[stage]) for stage in STAGES},
+                     "frame": stage_stats(total), "peak_rss_mb": peak_rss_mb()})
+        if args.file:
+            break
+    return runs
+
+
+def print_runs(runs):
+    for run in runs:
+        print(f"{run['source']} -> {run['display']}: {run['fps']:.1f} fps, "
+              f"peak RSS {run['peak_rss_mb'] or 0:.0f} MB")
+        for stage, stats in list(run["stages"].items()) + [("frame", run["frame"])]:
+            print(f"  {stage:8s} p50 {stats['p50_ms']:7.3f}  p99 {stats['p99_ms']:7.3f} ms")
+
+
+def regressions(runs, baseline, tolerance):
+    """Slower-than-baseline fps or stage p50 beyond tolerance, matched by source."""
+    old = {(r["source"], r["display"]): r for r in baseline["runs"]}
+    found = []
+    for run in runs:
+        ref = old.get((run["source"], run["display"]))
+        if ref is None:
+            continue
+        if run["fps"] < ref["fps"] * (1 - tolerance):
+            found.append(f"{run['source']}: fps {ref['fps']:.1f} -> {run['fps']:.1f}")
+        for stage in STAGES:
+            was, now = ref["stages"][stage]["p50_ms"], run["stages"][stage]["p50_ms"]
+            if now > was * (1 + tolerance) and now - was > 0.05:
+                found.append(f"{run['source']} {stage}: p50 {was:.3f} -> {now:.3f} ms")
+    return found
+
+
+def probe_capture(device, count):
+    """
+    Opens the device once per entry in CAPTURE_MODES and measures what it really delivers.
+    buffered_frames counts frames the driver had queued up after a pause -- each one is
+    a frame period of extra lag.
+    """
+    clock = time.perf_counter
+    results = []
+    for mode in K3_P3.CAPTURE_MODES:
+        cap = cv2.VideoCapture(device)
+        if not cap.isOpened():
+            raise RuntimeError(f"Could not open capture device {device}")
+        actual = K3_P3.negotiate_capture(cap, [mode])
+        if actual is None:
+            results.append({"requested": mode, "supported": False})
+            cap.release()
+            continue
+        reads = []
+        start = clock()
+        for _ in range(count):
+            t0 = clock()
+            cap.read()
+            reads.append(clock() - t0)
+        fps = count / (clock() - start)
+        time.sleep(0.5)
+        buffered = 0
+        for _ in range(10):
+            t0 = clock()
+            cap.read()
+            if clock() - t0 > 0.25 / fps:
+                break
+            buffered += 1
+        results.append({"requested": mode, "supported": True, "actual": actual, "fps": fps,
+                        "read": stage_stats(reads), "buffered_frames": buffered,
+                        "buffer_latency_ms": buffered / fps * 1000})
+        cap.release()
+    return results
+
+
+def print_probe(results):
+    for r in results:
+        wanted = " ".join(f"{v}" for v in r["requested"].values()) or "driver default"
+        if not r["supported"]:
+            print(f"{wanted:28s} not supported")
+            continue
+        a = r["actual"]
+        print(f"{wanted:28s} -> {a['fourcc'] or '?':4s} {a['width']}x{a['height']}  {r['fps']:5.1f} fps  "
+              f"read p50 {r['read']['p50_ms']:6.2f} ms  buffered {r['buffered_frames']} "
+              f"(+{r['buffer_latency_ms']:.0f} ms)")
+
+
+def legacy_show(label, frame, w, h, use_tk):
+    # the update_video body before DisplayPipeline
+    frame = cv2.resize(frame, (w, h))
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    img = Image.fromarray(frame)
+    if use_tk:
+        imgtk = ImageTk.PhotoImage(image=img)
+        label.imgtk = imgtk
+        label.config(image=imgtk)
+
+
+def compare(name, show, frames, count):
+    show(frames[0])                 # warm up / build buffers
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for i in range(count):
+        show(frames[i % len(frames)])
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    print(f"{name:10s} {count / wall:8.1f} fps   {cpu / count * 1000:7.2f} ms CPU/frame")
+    return count / wall, cpu / count
+
+
+def p3_scenes(width, height, count):
+    """
+    P3 style frame sequences: a static screen, a quiet band (the trace moves every frame,
+    the waterfall only every 6th) and a busy one where everything moves every frame.
+    """
+    synth = SyntheticP3Capture(width, height, fps=0)
+    for _ in range(height):
+        synth.read()                        # fill the waterfall
+    live = [synth.read()[1] for _ in range(count)]
+    quiet = [frame.copy() for frame in live]
+    for i, frame in enumerate(quiet):
+        if i % 6:
+            frame[synth._wf_top:] = quiet[i - i % 6][synth._wf_top:]
+    return {"static": [live[0]] * count, "quiet": quiet, "live": live}
+
+
+def detect(label, use_tk, source, display, count):
+    sw, sh = source
+    dw, dh = display
+    base = K3_P3.DisplayPipeline if use_tk else _BufferOnlyPipeline
+    modes = {"every frame": lambda: base(label),
+             "skip unchanged": lambda: base(label, K3_P3.ChangeDetector()),
+             "dirty rows": lambda: base(label, K3_P3.ChangeDetector(), dirty_regions=True)}
+    print(f"source {sw}x{sh} -> display {dw}x{dh}, {count} frames" + ("" if use_tk else ", no Tk"))
+    results = {}
+    for scene, frames in p3_scenes(sw, sh, count).items():
+        for name, make in modes.items():
+            pipeline = make()
+            pipeline.draw(frames[0], dw, dh)
+            cpu = time.process_time()
+            for frame in frames[1:]:
+                pipeline.draw(frame.copy(), dw, dh)     # a new buffer every frame, like a capture
+            cpu = (time.process_time() - cpu) / (len(frames) - 1)
+            results[f"{scene}/{name}"] = {"cpu_ms": cpu * 1000, "skipped": pipeline.skipped,
+                                          "partial": pipeline.partial}
+            print(f"{scene:7s} {name:15s} {cpu * 1000:7.2f} ms CPU/frame   "
+                  f"skipped {pipeline.skipped:4d}  partial {pipeline.partial:4d}")
+    return results
+
+
+def overlay_cost(label, use_tk, source, display, count):
+    """Dirty-row drawing of the quiet and live scenes without the overlay, with it, and with the pointer moving."""
+    from overlay import Overlay
+    from k3_emulator import P3_SPECTRUM_REGION
+
+    sw, sh = source
+    dw, dh = display
+    base = K3_P3.DisplayPipeline if use_tk else _BufferOnlyPipeline
+    print(f"source {sw}x{sh} -> display {dw}x{dh}, {count} frames" + ("" if use_tk else ", no Tk"))
+    results = {}
+    scenes = p3_scenes(sw, sh, count)
+    for scene in ("quiet", "live"):
+        frames = scenes[scene]
+        for name in ("no overlay", "overlay", "pointer moving"):
+            overlay = None if name == "no overlay" else Overlay(P3_SPECTRUM_REGION)
+            if overlay is not None:
+                overlay.set_view(14074000, 100000, -130, 50, {"A": 14070000})
+            pipeline = base(label, K3_P3.ChangeDetector(), dirty_regions=True, overlay=overlay)
+            pipeline.draw(frames[0], dw, dh)
+            cpu = time.process_time()
+            for i, frame in enumerate(frames[1:]):
+                if name == "pointer moving":
+                    x = (i * 5) % dw
+                    overlay.set_hover(x, f"{(14074000 + (x - dw / 2) * 100000 / dw) / 1000:.2f} kHz")
+                pipeline.draw(frame.copy(), dw, dh)
+            cpu = (time.process_time() - cpu) / (len(frames) - 1)
+            results[f"{scene}/{name}"] = {"cpu_ms": cpu * 1000, "partial": pipeline.partial,
+                                          "overlay_ms": overlay.busy_time / max(1, overlay.frames) * 1000 if overlay else 0.0}
+            print(f"{scene:7s} {name:15s} {cpu * 1000:7.2f} ms CPU/frame   partial {pipeline.partial:4d}"
+                  + (f"   overlay {results[f'{scene}/{name}']['overlay_ms']:.3f} ms a composite" if overlay else ""))
+    return results
+
+
+def _burn(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def schedule(label, use_tk, display, seconds, fps=30):
+    """
+    update_video's loop with time.sleep() standing in for Tk's after(), against a paced
+    synthetic P3 capture: the old fixed 5 ms poll, the capture-locked DisplayScheduler,
+    the same with every core busy, and paused. CPU is the whole process, capture included.
+    The click snap trace is wired up as the default config does (a display listener);
+    "paused, trace always" has it run on every frame as a plain listener instead.
+    """
+    dw, dh = display
+    base = K3_P3.DisplayPipeline if use_tk else _BufferOnlyPipeline
+    results = {}
+    print(f"{fps} fps synthetic 800x600 capture -> display {dw}x{dh}, {seconds:.0f} s each" + ("" if use_tk else ", no Tk"))
+    for name in ("poll 5 ms", "capture-locked", "locked, cores busy", "paused", "paused, trace always"):
+        grabber = K3_P3.FrameGrabber(SyntheticP3Capture(800, 600, fps=fps))
+        trace = SpectrumTrace(P3_SPECTRUM_REGION, P3_TRACE_BGR)
+        (grabber.listeners if name == "paused, trace always" else grabber.display_listeners).append(trace.update)
+        pipeline = base(label, K3_P3.ChangeDetector(), dirty_regions=True)
+        scheduler = K3_P3.DisplayScheduler()
+        grabber.start()
+        time.sleep(1.0)         # device open and the capture rate measured
+        burners = []
+        if name == "locked, cores busy":
+            burners = [multiprocessing.Process(target=_burn, args=(seconds + 1,)) for _ in range(os.cpu_count() or 1)]
+            for b in burners:
+                b.start()
+        grabber.paused = name.startswith("paused")
+        shown = wakeups = 0
+        age = 0.0
+        cpu, start = time.process_time(), time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            if grabber.paused:
+                time.sleep(0.1)     # the app has no display loop at all while paused
+                continue
+            wakeups += 1
+            latest = grabber.latest()
+            if latest:
+                t0 = time.perf_counter()
+                pipeline.draw(latest[0], dw, dh)
+                scheduler.drawn(latest[1], time.perf_counter() - t0)
+                age += time.perf_counter() - latest[1]
+                shown += 1
+            delay = K3_P3.FRAME_POLL_TIME if name == "poll 5 ms" else scheduler.delay(grabber.interval)
+            time.sleep(delay / 1000)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        grabber.release()
+        for b in burners:
+            b.join()
+        results[name] = {"cpu_percent": 100 * cpu / elapsed, "wakeups_per_s": wakeups / elapsed,
+                         "shown_per_s": shown / elapsed, "draw_ms": scheduler.draw_time * 1000,
+                         "age_ms": 1000 * age / shown if shown else None}
+        print(f"{name:20s} CPU {100 * cpu / elapsed:5.1f}%   wakeups {wakeups / elapsed:6.1f}/s   "
+              f"shown {shown / elapsed:5.1f}/s   draw {scheduler.draw_time * 1000:5.2f} ms   "
+              f"capture-to-display {1000 * age / max(shown, 1):5.1f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the capture-to-display path")
+    parser.add_argument("--resolutions", default="720p,1080p,svga",
+                        help="comma separated: svga, 720p, 1080p or WxH")
+    parser.add_argument("--file", help="use frames from this video file instead of synthetic ones")
+    parser.add_argument("--session", help="use the frames of this recorded session (session.py)")
+    parser.add_argument("--display", default="1426x720", help="label size WxH, or 'native' for no resize")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--no-tk", action="store_true", help="skip the PhotoImage handoff")
+    parser.add_argument("--json", help="write the results to this file ('-' for stdout)")
+    parser.add_argument("--baseline", help="earlier --json output to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown vs. the baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="old per-frame-allocation path vs. DisplayPipeline at --source")
+    parser.add_argument("--source", default="1920x1080", help="source frame size for --compare / --detect")
+    parser.add_argument("--detect", action="store_true",
+                        help="static / quiet / busy P3 scenes with change detection off and on, at --source")
+    parser.add_argument("--overlay", action="store_true",
+                        help="measure the readout overlay on top of dirty-row drawing")
+    parser.add_argument("--schedule", action="store_true",
+                        help="display loop CPU and wakeups: fixed poll, capture-locked, under load, paused")
+    parser.add_argument("--probe-capture", type=int, metavar="DEVICE",
+                        help="measure every capture mode of this device index instead")
+    args = parser.parse_args()
+    use_tk = not args.no_tk
+
+    if args.probe_capture is not None:
+        results = probe_capture(args.probe_capture, min(args.frames, 120))
+        print_probe(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    root = None
+    if use_tk:
+        import tkinter as tk
+        root = tk.Tk()
+        label = tk.Label(root)
+        label.pack()
+    else:
+        label = _NullLabel()
+
+    if args.compare:
+        sw, sh = (int(v) for v in args.source.split("x"))
+        dw, dh = (int(v) for v in args.display.split("x"))
+        frames = [synthetic_frame(sw, sh) for _ in range(4)]
+        pipeline = K3_P3.DisplayPipeline(label) if use_tk else _BufferOnlyPipeline(label)
+        print(f"source {sw}x{sh} -> display {dw}x{dh}, {args.frames} frames" + ("" if use_tk else ", no Tk"))
+        before = compare("before", lambda f: legacy_show(label, f, dw, dh, use_tk), frames, args.frames)
+        after = compare("after", lambda f: pipeline.handoff(pipeline.wrap(pipeline.convert(
+            pipeline.resize(f, dw, dh)))), frames, args.frames)
+        print(f"speedup    {after[0] / before[0]:8.2f}x fps   {before[1] / after[1]:7.2f}x less CPU")
+        return 0
+
+    if args.schedule:
+        display = (800, 600) if args.display == "native" else tuple(int(v) for v in args.display.split("x"))
+        results = schedule(label, use_tk, display, 5.0)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.overlay:
+        results = overlay_cost(label, use_tk, tuple(int(v) for v in args.source.split("x")),
+                               tuple(int(v) for v in args.display.split("x")), min(args.frames, 120))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.detect:
+        results = detect(label, use_tk, tuple(int(v) for v in args.source.split("x")),
+                         tuple(int(v) for v in args.display.split("x")), min(args.frames, 120))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    runs = suite(args, root, label)
+    results = {"meta": {"python": platform.python_version(), "opencv": cv2.__version__,
+                        "platform": platform.platform(), "tk": use_tk}, "runs": runs}
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        print_runs(runs)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(runs, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION", line, file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
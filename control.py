@@ -0,0 +1,165 @@
+##
+##    Local control API for the P3 interface
+##    A small JSON over HTTP interface to the same actions as the buttons: tune,
+##    step, span, markers, VFO switches, band, mode, REF and SCL, plus the rig state.
+##    Used by k3_service.py, and by the app with "control_port" in config.json.
+##
+##    GET  /state                          rig state, connection, auto-info
+##    GET  /actions                        what can be posted, with the accepted labels
+##    POST /freq {"hz": 14074000}          (or marker A/B while one is active)
+##    POST /band {"band": "20 M"}          POST /span {"label": "10K"}   ...
+##
+
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from k3_rig import RigState, BANDS, MODES, SPANS
+
+log = logging.getLogger("K3_P3.control")
+
+CONTROL_PORT = 4533
+MARKERS = ("MKR A", "MKR B", "QSY", "OFF")
+VFO_BUTTONS = ("A/B", "SUB", "A>B", "SPLIT")
+
+
+def _int(args, key):
+    value = args.get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"'{key}' missing")
+    return int(value)
+
+
+def _named(args, key, names):
+    """A value given by name ("20 M") or by its CAT number (5)."""
+    value = args.get(key)
+    if isinstance(value, str) and value in names:
+        return names[value]
+    if isinstance(value, (int, str)) and not isinstance(value, bool) and str(value).isdigit() \
+            and int(value) in names.values():
+        return int(value)
+    raise ValueError(f"'{key}' must be one of {', '.join(names)}")
+
+
+def _label(args, labels):
+    value = args.get("label")
+    if value not in labels:
+        raise ValueError(f"'label' must be one of {', '.join(labels)}")
+    return value
+
+
+# action -> (check the request body, apply it to a K3Rig); checks run on the HTTP thread,
+# so a bad request gets its 400 and nothing reaches the rig
+ACTIONS = {
+    "freq": (lambda a: _int(a, "hz"), lambda radio, hz: radio.tune(hz)),
+    "step": (lambda a: _int(a, "notches"), lambda radio, n: radio.tuner.wheel(n)),
+    "span": (lambda a: _label(a, SPANS), lambda radio, label: radio.span_action(label)),
+    "marker": (lambda a: _label(a, MARKERS), lambda radio, label: radio.marker_action(label)),
+    "vfo": (lambda a: _label(a, VFO_BUTTONS), lambda radio, label: radio.vfo_action(label)),
+    "band": (lambda a: _named(a, "band", BANDS), lambda radio, band: radio.set_band(band)),
+    "mode": (lambda a: _named(a, "mode", MODES), lambda radio, mode: radio.set_mode(mode)),
+    "ref": (lambda a: _int(a, "value"), lambda radio, value: radio.tuner.slider("ref", value)),
+    "scl": (lambda a: _int(a, "value"), lambda radio, value: radio.tuner.slider("scl", value)),
+}
+
+
+def rig_state(radio):
+    state = {field: radio.rig.get(field) for field in RigState.FIELDS}
+    state.update(connected=radio.k3.connected, auto_info=radio.poller.auto_info,
+                 pending=sorted(radio.rig.pending), rollbacks=radio.rig.rollbacks)
+    return state
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s", self.address_string(), fmt % args)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("", "/state"):
+            self._reply(200, self.server.state)
+        elif self.path == "/actions":
+            self._reply(200, {"actions": sorted(ACTIONS), "bands": list(BANDS), "modes": list(MODES),
+                              "spans": list(SPANS), "markers": MARKERS, "vfo": VFO_BUTTONS})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        action = ACTIONS.get(self.path.strip("/"))
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            args = json.loads(self.rfile.read(length) or b"{}") if length else {}
+        except ValueError:
+            self._reply(400, {"error": "body is not JSON"})
+            return
+        if action is None:
+            self._reply(404, {"error": f"no action {self.path}", "actions": sorted(ACTIONS)})
+            return
+        try:
+            value = action[0](args if isinstance(args, dict) else {})
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self.server.commands.put((action[1], value))
+        self._reply(202, {"queued": self.path.strip("/")})
+
+
+class ControlServer(ThreadingHTTPServer):
+    """
+    Local JSON control API. Requests are checked on the server's threads and queued;
+    the loop that owns the rig applies them with run_pending(), so the rig is never
+    touched from two threads. GET /state answers from a snapshot run_pending() publishes.
+    Binds to localhost unless told otherwise -- anyone who can reach the port can tune
+    the radio.
+    """
+    daemon_threads = True
+
+    def __init__(self, radio, host="127.0.0.1", port=CONTROL_PORT):
+        super().__init__((host, port), ControlHandler)
+        self.radio = radio
+        self.commands = queue.SimpleQueue()
+        self.state = rig_state(radio)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="control", daemon=True)
+        self._thread.start()
+        log.info("Control API on http://%s:%d/", *self.server_address[:2])
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def run_pending(self, timeout=None):
+        """
+        Applies the queued commands; with a timeout, first waits that long for one.
+        Then publishes the rig state for GET /state, a new dict each time.
+        """
+        try:
+            command = self.commands.get(timeout=timeout) if timeout else self.commands.get_nowait()
+        except queue.Empty:
+            self.state = rig_state(self.radio)
+            return 0
+        done = 0
+        while command is not None:
+            apply, value = command
+            apply(self.radio, value)
+            done += 1
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                command = None
+        self.state = rig_state(self.radio)
+        return done
@@ -0,0 +1,230 @@
+##
+##    Spectrum history for the P3 interface
+##    Keeps hours of band activity in a fixed-size memory-mapped ring file:
+##    one row per sample with its time, center frequency, span and the spectrum
+##    trace (one byte per column). The file never grows, old rows get overwritten.
+##    HistoryRecorder writes on its own thread, HistoryReader pulls any time window.
+##
+##    python history.py history.p3h                          (what's in the file)
+##    python history.py history.p3h --last 3600 --png hour.png
+##
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger("K3_P3.history")
+
+MAGIC = b"P3HIST01"
+VERSION = 1
+HEADER_SIZE = 64
+HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("width", "<u4"),
+                   ("capacity", "<u8"), ("head", "<u8"), ("count", "<u8")])
+DEFAULT_WIDTH = 800
+DEFAULT_ROWS = 72000    # 4 hours at 5 rows a second, ~59 MB at 800 columns
+FLUSH_TIME = 5.0        # s between msync()s of the ring file
+QUEUE_ROWS = 256        # rows waiting for the writer before new ones get dropped
+
+
+def row_dtype(width):
+    return np.dtype([("time", "<f8"), ("freq", "<i8"), ("span", "<i4"), ("pad", "<i4"),
+                     ("amp", "u1", (width,))])
+
+
+class RingFile:
+    """The ring file itself: a header and capacity fixed-size rows, oldest first from head - count."""
+    def __init__(self, path, width=DEFAULT_WIDTH, capacity=DEFAULT_ROWS, readonly=False):
+        self.path = path
+        mode = "r" if readonly else "r+"
+        if not readonly and not self._matches(path, width, capacity):
+            self._create(path, width, capacity)
+        self.header = np.memmap(path, HEADER, mode, shape=(1,))
+        if self.header["magic"][0] != MAGIC:
+            raise ValueError(f"{path} is not a spectrum history file")
+        self.width = int(self.header["width"][0])
+        self.capacity = int(self.header["capacity"][0])
+        self.rows = np.memmap(path, row_dtype(self.width), mode, offset=HEADER_SIZE, shape=(self.capacity,))
+
+    @staticmethod
+    def _matches(path, width, capacity):
+        try:
+            header = np.fromfile(path, HEADER, count=1)
+        except (OSError, ValueError):
+            return False
+        return (len(header) == 1 and header["magic"][0] == MAGIC and header["version"][0] == VERSION
+                and header["width"][0] == width and header["capacity"][0] == capacity
+                and os.path.getsize(path) == HEADER_SIZE + capacity * row_dtype(width).itemsize)
+
+    @staticmethod
+    def _create(path, width, capacity):
+        log.info("Creating history file %s: %d rows of %d columns", path, capacity, width)
+        with open(path, "wb") as f:
+            f.truncate(HEADER_SIZE + capacity * row_dtype(width).itemsize)     # sparse where the OS allows
+        header = np.memmap(path, HEADER, "r+", shape=(1,))
+        header[0] = (MAGIC, VERSION, width, capacity, 0, 0)
+        header.flush()
+        del header
+
+    @property
+    def head(self):
+        return int(self.header["head"][0])
+
+    @property
+    def count(self):
+        return int(self.header["count"][0])
+
+    def segments(self):
+        """The filled part of the ring as (start, stop) index ranges, oldest first."""
+        head, count = self.head, self.count
+        start = (head - count) % self.capacity
+        if start + count <= self.capacity:
+            return [(start, start + count)]
+        return [(start, self.capacity), (0, head)]
+
+    def flush(self):
+        self.rows.flush()
+        self.header.flush()
+
+
+class HistoryRecorder:
+    """
+    Writes spectrum rows into a RingFile on a background thread.
+    add() never blocks: rows arrive through a bounded queue and are dropped (and
+    counted) if the disk falls behind. Rows narrower or wider than the file are
+    resampled to its width.
+    """
+    def __init__(self, path, width=DEFAULT_WIDTH, capacity=DEFAULT_ROWS, rate=5.0):
+        self.path = path
+        self.width = width
+        self.capacity = capacity
+        self.interval = 1.0 / rate if rate else 0.0
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=QUEUE_ROWS)
+        self._next = 0.0
+        self._thread = None
+        self._ring = None
+
+    def start(self):
+        self._ring = RingFile(self.path, self.width, self.capacity)
+        self._thread = threading.Thread(target=self._run, name="history", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def add(self, amp, freq, span, stamp=None):
+        """Queues one row (amp is 0..1 per column); rows closer together than 1/rate are skipped."""
+        now = time.monotonic()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        try:
+            self._queue.put_nowait((stamp if stamp is not None else time.time(), int(freq), int(span), amp))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        ring = self._ring
+        columns = np.linspace(0, 1, ring.width)
+        flushed = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=FLUSH_TIME)
+            except queue.Empty:
+                item = False
+            if item:
+                stamp, freq, span, amp = item
+                if len(amp) != ring.width:
+                    amp = np.interp(columns, np.linspace(0, 1, len(amp)), amp)
+                head = ring.head
+                rows = ring.rows
+                rows["time"][head], rows["freq"][head], rows["span"][head] = stamp, freq, span
+                rows["amp"][head] = np.clip(np.asarray(amp) * 255 + 0.5, 0, 255)
+                # the header moves only after the row is complete, a reader never sees half a row
+                ring.header["head"] = (head + 1) % ring.capacity
+                ring.header["count"] = min(ring.count + 1, ring.capacity)
+                self.written += 1
+            if item is None or time.monotonic() - flushed > FLUSH_TIME:
+                ring.flush()
+                flushed = time.monotonic()
+            if item is None:
+                return
+
+
+class HistoryReader:
+    """Read side of a ring file, safe to use while a recorder is writing it."""
+    def __init__(self, path):
+        self.ring = RingFile(path, readonly=True)
+
+    def time_range(self):
+        """(oldest, newest) timestamps, or None if the file is empty."""
+        segments = self.ring.segments()
+        if not self.ring.count:
+            return None
+        first, last = segments[0][0], segments[-1][1] - 1
+        return float(self.ring.rows["time"][first]), float(self.ring.rows["time"][last])
+
+    def window(self, start=None, end=None):
+        """
+        Rows with start <= time < end, oldest first, as a structured array (a copy).
+        Each filled segment of the ring is in time order, so this is two binary searches
+        per segment -- no scan, however big the file.
+        """
+        parts = []
+        times = self.ring.rows["time"]
+        for a, b in self.ring.segments():
+            seg = times[a:b]
+            lo = 0 if start is None else int(np.searchsorted(seg, start, "left"))
+            hi = len(seg) if end is None else int(np.searchsorted(seg, end, "left"))
+            if hi > lo:
+                parts.append(np.array(self.ring.rows[a + lo:a + hi]))
+        if not parts:
+            return np.empty(0, self.ring.rows.dtype)
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def last(self, seconds):
+        newest = self.time_range()
+        if newest is None:
+            return self.window(0, 0)
+        return self.window(newest[1] - seconds, None)
+
+
+def main():
+    import argparse
+
+    import cv2
+
+    parser = argparse.ArgumentParser(description="Look into a spectrum history file")
+    parser.add_argument("path")
+    parser.add_argument("--last", type=float, help="only the last this many seconds")
+    parser.add_argument("--png", help="write the rows as a waterfall picture (newest at the top)")
+    args = parser.parse_args()
+
+    reader = HistoryReader(args.path)
+    ring = reader.ring
+    print(f"{args.path}: {ring.count} of {ring.capacity} rows, {ring.width} columns")
+    found = reader.time_range()
+    if found is None:
+        return
+    print(f"from {time.ctime(found[0])} to {time.ctime(found[1])}")
+    started = time.perf_counter()
+    rows = reader.last(args.last) if args.last else reader.window()
+    print(f"{len(rows)} rows read in {(time.perf_counter() - started) * 1000:.1f} ms")
+    if args.png and len(rows):
+        picture = cv2.applyColorMap(np.ascontiguousarray(rows["amp"][::-1]), cv2.COLORMAP_JET)
+        cv2.imwrite(args.png, picture)
+
+
+if __name__ == "__main__":
+    main()
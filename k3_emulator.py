@@ -0,0 +1,385 @@
+##
+##    K3/P3 stand-in for testing without a radio (Linux only -- uses a pty)
+##
+##    K3Emulator answers the CAT commands the P3 interface uses on a
+##    pseudo-terminal. Point the app's COM port at emulator.port_name.
+##    SyntheticP3Capture is a VideoCapture look-alike that draws P3 style
+##    frames (spectrum trace on top, waterfall below) for the same radio.
+##
+##    python k3_emulator.py --delay 0.005 --chunk 4
+##    python k3_emulator.py --work 0.02          (a radio that takes 20 ms per command)
+##    python k3_emulator.py --cw-wpm 30          (decodes CW at 30 WPM for the TB readout)
+##
+
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+import cv2
+import numpy as np
+
+# UPn / DNn step sizes in Hz, from the K3 programmer's reference
+STEP_HZ = {0: 1, 1: 10, 2: 20, 3: 50, 4: 1000, 5: 2000, 6: 3000, 7: 5000, 8: 100, 9: 200}
+# frequency the radio lands on after a BNnn band change
+BAND_HZ = {0: 1830000, 1: 3573000, 2: 5357000, 3: 7074000, 4: 10136000, 5: 14074000,
+           6: 18100000, 7: 21074000, 8: 24915000, 9: 28074000, 10: 50313000}
+
+CW_TEXT = "CQ TEST WR9R WR9R TEST 5NN WI 5NN WI TU WR9R TEST "   # what the decoder "hears", over and over
+P3_TRACE_BGR = (0, 255, 255)                # spectrum trace colour drawn by SyntheticP3Capture
+P3_SPECTRUM_REGION = (0.0, 0.08, 1.0, 0.45)   # x0, y0, x1, y1 as fractions of the frame
+P3_WATERFALL_TOP = 0.5
+
+
+class K3Emulator:
+    """
+    Answers K3/P3 CAT commands on a pseudo-terminal.
+    delay is the processing time before each reply, chunk > 0 splits every reply into
+    pieces of that many bytes (chunk_gap apart) to exercise partial reads, and baud
+    paces both directions like the real serial line. work is the time the radio is busy
+    with each command: commands queue up behind each other and take effect one by one.
+    cw_wpm > 0 decodes CW_TEXT at that speed in CW mode; TB hands it out, 40 characters
+    at most like the K3's buffer, and whatever didn't fit is counted in tb_lost.
+    """
+    def __init__(self, delay=0.002, chunk=0, chunk_gap=0.001, baud=38400, work=0.0, cw_wpm=0):
+        self.delay = delay
+        self.work = work
+        self.chunk = chunk
+        self.chunk_gap = chunk_gap
+        self.byte_time = 10.0 / baud if baud else 0.0
+        self.freq = 14074000
+        self.freq_b = 14074000
+        self.band = 5
+        self.mode = 2
+        self.ai = 0
+        self.ref = -112
+        self.scl = 41
+        self.span = 1000        # #SPN units of 100 Hz
+        self.markers = {"A": 0, "B": 0}
+        self.marker_freq = {"A": 0, "B": 0}
+        self.split = False
+        self.cw_wpm = cw_wpm
+        self.tb_sent = 0
+        self.tb_lost = 0
+        self._tb_start = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.commands = 0
+        self.log = deque(maxlen=100000)     # (arrival time, command) for benchmarks
+        self.port_name = None
+        self._lock = threading.Lock()
+        self._pending = []      # (due time, bytes) waiting to be written
+        self._inbox = deque()   # (due time, command) received but not carried out yet
+        self._busy = 0.0
+        self._rx_free = 0.0
+        self._tx_free = 0.0
+        self._running = False
+        self._thread = None
+        self._master = None
+        self._slave = None
+
+    def start(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port_name = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="k3-emulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def turn_vfo(self, hz):
+        """Front panel VFO change -- pushed to the app if auto-info is on."""
+        with self._lock:
+            self.freq += hz
+            if self.ai:
+                self._queue_reply(self._if() if self.ai == 1 else self._fa())
+
+    def _fa(self):
+        return f"FA{self.freq:011d};".encode()
+
+    def _if(self):
+        body = f"{self.freq:011d}" + " " * 5 + "+0000" + "00 00" + "0" + str(self.mode) + "00000" + "1 "
+        return f"IF{body};".encode()
+
+    def _tb(self):
+        if not self.cw_wpm or self.mode not in (3, 7):
+            return b"TB000;"
+        now = time.perf_counter()
+        if self._tb_start is None:
+            self._tb_start = now
+        # a word is six characters with its space, so WPM / 10 characters a second
+        decoded = int((now - self._tb_start) * self.cw_wpm / 10)
+        count = decoded - self.tb_sent - self.tb_lost
+        if count > 40:
+            self.tb_lost += count - 40
+            count = 40
+        start = (self.tb_sent + self.tb_lost) % len(CW_TEXT)
+        text = (CW_TEXT * (2 + count // len(CW_TEXT)))[start:start + count]
+        self.tb_sent += count
+        return f"TB0{count:02d}{text};".encode()
+
+    def _queue_reply(self, data):
+        # called with the lock held
+        now = time.perf_counter()
+        start = max(now + self.delay, self._tx_free)
+        size = self.chunk or len(data)
+        for i in range(0, len(data), size):
+            piece = data[i:i + size]
+            self._pending.append((start, piece))
+            start += len(piece) * self.byte_time + (self.chunk_gap if self.chunk else 0)
+        self._tx_free = start
+
+    def _run(self):
+        tail = b""
+        while self._running:
+            with self._lock:
+                due = min((t for t, _ in self._pending), default=None)
+            if self._inbox and (due is None or self._inbox[0][0] < due):
+                due = self._inbox[0][0]
+            timeout = 0.01 if due is None else max(0.0, min(0.01, due - time.perf_counter()))
+            try:
+                ready, _, _ = select.select([self._master], [], [], timeout)
+            except (OSError, ValueError):
+                break
+            if ready:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    data = b""
+                now = time.perf_counter()
+                self.bytes_in += len(data)
+                # incoming bytes take line time too
+                self._rx_free = max(now, self._rx_free) + len(data) * self.byte_time
+                tail += data
+                *frames, tail = tail.split(b";")
+                for frame in frames:
+                    if frame:
+                        # with work, each command waits for the ones before it
+                        self._busy = max(now, self._busy) + self.work
+                        self._inbox.append((self._busy, frame))
+            self._execute()
+            self._flush()
+
+    def _execute(self):
+        now = time.perf_counter()
+        with self._lock:
+            while self._inbox and self._inbox[0][0] <= now:
+                due, frame = self._inbox.popleft()
+                self.commands += 1
+                try:
+                    reply = self._handle(frame.decode("ascii", "replace"))
+                except ValueError:
+                    reply = b"?;"
+                self.log.append((due, frame))     # after the state change
+                if reply:
+                    self._tx_free = max(self._tx_free, self._rx_free)
+                    self._queue_reply(reply)
+
+    def _flush(self):
+        now = time.perf_counter()
+        with self._lock:
+            ready = [p for p in self._pending if p[0] <= now]
+            self._pending = [p for p in self._pending if p[0] > now]
+        for _, piece in ready:
+            try:
+                os.write(self._master, piece)
+                self.bytes_out += len(piece)
+            except OSError:
+                pass
+
+    def _handle(self, cmd):
+        """Applies one command (without the ';') and returns the reply bytes, if any."""
+        if cmd.startswith("#"):
+            return self._handle_p3(cmd)
+        name, arg = cmd[:2], cmd[2:]
+        match name:
+            case "FA" | "FB":
+                if not arg:
+                    value = self.freq if name == "FA" else self.freq_b
+                    return f"{name}{value:011d};".encode()
+                if name == "FA":
+                    self.freq = int(arg)
+                else:
+                    self.freq_b = int(arg)
+            case "BN":
+                if not arg:
+                    return f"BN{self.band:02d};".encode()
+                self.band = int(arg)
+                self.freq = BAND_HZ.get(self.band, self.freq)
+            case "MD":
+                if not arg:
+                    return f"MD{self.mode};".encode()
+                self.mode = int(arg)
+            case "AI":
+                if not arg:
+                    return f"AI{self.ai};".encode()
+                self.ai = int(arg)
+            case "IF":
+                return self._if()
+            case "UP" | "DN":
+                step = STEP_HZ.get(int(arg or 0), 1)
+                self.freq += step if name == "UP" else -step
+            case "SW":
+                # SWTnn tap / SWHnn hold front panel switches
+                match arg:
+                    case "T11":
+                        self.freq, self.freq_b = self.freq_b, self.freq
+                    case "T13":
+                        self.freq_b = self.freq
+                    case "H13":
+                        self.split = not self.split
+            case "FT":
+                # TX VFO: 1 is B, i.e. split
+                if not arg:
+                    return f"FT{int(self.split)};".encode()
+                self.split = arg == "1"
+            case "TB":
+                return self._tb()
+            case _:
+                return b"?;"
+        return None
+
+    def _handle_p3(self, cmd):
+        name, arg = cmd[:4], cmd[4:].strip()
+        match name:
+            case "#REF":
+                if not arg:
+                    return f"#REF{self.ref:03d};".encode()
+                self.ref = int(arg)
+            case "#SCL":
+                if not arg:
+                    return f"#SCL{self.scl:03d};".encode()
+                self.scl = int(arg)
+            case "#SPN":
+                if not arg:
+                    return f"#SPN{self.span:06d};".encode()
+                self.span = int(arg)
+            case "#MKA" | "#MKB":
+                self.markers[name[3]] = int(arg or 0)
+            case "#MFA" | "#MFB":
+                self.marker_freq[name[3]] = int(arg)
+            case "#QSY":
+                if arg == "1":
+                    for mk, on in self.markers.items():
+                        if on:
+                            self.freq = self.marker_freq[mk]
+            case _:
+                return b"?;"
+        return None
+
+
+class SyntheticP3Capture:
+    """
+    VideoCapture look-alike that draws P3 style frames at a fixed rate.
+    With an emulator attached the signals follow its frequency and span, so clicks and
+    band changes show up in the picture the way they would on the real P3.
+    signals is a list of (frequency Hz, strength 0..1, width Hz).
+    """
+    def __init__(self, width=800, height=600, fps=30, emulator=None, signals=None, seed=1):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.emulator = emulator
+        self.signals = signals if signals is not None else [
+            (14074000, 0.8, 1500), (14076500, 0.5, 400), (14070200, 0.6, 200),
+            (14030000, 0.7, 150), (14195000, 0.9, 2400)]
+        self._rng = np.random.default_rng(seed)
+        self._next = 0.0
+        self._opened = True
+        self._base = np.zeros((height, width, 3), np.uint8)
+        x0, y0, x1, y1 = P3_SPECTRUM_REGION
+        self._top = int(y0 * height)
+        self._bottom = int(y1 * height)
+        self._wf_top = int(P3_WATERFALL_TOP * height)
+        self._wf = np.zeros((height - self._wf_top, width, 3), np.uint8)
+        self._base[self._top:self._bottom:max(1, (self._bottom - self._top) // 8), :] = (60, 60, 60)   # grid
+        self._cols = np.arange(width)
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: self.fps}.get(prop, 0.0)
+
+    def set(self, prop, value):
+        return False
+
+    def grab(self):
+        return self._opened
+
+    def view(self):
+        if self.emulator is not None:
+            return self.emulator.freq, self.emulator.span * 100
+        return 14074000, 100000
+
+    def spectrum(self):
+        """Per-column amplitude 0..1 for the current view."""
+        center, span = self.view()
+        hz = center + (self._cols - self.width / 2) * span / self.width
+        amp = self._rng.random(self.width) * 0.08 + 0.05
+        for f, strength, bw in self.signals:
+            amp += strength * np.exp(-0.5 * ((hz - f) / max(bw / 2, span / self.width)) ** 2)
+        return np.clip(amp, 0, 1)
+
+    def read(self, image=None):
+        if not self._opened:
+            return False, None
+        if self.fps:
+            now = time.perf_counter()
+            self._next = max(self._next + 1.0 / self.fps, now)
+            time.sleep(max(0.0, self._next - now))
+        amp = self.spectrum()
+        frame = self._base.copy()
+        rows = (self._bottom - 1 - amp * (self._bottom - self._top - 2)).astype(np.int32)
+        trace = np.stack([self._cols.astype(np.int32), rows], axis=1)
+        cv2.polylines(frame, [trace.reshape(-1, 1, 2)], False, P3_TRACE_BGR, 1)
+        self._wf[1:] = self._wf[:-1]
+        self._wf[0, :, 0] = (255 * (1 - amp)).astype(np.uint8)
+        self._wf[0, :, 1] = (255 * amp).astype(np.uint8)
+        self._wf[0, :, 2] = (255 * amp * amp).astype(np.uint8)
+        frame[self._wf_top:] = self._wf
+        center, span = self.view()
+        cv2.putText(frame, f"{center / 1000:.2f}", (self.width // 2 - 40, self._bottom + 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
+        return True, frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description="K3/P3 emulator on a pseudo-terminal")
+    parser.add_argument("--delay", type=float, default=0.002, help="reply delay in seconds")
+    parser.add_argument("--chunk", type=int, default=0, help="split replies into chunks of this many bytes")
+    parser.add_argument("--baud", type=int, default=38400)
+    parser.add_argument("--work", type=float, default=0.0, help="seconds the radio spends on each command")
+    parser.add_argument("--cw-wpm", type=int, default=0, help="decode CW at this speed for TB (in CW mode)")
+    args = parser.parse_args()
+
+    emu = K3Emulator(delay=args.delay, chunk=args.chunk, baud=args.baud, work=args.work, cw_wpm=args.cw_wpm).start()
+    print(f"K3 emulator on {emu.port_name} -- set it as the COM port, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emu.stop()
+    print(f"{emu.commands} commands, {emu.bytes_in} bytes in, {emu.bytes_out} bytes out")
+
+
+if __name__ == "__main__":
+    main()
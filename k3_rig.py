@@ -0,0 +1,842 @@
+##
+##    K3 side of the P3 interface, without any GUI
+##    The serial worker, polling, reply framing, rig state and tuning engine, and
+##    K3Rig tying them together with the action handlers the buttons use. Only the
+##    standard library and pyserial -- no Tk, OpenCV or PIL -- so it loads fast and
+##    runs on a machine without a display (k3_service.py).
+##
+
+import bisect
+import collections
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import re
+import threading
+import time
+
+import serial
+
+log = logging.getLogger("K3_P3.rig")
+
+MY_POLL_TIME = 500      # ms between FA polls when the radio isn't pushing auto-info
+POLL_TICK = 50          # ms between poll scheduler checks
+SERIAL_PUMP_TIME = 20   # ms between hand-offs of received serial data to the reply handlers
+PRIORITY_USER = 0       # user actions are written ahead of ...
+PRIORITY_POLL = 1       # ... background status polls
+CONFIG_FILE = "config.json"
+WHEEL_STEP = 50         # Hz the K3 moves for one UP3/DN3
+SPAN_UNIT = 100         # Hz per #SPN count
+READOUT_CHARS = 4096    # decoded CW/data text kept, however long the session
+TB_MODES = (3, 6, 7, 9) # CW, DATA and their reverse -- the only modes the K3 decodes text in
+W_WIDTH = 750           # default window size
+W_HEIGHT = 615
+
+# Load saved settings
+def load_config():
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)            
+    return {
+        "video_source": 0,
+        "k3_port": "COM4",
+        "baud_rate": "38400",
+        "stay_on_top": False,
+        "window_x": 100,
+        "window_y": 100,
+        "window_width": W_WIDTH,
+        "window_height": W_HEIGHT,
+        "slider_value": -117.0,  # default slider position
+        "left_slider_value": 60.0
+    }
+
+config_lock = threading.Lock()   # capture/discovery threads save config too
+
+def save_config(config):
+    with config_lock:
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(config, f)
+            
+config = load_config()
+
+def open_k3_port(port, rate):
+    if hasattr(port, "read"):
+        return port         # already a serial-like object, e.g. a session replay
+    ser = serial.Serial(baudrate=int(rate), timeout=0.1)
+    ser.port = port
+    ser.rts = False     # set before open() so the lines never toggle
+    ser.dtr = False
+    ser.open()
+    return ser
+
+def extract_tb_data(k):
+    # TBtrrs; -- t characters still to send, rr received characters, then the received text
+    match = re.match(r'TB\d(\d{2})(.*);', k, re.S)
+    if match:
+        byte_count = int(match.group(1))
+        data = match.group(2)
+        if len(data) >= byte_count:
+            return data[:byte_count]
+    return None
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms for the hot paths (serial round-trips,
+    frames, Tk loop lag). Callers check .enabled first, so when it's off the cost is
+    one attribute test.
+    """
+    BUCKETS_MS = (0.5, 1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000, 2000, 5000)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = {"buckets": [0] * (len(self.BUCKETS_MS) + 1),
+                                             "count": 0, "sum_ms": 0.0, "max_ms": 0.0}
+            h["buckets"][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            h["count"] += 1
+            h["sum_ms"] += ms
+            h["max_ms"] = max(h["max_ms"], ms)
+
+    def percentile(self, name, q):
+        """Upper edge of the bucket holding the q quantile (0..1)."""
+        h = self.histograms.get(name)
+        if not h or not h["count"]:
+            return None
+        seen = 0
+        for i, n in enumerate(h["buckets"]):
+            seen += n
+            if seen >= q * h["count"]:
+                return self.BUCKETS_MS[i] if i < len(self.BUCKETS_MS) else h["max_ms"]
+        return h["max_ms"]
+
+    def snapshot(self):
+        with self._lock:
+            hist = {name: dict(h, buckets=list(h["buckets"]), p50_ms=self.percentile(name, 0.5),
+                               p99_ms=self.percentile(name, 0.99)) for name, h in self.histograms.items()}
+            return {"uptime_s": time.monotonic() - self.started, "counters": dict(self.counters),
+                    "gauges": dict(self.gauges), "histograms": hist, "buckets_ms": list(self.BUCKETS_MS)}
+
+    def summary(self):
+        snap = self.snapshot()
+        lines = [f"{k} {v}" for k, v in sorted(snap["counters"].items())]
+        lines += [f"{k} {v:.1f}" if isinstance(v, float) else f"{k} {v}" for k, v in sorted(snap["gauges"].items())]
+        lines += [f"{k} p50<{h['p50_ms']} p99<{h['p99_ms']} max {h['max_ms']:.1f} ms"
+                  for k, h in sorted(snap["histograms"].items())]
+        return "\n".join(lines)
+
+    def dump(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, path)
+
+
+metrics = Metrics(config.get("metrics", False) or config.get("stats_overlay", False))
+
+
+class SerialWorker:
+    """
+    Owns the K3 port on its own thread so a slow or missing port never blocks the UI.
+    Commands are written in priority order (user actions before polls) and everything
+    read back is passed to on_receive from the worker thread, so it must be thread-safe.
+    A port that goes away is reopened with backoff.
+    """
+    RETRY_MIN = 0.5
+    RETRY_MAX = 8.0
+    IDLE_READ = 0.02    # seconds between reads when nothing is being written
+
+    def __init__(self, port, rate, on_receive, on_connect=None):
+        self.port = port
+        self.rate = rate
+        self.on_receive = on_receive
+        self.on_connect = on_connect
+        self.connected = False
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.query_sent = {}    # reply key -> time its query was written, for round-trip metrics
+        self.listeners = []     # called as listener("out" / "in", data) on the worker thread
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._pending_polls = set()
+        self._poll_lock = threading.Lock()
+        self._ser = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="k3-serial", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._queue.put((-1, next(self._order), None))     # wake the worker up
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        self._close()
+
+    def send(self, data, priority=PRIORITY_USER):
+        data = bytes(data)
+        if priority == PRIORITY_POLL:
+            with self._poll_lock:
+                if data in self._pending_polls:
+                    return      # the same poll is still waiting -- don't pile them up
+                self._pending_polls.add(data)
+        self._queue.put((priority, next(self._order), data))
+
+    def drain(self, timeout=0.5):
+        """Waits up to timeout for everything queued so far to be written, e.g. before stop()."""
+        end = time.monotonic() + timeout
+        while self.connected and not self._queue.empty() and time.monotonic() < end:
+            time.sleep(0.01)
+        time.sleep(0.01)    # the last item may be taken but not written yet
+
+    def reopen(self, port, rate):
+        self._queue.put((-1, next(self._order), (port, rate)))
+
+    def _close(self):
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except (serial.SerialException, OSError):
+                pass
+        self._ser = None
+        self.connected = False
+
+    def _next(self, timeout):
+        try:
+            _, _, item = self._queue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return None
+        if isinstance(item, tuple):
+            self.port, self.rate = item
+            self._close()
+            return None
+        if item is not None:
+            with self._poll_lock:
+                self._pending_polls.discard(item)
+        return item
+
+    def _note_queries(self, data):
+        now = time.perf_counter()
+        metrics.count("serial_writes")
+        for command in data.split(b";"):
+            if command and command == cat_key(command):    # bare query like FA; or #REF;
+                self.query_sent[command] = now
+
+    def _run(self):
+        delay = self.RETRY_MIN
+        while self._running:
+            if self._ser is None:
+                try:
+                    self._ser = open_k3_port(self.port, self.rate)
+                    self.connected = True
+                    delay = self.RETRY_MIN
+                    log.info("K3 connected on %s at %s", self.port, self.rate)
+                    if self.on_connect:
+                        self.on_connect()
+                except (serial.SerialException, OSError, ValueError) as e:
+                    log.warning("K3 port %s unavailable (%s), retry in %.1fs", self.port, e, delay)
+                    end = time.monotonic() + delay
+                    target = (self.port, self.rate)
+                    while self._running and (self.port, self.rate) == target and time.monotonic() < end:
+                        self._next(end - time.monotonic())    # commands for a dead port are dropped
+                    delay = min(delay * 2, self.RETRY_MAX)
+                    continue
+            data = self._next(self.IDLE_READ)
+            try:
+                if data and self._ser is not None:
+                    self._ser.write(data)
+                    self.bytes_out += len(data)
+                    for listener in self.listeners:
+                        listener("out", data)
+                    if metrics.enabled:
+                        self._note_queries(data)
+                if self._ser is not None and self._ser.in_waiting:
+                    received = self._ser.read(self._ser.in_waiting)
+                    self.bytes_in += len(received)
+                    for listener in self.listeners:
+                        listener("in", received)
+                    if metrics.enabled:
+                        metrics.count("serial_reads")
+                    self.on_receive(received)
+            except (serial.SerialException, OSError) as e:
+                log.warning("K3 port %s lost: %s", self.port, e)
+                self._close()
+
+
+class PollScheduler:
+    """
+    Decides what to ask the radio for and when.
+    With auto-info (AI2) the K3 pushes FA/BN/MD changes itself, so only the P3 settings
+    (#REF/#SCL) need polling plus a slow resync of the pushed state. Queries go out as one
+    batch, faster while the user is working the controls and slower when idle.
+    Without auto-info it falls back to polling FA every MY_POLL_TIME.
+    """
+    ACTIVE_TIME = 0.25  # s between batches while the user is interacting
+    IDLE_TIME = 2.0     # s between batches when idle
+    RESYNC_TIME = 10.0  # s between re-reads of the state the radio pushes
+    ACTIVE_FOR = 3.0    # s after the last user command that still counts as interacting
+
+    def __init__(self, send):
+        self.send = send
+        self.auto_info = False
+        self.bytes_polled = 0
+        self.started = time.monotonic()
+        self._last_activity = 0.0
+        self._last_batch = 0.0
+        self._last_resync = 0.0
+        self._last_fa = 0.0
+        self._last_tb = 0.0
+        self.tb_interval = None     # s between TB polls for the text readout, None = off
+
+    def touch(self):
+        self._last_activity = time.monotonic()
+
+    def connected(self):
+        # auto-info is lost with the connection -- ask for it again and confirm. The span isn't
+        # polled, and start()'s #SPN may have gone to a port that wasn't up, so read it here too
+        self.auto_info = False
+        self._last_resync = 0.0
+        self.send(b"AI2;AI;#SPN;", PRIORITY_POLL)
+
+    def on_ai_reply(self, value):
+        self.auto_info = value.strip() in ("1", "2", "3")
+
+    def _poll(self, data):
+        self.send(data, PRIORITY_POLL)
+        self.bytes_polled += len(data)
+        log.debug("Sent: %s", data)
+
+    def tick(self):
+        now = time.monotonic()
+        active = now - self._last_activity < self.ACTIVE_FOR
+        interval = self.ACTIVE_TIME if active else self.IDLE_TIME
+        batch = b""
+        if now - self._last_batch >= interval:
+            self._last_batch = now
+            batch = b"#REF;#SCL;"
+            if not self.auto_info or now - self._last_resync >= self.RESYNC_TIME:
+                self._last_resync = now
+                self._last_fa = now
+                batch = b"FA;BN;MD;" + batch + (b"" if self.auto_info else b"AI;")
+        elif not self.auto_info and now - self._last_fa >= MY_POLL_TIME / 1000:
+            self._last_fa = now
+            batch = b"FA;"
+        if self.tb_interval is not None and now - self._last_tb >= self.tb_interval:
+            # rides at the end of whatever else is due, so the status replies come back first
+            self._last_tb = now
+            batch += b"TB;"
+        if batch:
+            self._poll(batch)
+
+    def bandwidth(self):
+        return self.bytes_polled / max(time.monotonic() - self.started, 1e-3)
+
+
+class TextReadout:
+    """
+    Decoded CW/data text from TB replies, in a fixed-size ring buffer.
+    feed() appends the text of one reply; a reader keeps its position and since() hands it
+    everything newer as one string -- text older than the buffer is gone. The recent
+    characters/s decide how often TB is worth asking for: about BATCH characters a poll,
+    between MIN_TIME and MAX_TIME apart (the K3 holds 40).
+    """
+    BATCH = 5           # characters a TB poll should find
+    MIN_TIME = 0.25     # s between TB polls, fastest ...
+    MAX_TIME = 2.0      # ... and slowest
+    RATE_TAU = 5.0      # s the decode speed is smoothed over
+    K3_BUFFER = 40
+
+    def __init__(self, size=READOUT_CHARS):
+        self.size = size
+        self.total = 0          # characters ever fed
+        self.rate = 0.0         # characters/s, smoothed
+        self.overflows = 0      # replies with a full K3 buffer -- text may have been lost
+        self._buffer = bytearray(size)
+        self._last = None
+
+    def feed(self, text, now=None):
+        now = time.monotonic() if now is None else now
+        data = text.encode("ascii", "replace")
+        if self._last is not None and now > self._last:
+            dt = now - self._last
+            alpha = 1.0 - math.exp(-dt / self.RATE_TAU)
+            self.rate += alpha * (len(data) / dt - self.rate)
+        self._last = now
+        if len(data) >= self.K3_BUFFER:
+            self.overflows += 1
+        if not data:
+            return
+        keep = data[-self.size:]
+        start = (self.total + len(data) - len(keep)) % self.size
+        first = min(len(keep), self.size - start)
+        self._buffer[start:start + first] = keep[:first]
+        self._buffer[:len(keep) - first] = keep[first:]
+        self.total += len(data)
+
+    def since(self, position):
+        """(text, new position) for everything fed after position."""
+        position = max(position, self.total - self.size)
+        if position >= self.total:
+            return "", self.total
+        start, end = position % self.size, self.total % self.size
+        if start < end:
+            data = self._buffer[start:end]
+        else:
+            data = self._buffer[start:] + self._buffer[:end]
+        return data.decode("ascii"), self.total
+
+    def poll_interval(self):
+        return min(self.MAX_TIME, max(self.MIN_TIME, self.BATCH / self.rate)) if self.rate > 0 else self.MAX_TIME
+
+
+class CatFramer:
+    """
+    Splits the K3 reply stream into complete ';' terminated frames.
+    A partial reply at the end of a read is held until the rest of it arrives.
+    """
+    MAX_TAIL = 1024     # garbage without a ';' never grows the buffer past this
+
+    def __init__(self):
+        self._tail = bytearray()
+
+    def feed(self, data):
+        self._tail += data
+        end = self._tail.rfind(b";")
+        if end < 0:
+            if len(self._tail) > self.MAX_TAIL:
+                self._tail.clear()
+            return []
+        frames = bytes(self._tail[:end]).split(b";")
+        del self._tail[:end + 1]
+        return [f for f in frames if f]
+
+
+def cat_key(frame):
+    """
+    Handler table key for a reply: '#XXX' for P3 commands, two letters for K3 commands.
+    """
+    return frame[:4] if frame.startswith(b"#") else frame[:2]
+
+
+class RigState:
+    """
+    What the app believes the radio is set to: freq, band, mode, span (Hz), marker, ref and scl.
+    expect() applies a command's effect at once, so the next click or wheel step builds on it
+    rather than on the last poll. confirm() takes the radio's reply: a match settles the
+    expectation, a different value is taken as an older reply while the expectation is fresh
+    and as a refusal once it is stale -- then the radio's value wins (a rollback).
+    Unknown values are None. on_change(field, value) runs whenever a shown value changes.
+    """
+    FIELDS = ("freq", "band", "mode", "span", "marker", "ref", "scl")
+    SETTLE_TIME = 1.0   # s an expected value waits for the radio to agree
+
+    def __init__(self, on_change=None, **values):
+        self.confirmed = dict.fromkeys(self.FIELDS)
+        self.confirmed.update(values)
+        self.pending = {}       # field -> (expected value, deadline)
+        self.on_change = on_change
+        self.rollbacks = 0
+
+    def __getattr__(self, name):
+        if name in RigState.FIELDS:
+            return self.get(name)
+        raise AttributeError(name)
+
+    def get(self, field):
+        pending = self.pending.get(field)
+        return pending[0] if pending else self.confirmed[field]
+
+    def ready(self, field):
+        """True once the radio has reported the field."""
+        return self.confirmed[field] is not None
+
+    def set(self, field, value):
+        """A value only the app knows (the active marker), nothing to reconcile."""
+        shown = self.get(field)
+        self.pending.pop(field, None)
+        self.confirmed[field] = value
+        self._changed(field, shown)
+
+    def forget(self, field):
+        """The value is no longer known (a band change moved the VFO); steps wait for the radio."""
+        self.set(field, None)
+
+    def expect(self, field, value):
+        shown = self.get(field)
+        self.pending[field] = (value, time.monotonic() + self.SETTLE_TIME)
+        self._changed(field, shown)
+
+    def adjust(self, field, delta):
+        """expect() relative to the shown value, for steps; does nothing while it is unknown."""
+        value = self.get(field)
+        if value is not None:
+            self.expect(field, value + delta)
+
+    def confirm(self, field, value):
+        shown = self.get(field)
+        self.confirmed[field] = value
+        pending = self.pending.get(field)
+        if pending:
+            expected, deadline = pending
+            if value == expected:
+                del self.pending[field]
+            elif time.monotonic() >= deadline:
+                self._rollback(field, expected, value)
+        self._changed(field, shown)
+
+    def expire(self):
+        """Rolls back expectations the radio never answered."""
+        now = time.monotonic()
+        for field, (expected, deadline) in list(self.pending.items()):
+            if now >= deadline:
+                self._rollback(field, expected, self.confirmed[field])
+                self._changed(field, expected)
+
+    def _rollback(self, field, expected, value):
+        del self.pending[field]
+        self.rollbacks += 1
+        log.info("Rig %s: expected %s, radio has %s", field, expected, value)
+
+    def _changed(self, field, shown):
+        value = self.get(field)
+        if value != shown and self.on_change is not None:
+            self.on_change(field, value)
+
+
+class TuningEngine:
+    """
+    Turns wheel spins and slider drags into as few serial writes as possible.
+    Every notch moves the rig state at once, with bigger steps the faster the wheel
+    turns, and tick() sends wherever it ended up as one absolute FA. Sliders are
+    latest-value-wins, each written at most every SLIDER_TIME. When a spin stops the
+    radio is asked for FA once, which confirms (or rolls back) the expected frequency.
+    """
+    SPIN_WINDOW = 0.3       # s of notches the spin speed is measured over
+    ACCEL_START = 10.0      # notches/s before the step grows
+    ACCEL_MAX = 10          # largest step, in WHEEL_STEPs
+    SLIDER_TIME = 0.1       # s between writes of one slider
+    SLIDERS = {"scl": "#SCL", "ref": "#REF"}
+
+    def __init__(self, rig, send):
+        self.rig = rig
+        self.send = send
+        self.inputs = 0         # notches and slider moves handed in
+        self.writes = 0
+        self.bytes_sent = 0
+        self._notches = collections.deque()
+        self._dirty = set()     # fields changed since they were last written
+        self._written = {}      # slider field -> when it was last written
+        self._confirm = False
+
+    def step(self, now):
+        # notches/s over the last SPIN_WINDOW, 1x up to ACCEL_START and linear above it
+        notches = self._notches
+        notches.append(now)
+        while now - notches[0] > self.SPIN_WINDOW:
+            notches.popleft()
+        rate = len(notches) / self.SPIN_WINDOW
+        return WHEEL_STEP * min(self.ACCEL_MAX, max(1, int(rate / self.ACCEL_START)))
+
+    def wheel(self, notches):
+        self.inputs += 1
+        self.rig.adjust("freq", notches * self.step(time.monotonic()))
+        self._dirty.add("freq")
+
+    def slider(self, field, value):
+        if not self.rig.ready(field) or value == self.rig.get(field):
+            return      # not reported by the P3 yet, or the slider just followed a reply
+        self.inputs += 1
+        self.rig.expect(field, value)
+        self._dirty.add(field)
+
+    def tick(self):
+        now = time.monotonic()
+        data = b""
+        if "freq" in self._dirty:
+            self._dirty.discard("freq")
+            if self.rig.freq is not None:
+                data += f"FA{self.rig.freq:011d};".encode()
+                self._confirm = True
+        elif self._confirm:
+            self._confirm = False
+            data += b"FA;"
+        for field, command in self.SLIDERS.items():
+            if field in self._dirty and now - self._written.get(field, 0.0) >= self.SLIDER_TIME:
+                self._dirty.discard(field)
+                self._written[field] = now
+                data += f"{command}{self.rig.get(field):03d};".encode()
+        if data:
+            self.writes += 1
+            self.bytes_sent += len(data)
+            log.debug("Sending %s", data)
+            self.send(data)
+
+
+BANDS = {"160 M": 0, "80 M": 1, "60 M": 2, "40 M": 3, "30 M": 4, "20 M": 5,
+         "17 M": 6, "15 M": 7, "12 M": 8, "10 M": 9, "6 M": 10}
+MODES = {"LSB": 1, "USB": 2, "CW": 3, "FM": 4, "AM": 5}
+SPANS = {"2K": 20, "10K": 100, "50K": 500, "100K": 1000, "200K": 2000}     # button label -> #SPN count
+
+
+class K3Rig:
+    """
+    Everything the app does with the radio, minus the window: the serial worker, the
+    poll scheduler, rig state, tuning engine and the reply handlers. Whoever owns it calls
+    pump() every SERIAL_PUMP_TIME and tick() every POLL_TICK from one thread -- the Tk
+    loop in the app, a plain loop in k3_service.py. on_change(field, value) follows the
+    rig state. The actions take the same labels as the buttons.
+    """
+    def __init__(self, port, rate, on_change=None):
+        self.rig = RigState(on_change, marker="N")
+        self.tuner = TuningEngine(self.rig, self.send_user)
+        self.rx_queue = queue.SimpleQueue()
+        self.k3 = SerialWorker(port, rate, self.rx_queue.put)
+        self.poller = PollScheduler(self.k3.send)
+        self.k3.on_connect = self.poller.connected
+        self.framer = CatFramer()
+        self.handlers = {
+            b"FA": self.on_fa_reply,
+            b"BN": self.on_bn_reply,
+            b"MD": self.on_md_reply,
+            b"#SCL": self.on_scl_reply,
+            b"#REF": self.on_ref_reply,
+            b"#SPN": self.on_spn_reply,
+            b"IF": self.on_if_reply,
+            b"AI": self.poller.on_ai_reply,
+        }
+        self.rigctld = None
+        self.readout = None
+        self.markers = {}       # "A"/"B" -> Hz, where the clicks put the markers that are on
+
+    def start(self):
+        self.k3.start()
+        self.rig.expect("span", SPANS["100K"] * SPAN_UNIT)
+        self.k3.send(b"#SPN001000;#SPN;#SCL;#REF;")
+        return self
+
+    def stop(self):
+        self.k3.stop()
+        if self.rigctld:
+            self.rigctld.stop()
+        log.info("Serial: %d bytes out, %d bytes in, polling %.1f bytes/s, auto-info %s",
+                 self.k3.bytes_out, self.k3.bytes_in, self.poller.bandwidth(), "on" if self.poller.auto_info else "off")
+        log.info("Tuning: %d wheel/slider inputs sent as %d writes (%d bytes), %d rig state rollbacks",
+                 self.tuner.inputs, self.tuner.writes, self.tuner.bytes_sent, self.rig.rollbacks)
+
+    def start_rigctld(self, host, port):
+        from rigctld import RigCache, RigctlServer
+
+        self.rig_cache = RigCache()
+        self.rig_framer = CatFramer()
+        self.k3.listeners.append(self.feed_rig_cache)
+        self.rigctld = RigctlServer(self.k3.send, self.rig_cache, host, port).start()
+
+    def feed_rig_cache(self, direction, data):
+        # serial worker thread -- keeps the rigctld cache current without waiting for the owner's loop
+        if direction == "in":
+            for frame in self.rig_framer.feed(data):
+                self.rig_cache.on_reply(frame)
+
+    def pump(self):
+        """Hands everything the serial worker has read to the reply handlers."""
+        while True:
+            try:
+                data = self.rx_queue.get_nowait()
+            except queue.Empty:
+                break
+            for frame in self.framer.feed(data):
+                self.dispatch(frame)
+
+    def start_readout(self, size=READOUT_CHARS):
+        """Polls TB for the text the K3 decodes (CW, DATA) into readout."""
+        self.readout = TextReadout(size)
+        self.handlers[b"TB"] = self.on_tb_reply
+        return self.readout
+
+    def tick(self):
+        """Whatever is due: coalesced tuning writes, status polls, stale expectations."""
+        self.tuner.tick()
+        if self.readout is not None:
+            mode = self.rig.mode
+            self.poller.tb_interval = self.readout.poll_interval() if mode is None or mode in TB_MODES else None
+        self.poller.tick()
+        self.rig.expire()
+
+    def send_user(self, data):
+        self.poller.touch()
+        self.k3.send(data, PRIORITY_USER)
+
+    def dispatch(self, frame):
+        key = cat_key(frame)
+        if metrics.enabled:
+            metrics.count("cat_replies")
+            sent = self.k3.query_sent.pop(key, None)
+            if sent is not None:
+                metrics.observe("serial_round_trip", time.perf_counter() - sent)
+        handler = self.handlers.get(key)
+        if handler:
+            handler(frame[len(key):].decode("ascii", "replace"))
+
+    # actions
+
+    def tune(self, freq):
+        """A click: moves VFO A, or marker A or B when one is active."""
+        if self.rig.marker == "A":
+            formatted = f"#MFA 000{freq:08d};"
+            self.markers["A"] = freq
+        elif self.rig.marker == "B":
+            formatted = f"#MFB 000{freq:08d};"
+            self.markers["B"] = freq
+        else:
+            # the next click or wheel step builds on this, not on the last reply
+            self.rig.expect("freq", freq)
+            formatted = f"FA000{freq:08d};"
+
+        log.debug("Sending %s", formatted)
+        self.send_user(formatted.encode())
+        self.send_user(b"FA;")  # Trigger display update
+
+    def span_action(self, label):
+        span = SPANS.get(label)
+        if span is None:
+            log.warning("Unknown label: %s", label)
+            return
+        self.rig.expect("span", span * SPAN_UNIT)
+        self.send_user(f"#SPN{span:06d};#SPN;".encode())
+
+    def marker_action(self, label):
+        match label:
+            case "MKR A":
+                log.debug("Marker A action triggered")
+                self.send_user(b"#MKA1;#MKB0;")
+                self.rig.set("marker", "A")
+                self.markers.pop("B", None)
+            case "MKR B":
+                log.debug("Marker B action triggered")
+                self.send_user(b"#MKA0;#MKB1;")
+                self.rig.set("marker", "B")
+                self.markers.pop("A", None)
+            case "QSY":
+                log.debug("QSY action triggered")
+                self.send_user(b"#QSY1;")
+            case "OFF":
+                log.debug("Markers OFF action triggered")
+                self.send_user(b"#MKA0;#MKB0;#QSY0;")
+                self.rig.set("marker", "N")
+                self.markers.clear()
+            case _:
+                log.warning("Unknown marker button: %s", label)
+
+    def vfo_action(self, label):
+        match label:
+            case "A/B":
+                log.debug("VFO A/B action triggered")
+                self.send_user(b"SWT11;")
+            case "SUB":
+                log.debug("VFO REV action triggered")
+                self.send_user(b"SWT48;")
+            case "A>B":
+                log.debug("VFO A=B action triggered")
+                self.send_user(b"SWT13;")
+            case "SPLIT":
+                log.debug("SPLIT action triggered")
+                self.send_user(b"SWH13;")
+            case _:
+                log.warning("Unknown VFO button: %s", label)
+
+    def set_band(self, band_id):
+        self.rig.expect("band", band_id)
+        self.rig.forget("freq")     # the K3 lands on the band's last frequency
+        formatted = f"BN{band_id:02d};BN;FA;"
+        log.debug("Sending %s", formatted)
+        self.send_user(formatted.encode())
+
+    def set_mode(self, mode_code):
+        self.rig.expect("mode", mode_code)
+        self.send_user(f"MD{mode_code};MD;".encode())
+
+    # replies
+
+    def on_fa_reply(self, number_str):
+        try:
+            freq = int(number_str)
+            log.debug("FREQ: %s", freq)
+            self.rig.confirm("freq", freq)
+        except ValueError:
+            log.warning("Ignored bad Freq: %r", number_str)
+
+    def on_tb_reply(self, body):
+        text = extract_tb_data(f"TB{body};")
+        if text is None:
+            log.warning("Ignored bad TB data: %r", body)
+            return
+        self.readout.feed(text)
+
+    def on_if_reply(self, body):
+        # auto-info status: frequency is the first 11 digits, mode sits at offset 27
+        self.on_fa_reply(body[0:11])
+        if len(body) > 27:
+            self.on_md_reply(body[27])
+
+    def on_bn_reply(self, number_str):
+        try:
+            bandid = int(number_str)
+            log.debug("BAND: %s", bandid)
+            self.rig.confirm("band", bandid)
+        except ValueError:
+            log.warning("Ignored bad band data: %r", number_str)
+
+    def on_md_reply(self, number_str):
+        try:
+            mode_id = int(number_str)
+            log.debug("MODE: %s", mode_id)
+            self.rig.confirm("mode", mode_id)
+        except ValueError:
+            log.warning("Ignored bad mode data: %r", number_str)
+
+    def on_scl_reply(self, number_str):
+        try:
+            sclval = int(number_str)
+            log.debug("SCALE: %s", sclval)
+            self.rig.confirm("scl", sclval)     # the app's left slider follows through on_change
+        except ValueError:
+            log.warning("Ignored bad scale data: %r", number_str)
+
+    def on_ref_reply(self, number_str):
+        try:
+            refval = int(number_str)
+            log.debug("REF: %s", refval)
+            self.rig.confirm("ref", refval)
+        except ValueError:
+            log.warning("Ignored bad ref data: %r", number_str)
+
+    def on_spn_reply(self, number_str):
+        try:
+            span = int(number_str)
+            log.debug("SPAN: %s", span)
+            self.rig.confirm("span", span * SPAN_UNIT)
+        except ValueError:
+            log.warning("Ignored bad span data: %r", number_str)
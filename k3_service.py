@@ -0,0 +1,89 @@
+##
+##    Headless K3 service for the P3 interface
+##    Runs the radio side of the app -- serial worker, polling, rig state, tuning
+##    engine -- without a window, OpenCV or a display, e.g. on a small shack server.
+##    The local JSON control API (control.py) gives other programs the same actions as
+##    the buttons; the rigctld server can run alongside it.
+##
+##    python k3_service.py --port /dev/ttyUSB0                 (control API on 127.0.0.1:4533)
+##    curl localhost:4533/state
+##    curl -d '{"hz": 14074000}' localhost:4533/freq
+##    curl -d '{"label": "10K"}' localhost:4533/span
+##
+
+import argparse
+import logging
+import signal
+import threading
+import time
+
+from k3_rig import K3Rig, POLL_TICK, SERIAL_PUMP_TIME, config, save_config
+
+log = logging.getLogger("K3_P3.service")
+
+
+def run(radio, control=None, stop=None, duration=None):
+    """
+    The headless counterpart of the Tk after() loops: pump replies every SERIAL_PUMP_TIME,
+    tick every POLL_TICK, and in between sleep on the control queue so a command is applied
+    as soon as it arrives.
+    """
+    stop = stop or threading.Event()
+    started = time.monotonic()
+    next_pump = next_tick = started
+    while not stop.is_set() and (duration is None or time.monotonic() - started < duration):
+        now = time.monotonic()
+        if now >= next_pump:
+            radio.pump()
+            next_pump = now + SERIAL_PUMP_TIME / 1000
+        if now >= next_tick:
+            radio.tick()
+            next_tick = now + POLL_TICK / 1000
+        wait = max(0.0, min(next_pump, next_tick) - time.monotonic())
+        if control is not None:
+            control.run_pending(wait)
+        else:
+            stop.wait(wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="K3 control without the P3 window")
+    parser.add_argument("--port", default=config.get("comm_port", "COM4"), help="K3 serial port")
+    parser.add_argument("--rate", default=config.get("comm_rate", "38400"))
+    parser.add_argument("--control-host", default=config.get("control_host", "127.0.0.1"))
+    parser.add_argument("--control-port", type=int, default=config.get("control_port", 4533),
+                        help="0 turns the control API off")
+    parser.add_argument("--rigctld-port", type=int, default=config.get("rigctld_port", 0),
+                        help="also serve rigctld on this port")
+    parser.add_argument("--save", action="store_true", help="keep --port and --rate in config.json")
+    parser.add_argument("--log-level", default=config.get("log_level", "INFO"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, filename=config.get("log_file"),
+                        format="%(asctime)s %(levelname)s %(message)s")
+    if args.save:
+        config["comm_port"], config["comm_rate"] = args.port, args.rate
+        save_config(config)
+    radio = K3Rig(args.port, args.rate,
+                  lambda field, value: log.info("%s %s", field, value))
+    if args.rigctld_port:
+        radio.start_rigctld(config.get("rigctld_host", "127.0.0.1"), args.rigctld_port)
+    radio.start()
+    control = None
+    if args.control_port:
+        from control import ControlServer
+        control = ControlServer(radio, args.control_host, args.control_port).start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        run(radio, control, stop)
+    except KeyboardInterrupt:
+        pass
+    if control is not None:
+        control.stop()
+    radio.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+##
+##    Readout overlay for the P3 interface
+##    Draws a frequency grid, level lines, the marker A/B positions and the frequency under
+##    the mouse pointer over the video. Everything but the pointer is a static layer: drawn
+##    once, at the label size, and only drawn again when the VFO, span, ref, scale, markers
+##    or window size change. It's kept as the few pixels it covers (index, colour * alpha,
+##    256 - alpha), so putting it on a frame is one gather/blend/scatter over those pixels
+##    rather than a blend of the whole picture. The pointer readout is a column and a small
+##    cached text patch on top of that.
+##
+##    "overlay": true in config.json
+##    python overlay.py                                       (rebuild and per-frame cost)
+##    python overlay.py --size 1280x720 --frames 500
+##
+
+import logging
+import time
+
+import cv2
+import numpy as np
+
+log = logging.getLogger("K3_P3.overlay")
+
+GRID_LINES = 8              # about this many frequency grid lines across the picture
+GRID_STEPS = (1, 2, 2.5, 5)
+LEVEL_STEP = 10             # dB between level lines, 5 when the scale is under 30 dB
+GRID_RGBA = (150, 150, 150, 70)
+LABEL_RGBA = (220, 220, 220, 210)
+MARKER_RGBA = {"A": (255, 200, 0, 170), "B": (0, 200, 255, 170)}
+HOVER_RGBA = (255, 255, 255, 120)
+HOVER_TEXT_RGBA = (255, 255, 255, 255)
+HOVER_BACK_RGBA = (0, 0, 0, 170)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def grid_step(span, lines=GRID_LINES):
+    """A round step in Hz (1, 2, 2.5 or 5 times a power of ten) giving at most lines lines across span."""
+    scale = 10 ** max(0, int(np.floor(np.log10(max(1, span / lines)))))
+    while True:
+        for step in GRID_STEPS:
+            if span / (step * scale) <= lines:
+                return int(step * scale)
+        scale *= 10
+
+
+def freq_label(freq, step):
+    # kHz, with the decimals the grid step needs
+    return f"{freq / 1000:.0f}" if step % 1000 == 0 else f"{freq / 1000:.1f}" if step % 100 == 0 else f"{freq / 1000:.2f}"
+
+
+def _alpha(a):
+    # 0..255 to 0..256, so a full alpha replaces the pixel outright
+    return a.astype(np.uint16) + (a >> 7)
+
+
+class _Layer:
+    """
+    The covered pixels of an RGB(A) picture as flat indices into an h x w x 3 array,
+    with colour * alpha and 256 - alpha per channel, plus the buffers blend() works in.
+    """
+    def __init__(self, rgb, alpha, row_size):
+        covered = np.flatnonzero(alpha.ravel() != 0)     # several times faster than on the uint8 values
+        a = _alpha(alpha.ravel()[covered])
+        self.idx = (covered[:, None] * 3 + np.arange(3)).ravel()
+        self.premul = (rgb.reshape(-1, 3)[covered].astype(np.uint16) * a[:, None]).ravel()
+        self.inv = np.repeat(256 - a, 3)
+        self.row_size = row_size
+        self._px = np.empty(len(self.idx), np.uint8)
+        self._acc = np.empty(len(self.idx), np.uint16)
+
+    def __len__(self):
+        return len(self.idx) // 3
+
+    def blend(self, flat, y0=0, y1=None):
+        """Blends the layer into flat (a raveled h x w x 3 picture), rows y0..y1 only."""
+        end = flat.size if y1 is None else y1 * self.row_size
+        a, b = np.searchsorted(self.idx, (y0 * self.row_size, end))
+        if a >= b:
+            return
+        idx, px, acc = self.idx[a:b], self._px[a:b], self._acc[a:b]
+        np.take(flat, idx, out=px)
+        np.multiply(px, self.inv[a:b], out=acc)
+        acc += self.premul[a:b]
+        acc >>= 8
+        flat[idx] = acc
+
+
+class Overlay:
+    """
+    The readout layers for one label. The owner calls set_view() and set_hover() with
+    what it knows (both cheap when nothing changed), prepare() at the label size before
+    drawing, and composite() on each RGB frame. version changes whenever the result would
+    look different, so a display that skips unchanged frames knows to draw anyway; when
+    view_version hasn't changed with it only the pointer moved, and only pointer_rows() need it.
+    region is the spectrum part of the picture (x0, y0, x1, y1 fractions); the grid, level
+    lines and pointer readout stay inside it, marker lines run down through the waterfall too.
+    The P3's ref level is the bottom of the spectrum and its scale the dB range above that.
+    """
+    def __init__(self, region):
+        self.region = region
+        self.version = 0
+        self.view_version = 0
+        self.rebuilds = 0
+        self.rebuild_time = 0.0
+        self.frames = 0
+        self.busy_time = 0.0
+        self._view = None
+        self._hover = None
+        self._key = None
+        self._layer = None
+        self._hover_key = None
+        self._patch = None
+        self._canvas = None
+
+    def set_view(self, freq, span, ref=None, scl=None, markers=None):
+        view = (freq, span, ref, scl, tuple(sorted((markers or {}).items())))
+        if view != self._view:
+            self._view = view
+            self.version += 1
+            self.view_version += 1
+
+    def set_hover(self, x, text=None):
+        """The pointer readout at label column x, or none with x None."""
+        hover = None if x is None else (int(x), text)
+        if hover != self._hover:
+            self._hover = hover
+            self.version += 1
+
+    def x_of(self, freq, w):
+        # the inverse of the app's click_freq: the picture is centred on the VFO and span Hz wide
+        vfo, span = self._view[:2]
+        return int(round(w / 2 + (freq - vfo) * w / span))
+
+    def _rows(self, h):
+        return int(self.region[1] * h), int(self.region[3] * h)
+
+    def pointer_rows(self, h):
+        """The rows of an h row picture the pointer readout can cover."""
+        return int(self.region[1] * h), min(h, int(np.ceil(self.region[3] * h)))
+
+    def prepare(self, w, h):
+        """Draws the static layer again if the view or size changed since the last time."""
+        if self._view is None or not self._view[0] or not self._view[1]:
+            self._layer = None
+            return
+        key = (self._view, w, h)
+        if key == self._key:
+            return
+        started = time.perf_counter()
+        self._key = key
+        if self._canvas is None or self._canvas[0].shape[:2] != (h, w):
+            self._canvas = np.zeros((h, w, 3), np.uint8), np.zeros((h, w), np.uint8)
+        rgb, alpha = self._canvas
+        rgb.fill(0)
+        alpha.fill(0)
+        self._draw_static(rgb, alpha, w, h)
+        self._layer = _Layer(rgb, alpha, w * 3)
+        self.rebuilds += 1
+        self.rebuild_time += time.perf_counter() - started
+
+    def _draw_static(self, rgb, alpha, w, h):
+        freq, span, ref, scl, markers = self._view
+        top, bottom = self._rows(h)
+
+        def line(p0, p1, rgba):
+            cv2.line(rgb, p0, p1, rgba[:3], 1)
+            cv2.line(alpha, p0, p1, rgba[3], 1)
+
+        def text(s, org, rgba, scale=0.4):
+            cv2.putText(rgb, s, org, FONT, scale, rgba[:3], 1, cv2.LINE_AA)
+            cv2.putText(alpha, s, org, FONT, scale, rgba[3], 1, cv2.LINE_AA)
+
+        step = grid_step(span)
+        low = freq - span // 2
+        for f in range(-(-low // step) * step, freq + span // 2 + 1, step):
+            x = min(w - 1, self.x_of(f, w))
+            line((x, top), (x, bottom - 1), GRID_RGBA)
+            text(freq_label(f, step), (min(max(0, x + 3), w - 50), bottom - 4), LABEL_RGBA)
+        if scl:
+            # level lines from the ref level at the bottom up through the scale
+            level_step = LEVEL_STEP if scl >= 30 else LEVEL_STEP // 2
+            for db in range(level_step, scl, level_step):
+                y = bottom - 1 - int(db * (bottom - top) / scl)
+                line((0, y), (w - 1, y), GRID_RGBA)
+                if ref is not None:
+                    text(f"{ref + db}", (2, y - 2), LABEL_RGBA)
+        for name, f in markers:
+            x = self.x_of(f, w)
+            if 0 <= x < w:
+                line((x, top), (x, h - 1), MARKER_RGBA.get(name, LABEL_RGBA))
+                text(name, (min(x + 3, w - 12), top + 12), MARKER_RGBA.get(name, LABEL_RGBA), 0.45)
+
+    def _hover_patch(self, text):
+        # small enough to blend whole: colour * alpha and 256 - alpha as h x w arrays
+        if self._hover_key != text:
+            self._hover_key = text
+            (tw, th), base = cv2.getTextSize(text, FONT, 0.45, 1)
+            rgb = np.zeros((th + base + 4, tw + 6, 3), np.uint8)
+            rgb[:] = HOVER_BACK_RGBA[:3]
+            mask = np.zeros(rgb.shape[:2], np.uint8)
+            cv2.putText(rgb, text, (3, th + 2), FONT, 0.45, HOVER_TEXT_RGBA[:3], 1, cv2.LINE_AA)
+            cv2.putText(mask, text, (3, th + 2), FONT, 0.45, 255, 1, cv2.LINE_AA)
+            alpha = np.maximum(HOVER_BACK_RGBA[3], mask.astype(np.uint16) * HOVER_TEXT_RGBA[3] // 255).astype(np.uint8)
+            a = _alpha(alpha)[..., None]
+            self._patch = rgb.astype(np.uint16) * a, 256 - a
+        return self._patch
+
+    def composite(self, rgb, y0=0, y1=None):
+        """Blends the overlay into rows y0..y1 of an h x w x 3 RGB picture in place; returns it."""
+        started = time.perf_counter()
+        h, w = rgb.shape[:2]
+        self.prepare(w, h)
+        y1 = h if y1 is None else y1
+        if self._layer is not None:
+            self._layer.blend(rgb.reshape(-1), y0, y1)
+        if self._hover is not None and 0 <= self._hover[0] < w:
+            x, text = self._hover
+            top, bottom = self._rows(h)
+            col = rgb[max(y0, top):min(y1, bottom), x]
+            if len(col):
+                col[:] = (col * np.uint16(256 - HOVER_RGBA[3]) + np.uint16(HOVER_RGBA[3]) * np.array(HOVER_RGBA[:3], np.uint16)) >> 8
+            if text:
+                premul, inv = self._hover_patch(text)
+                ph, pw = inv.shape[:2]
+                px = x + 6 if x + 6 + pw <= w else max(0, x - 6 - pw)
+                py = max(0, min(top + 2, bottom - ph))
+                a, b = max(y0, py), min(y1, py + ph)
+                if a < b:
+                    window = rgb[a:b, px:px + pw]
+                    window[:] = (window * inv[a - py:b - py] + premul[a - py:b - py]) >> 8
+        self.frames += 1
+        self.busy_time += time.perf_counter() - started
+        return rgb
+
+
+def naive_composite(rgb, layer_rgba):
+    """The whole-picture alpha blend the cached layer replaces, for comparison."""
+    a = layer_rgba[..., 3:].astype(np.uint16)
+    rgb[:] = (rgb * (256 - a) + layer_rgba[..., :3] * a) >> 8
+    return rgb
+
+
+def main():
+    import argparse
+    from k3_emulator import SyntheticP3Capture, P3_SPECTRUM_REGION
+
+    parser = argparse.ArgumentParser(description="Readout overlay cost")
+    parser.add_argument("--size", default="1920x1080", help="label size the overlay is drawn at")
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+    w, h = (int(v) for v in args.size.split("x"))
+
+    synth = SyntheticP3Capture(w, h, fps=0)
+    frames = [cv2.cvtColor(synth.read()[1], cv2.COLOR_BGR2RGB) for _ in range(8)]
+    overlay = Overlay(P3_SPECTRUM_REGION)
+    overlay.set_view(14074000, 200000, -130, 50, {"A": 14070000, "B": 14090000})
+
+    # static layer: drawn again on every retune (wheel steps), so its cost matters too
+    for i in range(50):
+        overlay.set_view(14074000 + i * 50, 200000, -130, 50, {"A": 14070000})
+        overlay.prepare(w, h)
+    rebuild = overlay.rebuild_time / overlay.rebuilds
+    print(f"{w}x{h}: static layer {rebuild * 1000:.2f} ms to draw, covers {len(overlay._layer)} pixels "
+          f"({len(overlay._layer) / (w * h) * 100:.1f}%)")
+
+    # per frame, the pointer moving every frame (a new readout text each time)
+    overlay.frames, overlay.busy_time = 0, 0.0
+    rgb = np.empty_like(frames[0])
+    for i in range(args.frames):
+        np.copyto(rgb, frames[i % len(frames)])
+        x = (i * 7) % w
+        overlay.set_hover(x, f"{(14074000 + (x - w / 2) * 200000 / w) / 1000:.2f} kHz")
+        overlay.composite(rgb)
+    per_frame = overlay.busy_time / overlay.frames
+    print(f"composite, pointer moving: {per_frame * 1000:.3f} ms a frame")
+
+    # a changed band of rows only, as the display's partial redraw does
+    band = h // 8
+    started = time.perf_counter()
+    for i in range(args.frames):
+        overlay.composite(rgb, (i % 8) * band, (i % 8 + 1) * band)
+    print(f"composite, 1/8 of the rows: {(time.perf_counter() - started) / args.frames * 1000:.3f} ms a frame")
+
+    # the same picture as a full-size RGBA layer blended every frame
+    layer = np.zeros((h, w, 4), np.uint8)
+    layer.reshape(-1, 4)[np.flatnonzero(overlay._canvas[1])] = np.concatenate(
+        [overlay._canvas[0].reshape(-1, 3), overlay._canvas[1].reshape(-1, 1)], axis=1)[np.flatnonzero(overlay._canvas[1])]
+    started = time.perf_counter()
+    count = max(10, args.frames // 10)
+    for i in range(count):
+        np.copyto(rgb, frames[i % len(frames)])
+        naive_composite(rgb, layer)
+    naive = (time.perf_counter() - started) / count
+    print(f"whole-picture RGBA blend: {naive * 1000:.2f} ms a frame -- {naive / per_frame:.0f}x the cached layer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+##
+##    P3 display over HTTP for remote operation
+##    Every captured frame is JPEG encoded once, on one worker thread, and the
+##    same bytes go to every viewer as an MJPEG stream. Each viewer has its own
+##    thread and always gets the newest frame, so a slow link only drops frames
+##    for itself. Clicks and wheel steps in the browser come back as small POSTs
+##    and go through the same frequency logic as the local window.
+##
+##    set "stream_port": 8080 in config.json to serve the app's video on this PC only;
+##    "stream_host": "0.0.0.0" opens it to the LAN, where viewers can only watch unless
+##    "stream_token" is set and they open http://this-pc:8080/?token=...
+##    python p3_stream.py --file capture.mp4                     (serve a video file, no radio)
+##    python p3_stream.py --file capture.mp4 --bench 8 --slow 2  (viewers on this machine, fps/encode report)
+##
+
+import hmac
+import ipaddress
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+
+log = logging.getLogger("K3_P3.stream")
+
+STREAM_PORT = 8080
+STREAM_QUALITY = 80
+STREAM_FPS = 20         # encode at most this many frames a second
+BOUNDARY = "p3frame"
+SEND_BUFFER = 128 * 1024    # per viewer -- a few frames; a bigger kernel buffer just queues seconds of lag
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Elecraft P3</title>
+<style>body{margin:0;background:#2e2e2e}img{width:100vw;height:100vh;object-fit:fill;cursor:crosshair}</style>
+</head><body><img id="p3" src="/stream">
+<script>
+const img = document.getElementById("p3");
+const token = new URLSearchParams(location.search).get("token") || "";
+const send = (path) => fetch(`${path}&token=${encodeURIComponent(token)}`, {method: "POST"});
+img.addEventListener("click", e =>
+  send(`/click?x=${e.offsetX / img.clientWidth}&y=${e.offsetY / img.clientHeight}`));
+img.addEventListener("wheel", e => { e.preventDefault(); send(`/wheel?delta=${e.deltaY < 0 ? 120 : -120}`); },
+  {passive: false});
+</script></body></html>
+"""
+
+
+class FrameEncoder:
+    """
+    Encodes the newest offered frame on its own thread, once, for all viewers.
+    Nothing is encoded while nobody is watching. Viewers call wait() with the sequence
+    number they last sent and get the newest JPEG, skipping any they were too slow for.
+    """
+    def __init__(self, quality=STREAM_QUALITY, max_fps=STREAM_FPS, width=None):
+        self.quality = quality
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self.width = width      # scale down to this width before encoding, None = as captured
+        self.viewers = 0
+        self.encoded = 0
+        self.encode_time = 0.0
+        self.jpeg_bytes = 0
+        self._pending = None
+        self._viewers_lock = threading.Lock()
+        self._offered = threading.Event()
+        self._published = threading.Condition()
+        self._jpeg = None
+        self._seq = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="stream-encoder", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._offered.set()
+        with self._published:
+            self._published.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def watch(self, change):
+        """+1 when a viewer starts, -1 when it goes away."""
+        with self._viewers_lock:
+            self.viewers += change
+
+    def offer(self, frame, stamp=None):
+        # capture thread -- only keeps a reference, the encoder picks up the newest one
+        if self.viewers:
+            self._pending = frame
+            self._offered.set()
+
+    def _run(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        next_due = 0.0
+        while self._running:
+            self._offered.wait(0.5)
+            self._offered.clear()
+            frame, self._pending = self._pending, None
+            if frame is None:
+                continue
+            delay = next_due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+                frame = self._pending if self._pending is not None else frame     # newest wins
+                self._pending = None
+            started = time.perf_counter()
+            if self.width and frame.shape[1] > self.width:
+                frame = cv2.resize(frame, (self.width, frame.shape[0] * self.width // frame.shape[1]),
+                                   interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode(".jpg", frame, params)
+            if not ok:
+                continue
+            jpeg = encoded.tobytes()
+            self.encode_time += time.perf_counter() - started
+            self.encoded += 1
+            self.jpeg_bytes += len(jpeg)
+            next_due = started + self.interval
+            with self._published:
+                self._jpeg = jpeg
+                self._seq += 1
+                self._published.notify_all()
+
+    def wait(self, last_seq, timeout=2.0):
+        """(seq, jpeg) of the newest frame after last_seq, or None on timeout / stop."""
+        with self._published:
+            self._published.wait_for(lambda: self._seq > last_seq or not self._running, timeout)
+            if self._seq > last_seq and self._running:
+                return self._seq, self._jpeg
+        return None
+
+    def stats(self):
+        return {"viewers": self.viewers, "frames_encoded": self.encoded,
+                "encode_ms": self.encode_time / self.encoded * 1000 if self.encoded else None,
+                "jpeg_kb": self.jpeg_bytes / self.encoded / 1024 if self.encoded else None}
+
+
+class StreamServer(ThreadingHTTPServer):
+    """
+    HTTP server for the stream page, /stream (MJPEG), /frame.jpg, /stats, and
+    POST /click?x=&y= (fractions of the picture) and /wheel?delta=.
+    Browser events are put on events as ("click", x, y) / ("wheel", delta) for the
+    UI thread to pick up. Only viewers on this machine may click and scroll -- or, with a
+    token, whoever sends it along (?token=); everyone else just watches.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, encoder, host="127.0.0.1", port=STREAM_PORT, token=None):
+        super().__init__((host, port), StreamHandler)
+        self.encoder = encoder
+        self.token = token
+        self.events = queue.SimpleQueue()
+        self.clients = {}       # id -> per-viewer counters
+        self._ids = iter(range(1, 1 << 30))
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stream-http", daemon=True)
+        self._thread.start()
+        log.info("Streaming the P3 display on http://%s:%d/", *self.server_address[:2])
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def may_control(self, address, token):
+        if self.token:
+            return hmac.compare_digest(token.encode(), self.token.encode())
+        return ipaddress.ip_address(address[0]).is_loopback
+
+    def add_client(self, address):
+        with self._lock:
+            client_id = next(self._ids)
+            self.clients[client_id] = {"address": f"{address[0]}:{address[1]}", "connected": time.time(),
+                                       "frames": 0, "skipped": 0, "bytes": 0, "last_seq": 0}
+        self.encoder.watch(+1)
+        return client_id
+
+    def remove_client(self, client_id):
+        with self._lock:
+            self.clients.pop(client_id, None)
+        self.encoder.watch(-1)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            viewers = [{**c, "fps": c["frames"] / max(1e-3, now - c["connected"])} for c in self.clients.values()]
+        return {"encoder": self.encoder.stats(), "clients": viewers}
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug("stream %s: " + format, self.address_string(), *args)
+
+    def _reply(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/":
+            self._reply(PAGE.encode(), "text/html; charset=utf-8")
+        elif path == "/stream":
+            self.stream()
+        elif path == "/frame.jpg":
+            self.server.encoder.watch(+1)       # make sure something gets encoded
+            try:
+                got = self.server.encoder.wait(0)
+            finally:
+                self.server.encoder.watch(-1)
+            if got:
+                self._reply(got[1], "image/jpeg")
+            else:
+                self._reply(b"no video", "text/plain", 503)
+        elif path == "/stats":
+            self._reply(json.dumps(self.server.stats(), indent=2).encode(), "application/json")
+        else:
+            self._reply(b"not found", "text/plain", 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if not self.server.may_control(self.client_address, query.get("token", "")):
+            self._reply(b"watch only", "text/plain", 403)
+            return
+        try:
+            if url.path == "/click":
+                x, y = float(query["x"]), float(query["y"])
+                if not (0 <= x <= 1 and 0 <= y <= 1):
+                    raise ValueError(x, y)
+                self.server.events.put(("click", x, y))
+            elif url.path == "/wheel":
+                self.server.events.put(("wheel", int(query["delta"])))
+            else:
+                self._reply(b"not found", "text/plain", 404)
+                return
+        except (KeyError, ValueError):
+            self._reply(b"bad request", "text/plain", 400)
+            return
+        self._reply(b"ok", "text/plain")
+
+    def stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        client_id = self.server.add_client(self.client_address)
+        counters = self.server.clients[client_id]
+        seq = 0
+        try:
+            while True:
+                got = self.server.encoder.wait(seq)
+                if got is None:
+                    if not self.server.encoder.running:
+                        break
+                    continue
+                new_seq, jpeg = got
+                if seq:
+                    counters["skipped"] += new_seq - seq - 1    # encoded while we were still sending
+                seq = new_seq
+                self.wfile.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                 f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b"\r\n")
+                counters["frames"] += 1
+                counters["bytes"] += len(jpeg)
+                counters["last_seq"] = seq
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.remove_client(client_id)
+            self.close_connection = True
+
+
+class FileSource:
+    """Plays a video file at its own frame rate, over and over, into a frame callback."""
+    def __init__(self, path, on_frame):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise RuntimeError(f"Could not open {path}")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.on_frame = on_frame
+        self.frames = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="file-source", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=1.0)
+        self.cap.release()
+
+    def _run(self):
+        due = time.perf_counter()
+        while self._running:
+            ret, frame = self.cap.read()
+            if not ret:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                continue
+            due += 1.0 / self.fps
+            time.sleep(max(0.0, due - time.perf_counter()))
+            self.frames += 1
+            self.on_frame(frame, time.perf_counter())
+
+
+def bench(port, viewers, slow, seconds):
+    """Local viewers reading /stream; the slow ones only manage ~40 kB/s, about one frame a second."""
+    def viewer(index):
+        with socket.socket() as sock:
+            if index < slow:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+            sock.connect(("127.0.0.1", port))
+            sock.sendall(b"GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            sock.settimeout(2.0)
+            end = time.time() + seconds
+            while time.time() < end:
+                try:
+                    if not sock.recv(4096 if index < slow else 1 << 16):
+                        break
+                except socket.timeout:
+                    continue
+                if index < slow:
+                    time.sleep(0.1)
+
+    threads = [threading.Thread(target=viewer, args=(i,), daemon=True) for i in range(viewers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds - 0.5)
+    return threads
+
+
+def main():
+    import argparse
+    import urllib.request
+
+    parser = argparse.ArgumentParser(description="Serve a video file as the P3 stream, or benchmark it")
+    parser.add_argument("--file", required=True, help="video file to stream in a loop")
+    parser.add_argument("--port", type=int, default=STREAM_PORT)
+    parser.add_argument("--host", default="127.0.0.1", help="0.0.0.0 to serve the LAN as well")
+    parser.add_argument("--token", help="lets viewers elsewhere click and scroll when they send it")
+    parser.add_argument("--quality", type=int, default=STREAM_QUALITY)
+    parser.add_argument("--fps", type=float, default=STREAM_FPS)
+    parser.add_argument("--bench", type=int, metavar="VIEWERS", help="run this many local viewers and report")
+    parser.add_argument("--slow", type=int, default=0, help="how many of the bench viewers are slow")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    encoder = FrameEncoder(args.quality, args.fps).start()
+    server = StreamServer(encoder, "127.0.0.1" if args.bench else args.host, args.port, args.token).start()
+    source = FileSource(args.file, encoder.offer).start()
+    try:
+        if args.bench:
+            bench(server.server_address[1], args.bench, args.slow, args.seconds)
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/stats") as r:
+                stats = json.load(r)
+            e = stats["encoder"]
+            print(f"source {source.fps:.1f} fps, encoded {e['frames_encoded']} frames, "
+                  f"{e['encode_ms']:.2f} ms and {e['jpeg_kb']:.0f} kB each")
+            for c in sorted(stats["clients"], key=lambda c: c["address"]):
+                print(f"  {c['address']:22s} {c['fps']:6.1f} fps  {c['frames']:5d} sent  {c['skipped']:5d} skipped")
+        else:
+            while True:
+                kind, *values = server.events.get()
+                log.info("browser %s %s", kind, values)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.stop()
+        encoder.stop()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+##
+##    Band-sweep panorama for the P3 interface
+##    The P3 shows 200 kHz at most. BandSweep steps VFO A across a whole band at one
+##    span, takes the spectrum trace at every step once the display has settled there,
+##    and stitches the steps into one NumPy array for the band (Panorama). The radio is
+##    put back where it was afterwards. resweep() only revisits the steps that changed
+##    the last time they were looked at, or that have gone stale.
+##
+##    python panorama.py                          (20 m on the emulator: lockstep vs. pipelined, re-sweep)
+##    python panorama.py --band "10 M" --span 200K --png 10m.png
+##
+
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from k3_rig import CatFramer, cat_key, BANDS, SPANS, SPAN_UNIT, PRIORITY_USER
+from spectrum import extract_trace
+
+log = logging.getLogger("K3_P3.panorama")
+
+# band edges in Hz (Region 2), keyed like BANDS
+BAND_EDGES = {"160 M": (1800000, 2000000), "80 M": (3500000, 4000000), "60 M": (5330000, 5410000),
+              "40 M": (7000000, 7300000), "30 M": (10100000, 10150000), "20 M": (14000000, 14350000),
+              "17 M": (18068000, 18168000), "15 M": (21000000, 21450000), "12 M": (24890000, 24990000),
+              "10 M": (28000000, 29700000), "6 M": (50000000, 54000000)}
+SWEEP_SPAN = "50K"      # span button label the sweep steps at
+OVERLAP = 0.1           # share of each step that overlaps its neighbours
+BINS_PER_SPAN = 800     # panorama resolution, bins per span (the P3 picture is 800 wide)
+SETTLE_TIME = 0.05      # s after the radio confirmed a step before frames count
+SETTLE_MAX = 0.5        # s after which the newest frame is taken whether it settled or not
+SETTLE_LEVEL = 0.2      # two traces agree when no more than SETTLE_SHARE of their columns ...
+SETTLE_SHARE = 0.01     # ... differ by more than SETTLE_LEVEL
+STEP_TIMEOUT = 2.0      # s without an FA reply before a sweep gives up
+CHANGE_LEVEL = 0.15     # a bin moved this much between two looks ...
+CHANGE_BINS = 2         # ... in this many bins and the step counts as changed
+REFRESH_AGE = 120.0     # s before resweep() looks at a quiet step again
+TRACE_BGR = (0, 255, 255)
+
+
+def sweep_centers(low, high, span, overlap=OVERLAP):
+    """VFO frequencies that cover low..high with steps of span Hz, overlapping by overlap."""
+    if high - low <= span:
+        return [(low + high) // 2]
+    n = int(np.ceil((high - low - span) / (span * (1 - overlap)))) + 1
+    return [int(round(c)) for c in np.linspace(low + span / 2, high - span / 2, n)]
+
+
+def settled(amp, previous, level=SETTLE_LEVEL, share=SETTLE_SHARE):
+    """True when two traces of the same step agree -- the P3 has finished redrawing."""
+    return np.count_nonzero(np.abs(amp - previous) > level) <= share * len(amp)
+
+
+class Panorama:
+    """
+    One band stitched together from sweep steps: amp (0..1) per bin_hz bin from low to high.
+    Each step covers span Hz around its center; where steps overlap, their middles count
+    more than their edges. add() may run on the capture thread while the UI reads.
+    seen and changed per step drive the incremental re-sweep.
+    """
+    def __init__(self, low, high, span, overlap=OVERLAP, bins_per_span=BINS_PER_SPAN):
+        self.low, self.high, self.span = low, high, span
+        self.bin_hz = span / bins_per_span
+        self.size = int(np.ceil((high - low) / self.bin_hz))
+        self.centers = sweep_centers(low, high, span, overlap)
+        self.amp = np.zeros(self.size, np.float32)
+        self.seen = np.zeros(len(self.centers))             # time of the last look, 0 = never
+        self.changed = np.zeros(len(self.centers), bool)    # differed from the look before
+        self.updates = 0
+        self._bins = low + (np.arange(self.size) + 0.5) * self.bin_hz
+        self._num = np.zeros(self.size)
+        self._den = np.zeros(self.size)
+        self._steps = [None] * len(self.centers)        # (first bin, weights, values) per step
+        self._lock = threading.Lock()
+
+    def step_bins(self, center, x0=0.0, x1=1.0):
+        """Bin range (b0, b1) a picture centered on center shows between x0 and x1 of its width."""
+        f0 = center + self.span * (x0 - 0.5)
+        f1 = center + self.span * (x1 - 0.5)
+        b0 = max(0, int(np.ceil((f0 - self.low) / self.bin_hz - 0.5)))
+        b1 = min(self.size, int(np.floor((f1 - self.low) / self.bin_hz - 0.5)) + 1)
+        return b0, max(b0, b1)
+
+    def resample(self, amp, center, x0=0.0, x1=1.0):
+        """
+        A trace onto the panorama bins it covers: (b0, values). Narrower bins than trace
+        columns interpolate, wider ones keep the strongest column so narrow signals survive.
+        """
+        b0, b1 = self.step_bins(center, x0, x1)
+        cols = center + self.span * (x0 + (np.arange(len(amp)) + 0.5) / len(amp) * (x1 - x0) - 0.5)
+        bins = self._bins[b0:b1]
+        if len(amp) <= b1 - b0 or b1 == b0:
+            return b0, np.interp(bins, cols, amp).astype(np.float32)
+        edges = np.searchsorted(cols, bins - self.bin_hz / 2)
+        edges = np.minimum(np.maximum.accumulate(edges), len(amp) - 1)
+        return b0, np.maximum.reduceat(amp, edges).astype(np.float32)
+
+    def add(self, step, amp, x0=0.0, x1=1.0, stamp=None):
+        """Puts one step's trace (columns x0..x1 of the picture) in place of its last one."""
+        center = self.centers[step]
+        b0, values = self.resample(amp, center, x0, x1)
+        b1 = b0 + len(values)
+        weights = 1.0 - 0.9 * np.abs(2 * (self._bins[b0:b1] - center) / self.span)
+        with self._lock:
+            old = self._steps[step]
+            if old is not None:
+                o0, o_weights, o_values = old
+                self._num[o0:o0 + len(o_values)] -= o_weights * o_values
+                self._den[o0:o0 + len(o_values)] -= o_weights
+                self.changed[step] = (o0 == b0 and len(o_values) == len(values) and
+                                      np.count_nonzero(np.abs(values - o_values) > CHANGE_LEVEL) >= CHANGE_BINS)
+            self._steps[step] = (b0, weights, values)
+            self._num[b0:b1] += weights * values
+            self._den[b0:b1] += weights
+            lo, hi = (min(b0, old[0]), max(b1, old[0] + len(old[2]))) if old is not None else (b0, b1)
+            den = self._den[lo:hi]
+            self.amp[lo:hi] = np.where(den > 1e-9, self._num[lo:hi] / np.maximum(den, 1e-9), 0.0)
+            self.seen[step] = stamp if stamp is not None else time.time()
+            self.updates += 1
+
+    def stale(self, max_age=REFRESH_AGE, now=None):
+        """Steps a re-sweep should visit: never seen, changed last time, or older than max_age."""
+        now = time.time() if now is None else now
+        return [i for i in range(len(self.centers))
+                if not self.seen[i] or self.changed[i] or now - self.seen[i] > max_age]
+
+    def columns(self, width):
+        """(amp, known) for a picture width columns wide; each column keeps its strongest bin."""
+        with self._lock:
+            amp, known = self.amp.copy(), self._den > 1e-9
+        if self.size >= width:
+            starts = np.linspace(0, self.size, width + 1).astype(np.intp)[:-1]
+            return np.maximum.reduceat(amp, starts), np.logical_or.reduceat(known, starts)
+        x = (np.arange(width) + 0.5) * self.size / width - 0.5
+        return np.interp(x, np.arange(self.size), amp), known[np.clip(x.round().astype(np.intp), 0, self.size - 1)]
+
+    def freq_at(self, x, width):
+        """Frequency under column x of a picture width columns wide."""
+        return int(self.low + (x + 0.5) * (self.high - self.low) / width)
+
+
+def render(panorama, width, height, vfo=None):
+    """The panorama as a BGR picture, P3 style: trace over a grid, parts not swept yet greyed."""
+    img = np.zeros((height, width, 3), np.uint8)
+    amp, known = panorama.columns(width)
+    img[:, ~known] = (40, 40, 40)
+    top, bottom = 18, height - 2
+    band = panorama.high - panorama.low
+    grid = next((g for g in (5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000) if band / g <= 8), 2000000)
+    for f in range(-(-panorama.low // grid) * grid, panorama.high + 1, grid):
+        x = min(width - 1, int((f - panorama.low) * width / band))
+        img[top:bottom, x] = (60, 60, 60)
+        cv2.putText(img, f"{f / 1e6:.3f}", (min(max(0, x - 24), width - 50), 13), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
+    rows = (bottom - amp * (bottom - top)).astype(np.int32)
+    trace = np.stack([np.arange(width, dtype=np.int32), rows], axis=1)
+    cv2.polylines(img, [trace.reshape(-1, 1, 2)], False, TRACE_BGR, 1)
+    if vfo is not None and panorama.low <= vfo <= panorama.high:
+        x = min(width - 1, int((vfo - panorama.low) * width / band))
+        img[top:bottom, x] = (0, 0, 255)
+    return img
+
+
+class BandSweep:
+    """
+    Steps the radio across a band and fills a Panorama.
+    The sweep runs off the radio's serial thread and the capture thread, not the owner's
+    loop: the FA reply for a step is timestamped as it arrives, frames captured SETTLE_TIME
+    after that are compared until two agree, and the next step's FA is written right away --
+    before the finished step is stitched -- so the radio retunes while the PC works.
+    The span is set once per sweep. attach() hooks on_serial and on_frame up as serial and
+    frame listeners; the owner calls poll() now and then.
+    A click, wheel step or band change during a sweep ends it where it is.
+    """
+    def __init__(self, radio, trace, span_label=SWEEP_SPAN, overlap=OVERLAP, settle=SETTLE_TIME):
+        self.radio = radio
+        self.trace = trace      # SpectrumTrace, for its region and colour settings
+        self.span_label = span_label
+        self.overlap = overlap
+        self.settle = settle
+        self.band = None
+        self.panorama = None
+        self.grabber = None
+        self.running = False
+        self.sweeps = 0
+        self.steps = 0          # steps taken, all sweeps
+        self.last_steps = 0     # steps in the last sweep
+        self.last_time = None   # s the last complete sweep took
+        self._framer = CatFramer()
+        self._lock = threading.Lock()
+        self._todo = []
+        self._step = None
+        self._target = None
+        self._sent = 0.0
+        self._confirmed = None
+        self._previous = None
+        self._restore = None
+        self._started = 0.0
+        self._done = 0
+
+    def attach(self, grabber):
+        self.grabber = grabber
+        self.radio.k3.listeners.append(self.on_serial)
+        grabber.listeners.append(self.on_frame)
+        return self
+
+    def detach(self):
+        # off the listener lists, so a paused grabber stops decoding frames for us
+        if self.on_serial in self.radio.k3.listeners:
+            self.radio.k3.listeners.remove(self.on_serial)
+        if self.grabber is not None and self.on_frame in self.grabber.listeners:
+            self.grabber.listeners.remove(self.on_frame)
+        self.grabber = None
+
+    def start(self, band, span_label=None):
+        """Full sweep of band (a BANDS name)."""
+        span_label = span_label or self.span_label
+        if band not in BAND_EDGES or span_label not in SPANS:
+            log.warning("Can't sweep %s at %s", band, span_label)
+            return False
+        if self.running:
+            self.cancel()
+        self.span_label = span_label
+        if self.panorama is None or band != self.band or self.panorama.span != SPANS[span_label] * SPAN_UNIT:
+            self.band = band
+            self.panorama = Panorama(*BAND_EDGES[band], SPANS[span_label] * SPAN_UNIT, self.overlap)
+        return self._begin(list(range(len(self.panorama.centers))))
+
+    def resweep(self, max_age=REFRESH_AGE):
+        """Visits only the steps that changed or went stale; returns how many."""
+        if self.panorama is None or self.running:
+            return 0
+        todo = self.panorama.stale(max_age)
+        return len(todo) if todo and self._begin(todo) else 0
+
+    def _begin(self, todo):
+        rig = self.radio.rig
+        if rig.freq is None or rig.span is None:
+            log.warning("Sweep needs the radio's frequency and span first")
+            return False
+        spn = SPANS[self.span_label]
+        first = self.panorama.centers[todo[0]]
+        with self._lock:
+            self._restore = (rig.freq, rig.span)
+            self._todo = todo[1:]
+            self._started = time.perf_counter()
+            self._done = 0
+            self._next_step(todo[0], self._started)
+            self.running = True
+        data = f"#SPN{spn:06d};" if rig.span != spn * SPAN_UNIT else ""
+        log.info("Sweeping %s: %d steps at %s", self.band, len(todo), self.span_label)
+        self.radio.k3.send(f"{data}FA{first:011d};FA;".encode(), PRIORITY_USER)
+        return True
+
+    def _next_step(self, step, now):
+        # under self._lock
+        self._step = step
+        self._target = self.panorama.centers[step]
+        self._sent = now
+        self._confirmed = None
+        self._previous = None
+
+    def cancel(self):
+        with self._lock:
+            was = self.running
+            if was:
+                self._finish()
+        if was:
+            log.info("Sweep of %s stopped after %d steps", self.band, self._done)
+
+    def _finish(self, freq=True):
+        # under self._lock; puts the span back, and the frequency unless the user has moved it
+        self.running = False
+        self._step = None
+        if self._restore is not None:
+            vfo, span = self._restore
+            data = f"#SPN{span // SPAN_UNIT:06d};#SPN;"
+            self.radio.k3.send((f"FA{vfo:011d};FA;" if freq else "").encode() + data.encode(), PRIORITY_USER)
+        self._restore = None
+
+    def _user_took_over(self):
+        # the rig state only expects values for the user's own actions -- the sweep never expects
+        return any(field in self.radio.rig.pending for field in ("freq", "span", "band"))
+
+    def on_serial(self, direction, data):
+        # serial thread -- notes when the radio reports the step's frequency
+        if direction != "in" or not self.running:
+            return
+        for frame in self._framer.feed(data):
+            key = cat_key(frame)
+            if key not in (b"FA", b"IF"):
+                continue
+            try:
+                freq = int(frame[2:13])
+            except ValueError:
+                continue
+            with self._lock:
+                if self.running and self._confirmed is None and freq == self._target:
+                    self._confirmed = time.perf_counter()
+
+    def on_frame(self, frame, stamp):
+        # capture thread
+        with self._lock:
+            if self._step is None or self._confirmed is None or stamp < self._confirmed + self.settle:
+                return
+            step, confirmed, previous = self._step, self._confirmed, self._previous
+        trace = self.trace
+        amp = extract_trace(frame, trace.region, trace.color, trace.tolerance, trace.level)
+        if (previous is None or not settled(amp, previous)) and stamp - confirmed < SETTLE_MAX:
+            with self._lock:
+                if self._step == step:
+                    self._previous = amp
+            return
+        with self._lock:
+            if self._step != step:
+                return
+            self._done += 1
+            self.steps += 1
+            if self._user_took_over():
+                self._finish(freq=False)
+                log.info("Sweep of %s given up to the user after %d steps", self.band, self._done)
+            elif self._todo:
+                self._next_step(self._todo.pop(0), time.perf_counter())
+                self.radio.k3.send(f"FA{self._target:011d};FA;".encode(), PRIORITY_USER)
+            else:
+                self.sweeps += 1
+                self.last_steps = self._done
+                self.last_time = time.perf_counter() - self._started
+                self._finish()
+                log.info("Swept %s: %d steps in %.2f s", self.band, self.last_steps, self.last_time)
+        # stitched after the next FA is on its way
+        self.panorama.add(step, amp, trace.region[0], trace.region[2])
+
+    def poll(self):
+        """Owner's thread: gives up on a radio that stopped answering. Returns panorama.updates."""
+        with self._lock:
+            stuck = self.running and self._confirmed is None and time.perf_counter() - self._sent > STEP_TIMEOUT
+        if stuck:
+            log.warning("Sweep of %s: no answer for %.0f kHz, giving up", self.band, self._target / 1000)
+            self.cancel()
+        return self.panorama.updates if self.panorama is not None else 0
+
+
+def lockstep_sweep(radio, grabber, trace, panorama, run, settle=SETTLE_TIME):
+    """
+    The obvious sweep, for comparison: from the owner's loop, tune, wait for the FA reply,
+    wait settle, take the second fresh frame, stitch, next.
+    """
+    started = time.perf_counter()
+    for step, center in enumerate(panorama.centers):
+        radio.rig.set("freq", None)
+        radio.k3.send(f"FA{center:011d};FA;".encode(), PRIORITY_USER)
+        deadline = time.perf_counter() + STEP_TIMEOUT
+        while radio.rig.freq != center and time.perf_counter() < deadline:
+            run(radio, duration=0.02)
+        run(radio, duration=settle)
+        grabber.latest()
+        frame, frames = None, 0
+        while frames < 2:
+            run(radio, duration=0.005)
+            fresh = grabber.latest()
+            if fresh is not None:
+                frame, frames = fresh[0], frames + 1
+        panorama.add(step, extract_trace(frame, trace.region, trace.color, trace.tolerance, trace.level),
+                     trace.region[0], trace.region[2])
+    return time.perf_counter() - started
+
+
+def main():
+    import argparse
+
+    from K3_P3 import FrameGrabber
+    from k3_emulator import K3Emulator, SyntheticP3Capture, P3_SPECTRUM_REGION, P3_TRACE_BGR
+    from k3_rig import K3Rig
+    from k3_service import run
+    from spectrum import SpectrumTrace, find_peaks
+
+    parser = argparse.ArgumentParser(description="Band sweep speed and stitching on the K3 emulator")
+    parser.add_argument("--band", default="20 M", choices=list(BANDS))
+    parser.add_argument("--span", default=SWEEP_SPAN, choices=list(SPANS))
+    parser.add_argument("--signals", type=int, default=30, help="synthetic signals in the band")
+    parser.add_argument("--fps", type=float, default=30, help="capture frame rate")
+    parser.add_argument("--work", type=float, default=0.0, help="seconds the radio spends on each command")
+    parser.add_argument("--png", help="write the stitched panorama to this file")
+    args = parser.parse_args()
+
+    low, high = BAND_EDGES[args.band]
+    rng = np.random.default_rng(7)
+    signals = [(int(f), float(s), float(w)) for f, s, w in zip(rng.uniform(low + 2000, high - 2000, args.signals),
+                                                                rng.uniform(0.35, 0.9, args.signals),
+                                                                rng.choice([100, 400, 2400], args.signals))]
+    emu = K3Emulator(work=args.work).start()
+    capture = SyntheticP3Capture(800, 600, fps=args.fps, emulator=emu, signals=list(signals))
+    grabber = FrameGrabber(capture)
+    trace = SpectrumTrace(P3_SPECTRUM_REGION, P3_TRACE_BGR)
+    radio = K3Rig(emu.port_name, "38400").start()
+    sweep = BandSweep(radio, trace).attach(grabber)
+    grabber.start()
+    while not (radio.rig.ready("freq") and radio.rig.ready("span")):
+        run(radio, duration=0.02)
+    home = radio.rig.freq
+
+    def found(panorama):
+        # how many of the synthetic signals show up as a peak within two bins
+        peaks = panorama.low + (find_peaks(panorama.amp) + 0.5) * panorama.bin_hz
+        return sum(bool(len(peaks)) and np.min(np.abs(peaks - f)) <= max(2 * panorama.bin_hz, w / 2)
+                   for f, _, w in capture.signals)
+
+    def timed(begin):
+        started = time.perf_counter()
+        begin()
+        while sweep.running:
+            run(radio, duration=0.02)
+            sweep.poll()
+        return time.perf_counter() - started
+
+    span = SPANS[args.span] * SPAN_UNIT
+    radio.k3.send(f"#SPN{SPANS[args.span]:06d};#SPN;".encode(), PRIORITY_USER)
+    lockstep = Panorama(low, high, span)
+    took = lockstep_sweep(radio, grabber, trace, lockstep, run)
+    print(f"{args.band} at {args.span}: {len(lockstep.centers)} steps, {lockstep.size} bins of {lockstep.bin_hz:.0f} Hz")
+    print(f"lockstep   {took:6.2f} s  {took / len(lockstep.centers) * 1000:5.0f} ms/step  "
+          f"{found(lockstep)}/{len(capture.signals)} signals found")
+    radio.k3.send(f"FA{home:011d};FA;".encode(), PRIORITY_USER)
+    run(radio, duration=0.2)
+
+    took = timed(lambda: sweep.start(args.band, args.span))
+    steps = sweep.last_steps
+    run(radio, duration=0.2)
+    print(f"pipelined  {took:6.2f} s  {took / max(1, steps) * 1000:5.0f} ms/step  "
+          f"{found(sweep.panorama)}/{len(capture.signals)} signals found, radio back on {radio.rig.freq} Hz")
+
+    # a station comes up in one sub-span: that step changes on the next full sweep ...
+    keyed = (int(sweep.panorama.centers[len(sweep.panorama.centers) // 2] + span / 5), 0.8, 400)
+    capture.signals.append(keyed)
+    timed(lambda: sweep.start(args.band, args.span))
+    changed = int(sweep.panorama.changed.sum())
+    # ... and is the only one a re-sweep looks at again while the rest are fresh
+    capture.signals.remove(keyed)
+    took = timed(sweep.resweep)
+    print(f"re-sweep   {took:6.2f} s  {sweep.last_steps} of {len(sweep.panorama.centers)} steps "
+          f"({changed} changed on the sweep before)")
+    took = timed(lambda: sweep.resweep(max_age=0))
+    print(f"re-sweep   {took:6.2f} s  {sweep.last_steps} of {len(sweep.panorama.centers)} steps, all stale")
+
+    if args.png:
+        cv2.imwrite(args.png, render(sweep.panorama, 1600, 300, home))
+    scratch, amp = Panorama(low, high, span), np.full(800, 0.5, np.float32)
+    started = time.perf_counter()
+    for i in range(100):
+        scratch.add(i % len(scratch.centers), amp)
+    print(f"stitch     {(time.perf_counter() - started) * 10:6.3f} ms/step")
+    grabber.stop()
+    radio.stop()
+    emu.stop()
+
+
+if __name__ == "__main__":
+    main()
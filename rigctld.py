@@ -0,0 +1,394 @@
+##
+##    rigctld compatible TCP server for the P3 interface
+##    The app owns the K3 serial port, so logging and digital mode programs connect
+##    here instead (Hamlib model 2, "NET rigctl", localhost:4532). Reads are answered
+##    from a cache the K3 replies and auto-info pushes keep current; writes go into
+##    the app's serial stream ahead of its polls. One asyncio loop on its own thread
+##    serves all clients.
+##
+##    set "rigctld_port": 4532 in config.json to start it with the app
+##    python rigctld.py --clients 50 --requests 200      (latency benchmark against the emulator)
+##
+
+import asyncio
+import logging
+import threading
+import time
+
+log = logging.getLogger("K3_P3.rigctld")
+
+RIGCTLD_PORT = 4532
+MISS_WAIT = 1.0         # s a read waits for the radio when nothing is cached yet
+
+# K3 MDn codes <-> Hamlib mode names
+K3_MODES = {1: "LSB", 2: "USB", 3: "CW", 4: "FM", 5: "AM", 6: "PKTUSB", 7: "CWR", 9: "PKTLSB"}
+HAMLIB_MODES = {name: code for code, name in K3_MODES.items()}
+HAMLIB_MODES.update(RTTY=6, RTTYR=9)
+
+# Hamlib error codes
+RIG_OK = 0
+RIG_EINVAL = -1
+RIG_ENIMPL = -4
+RIG_ETIMEOUT = -5
+
+# what a NET rigctl client expects from \dump_state (protocol 0): HF + 6 m, all modes
+DUMP_STATE = "\n".join([
+    "0", "2", "2",
+    "150000.000000 60000000.000000 0x1ff -1 -1 0x3 0x3",
+    "0 0 0 0 0 0 0",
+    "1800000.000000 54000000.000000 0x1ff 5000 100000 0x3 0x3",
+    "0 0 0 0 0 0 0",
+    "0x1ff 1", "0x1ff 0",
+    "0 0",
+    "0x1ff 2400", "0x1ff 500", "0x1ff 6000",
+    "0 0",
+    "9990", "9990", "0", "0",
+    "10 0", "10 0",
+    "0x0", "0x0", "0x0", "0x0", "0x0", "0x0",
+    ""])
+
+
+class RigCache:
+    """
+    Last known radio state, fed with complete K3 replies (without the ';') from the serial
+    worker thread and read from the server thread. Writes update it straight away so a
+    client reading back what it just set doesn't wait for the radio; the radio's reply
+    then confirms or corrects it.
+    """
+    def __init__(self):
+        self.freq = None
+        self.freq_b = None
+        self.mode = None
+        self.band = None
+        self.bandwidth = None   # Hz
+        self.tx = False
+        self.split = None       # AI2 doesn't push it -- asked for (FT) when it matters
+        self.updated = 0.0
+        self._changed = threading.Condition()
+
+    def on_reply(self, frame):
+        body = frame[2:].decode("ascii", "replace")
+        try:
+            match frame[:2]:
+                case b"FA":
+                    self.freq = int(body)
+                case b"FB":
+                    self.freq_b = int(body)
+                case b"MD":
+                    self.mode = int(body)
+                case b"BN":
+                    self.band = int(body)
+                case b"BW":
+                    self.bandwidth = int(body) * 10
+                case b"FT":
+                    self.split = body == "1"
+                case b"IF":
+                    # IF[f 11]*****+yyyyrx*00tmvspbd1*
+                    self.freq = int(body[0:11])
+                    self.tx = body[26] == "1"
+                    self.mode = int(body[27])
+                    self.split = body[30] == "1"
+                case _:
+                    return
+        except (ValueError, IndexError):
+            log.debug("Ignored reply %r", frame)
+            return
+        with self._changed:
+            self.updated = time.monotonic()
+            self._changed.notify_all()
+
+    def set(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated = time.monotonic()
+            self._changed.notify_all()
+
+    def wait_for(self, name, timeout=MISS_WAIT):
+        """Blocks until the field has a value (or the timeout), returns it."""
+        with self._changed:
+            self._changed.wait_for(lambda: getattr(self, name) is not None, timeout)
+            return getattr(self, name)
+
+
+class RigctlServer:
+    """
+    Line based rigctld protocol, enough of it for WSJT-X, fldigi and the loggers:
+    frequency, mode, VFO, PTT, split, plus the handshake commands. send(bytes) queues
+    CAT commands for the radio; cache is the RigCache the replies are fed into.
+    """
+    def __init__(self, send, cache, host="127.0.0.1", port=RIGCTLD_PORT):
+        self.send = send
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.clients = 0
+        self.commands = 0
+        self.misses = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._handlers = {}
+        for names, handler in ((("f", "get_freq"), self.get_freq), (("F", "set_freq"), self.set_freq),
+                               (("m", "get_mode"), self.get_mode), (("M", "set_mode"), self.set_mode),
+                               (("v", "get_vfo"), self.get_vfo), (("V", "set_vfo"), self.set_vfo),
+                               (("t", "get_ptt"), self.get_ptt), (("T", "set_ptt"), self.set_ptt),
+                               (("s", "get_split_vfo"), self.get_split_vfo),
+                               (("S", "set_split_vfo"), self.set_split_vfo),
+                               (("dump_state",), self.dump_state), (("chk_vfo",), self.chk_vfo),
+                               (("get_powerstat",), self.get_powerstat), (("1", "dump_caps"), self.dump_state),
+                               (("_", "get_info"), self.get_info)):
+            for name in names:
+                self._handlers[name] = handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rigctld", daemon=True)
+        self._thread.start()
+        self._ready.wait(5.0)
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._client, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]    # the real one if port was 0
+            log.info("rigctld listening on %s:%d", self.host, self.port)
+        except OSError as e:
+            log.warning("rigctld can't listen on %s:%d: %s", self.host, self.port, e)
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    async def _client(self, reader, writer):
+        self.clients += 1
+        peer = writer.get_extra_info("peername")
+        log.info("rigctld client %s connected", peer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.execute(line.decode("ascii", "replace").strip())
+                if reply is None:
+                    break
+                writer.write(reply.encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+            log.info("rigctld client %s gone", peer)
+
+    async def execute(self, line):
+        """One command line -> the reply text, None to close the connection."""
+        if not line:
+            return ""
+        extended = line[0] in "+;|,"
+        if extended:
+            line = line[1:]
+        parts = line.split()
+        name = parts[0].lstrip("\\")
+        if name in ("q", "Q", "quit", "exit"):
+            return None
+        self.commands += 1
+        handler = self._handlers.get(name)
+        if handler is None:
+            return f"RPRT {RIG_ENIMPL}\n"
+        try:
+            result = handler(*parts[1:])
+            if asyncio.iscoroutine(result):
+                result = await result
+        except (TypeError, ValueError, KeyError, IndexError):    # IndexError: arguments missing
+            return f"RPRT {RIG_EINVAL}\n"
+        if isinstance(result, int):         # set commands return a status
+            return f"{handler.__name__}:\nRPRT {result}\n" if extended else f"RPRT {result}\n"
+        if extended:
+            body = "".join(f"{label}: {value}\n" for label, value in result)
+            return f"{handler.__name__}:\n{body}RPRT 0\n"
+        return "".join(f"{value}\n" for _, value in result)
+
+    async def cached(self, name, query):
+        value = getattr(self.cache, name)
+        if value is None:
+            # nothing heard from the radio yet -- ask once and wait for the reply
+            self.misses += 1
+            self.send(query)
+            value = await asyncio.get_running_loop().run_in_executor(None, self.cache.wait_for, name)
+            if value is None:
+                raise TimeoutError(name)
+        return value
+
+    async def get_freq(self, vfo=None):
+        try:
+            return [("Frequency", await self.cached("freq", b"FA;"))]
+        except TimeoutError:
+            return RIG_ETIMEOUT
+
+    def set_freq(self, *args):
+        hz = int(float(args[-1]))
+        self.send(f"FA{hz:011d};FA;".encode())
+        self.cache.set(freq=hz)
+        return RIG_OK
+
+    async def get_mode(self, vfo=None):
+        try:
+            mode = await self.cached("mode", b"MD;")
+        except TimeoutError:
+            return RIG_ETIMEOUT
+        return [("Mode", K3_MODES.get(mode, "USB")), ("Passband", self.cache.bandwidth or 0)]
+
+    def set_mode(self, *args):
+        if len(args) == 3:      # a VFO came first
+            args = args[1:]
+        mode = HAMLIB_MODES[args[0].upper()]
+        command = f"MD{mode};"
+        passband = int(args[1]) if len(args) > 1 else 0
+        if passband > 0:
+            command += f"BW{min(passband // 10, 9999):04d};"
+            self.cache.set(bandwidth=passband // 10 * 10)
+        self.send((command + "MD;").encode())
+        self.cache.set(mode=mode)
+        return RIG_OK
+
+    def get_vfo(self):
+        return [("VFO", "VFOA")]
+
+    def set_vfo(self, vfo):
+        return RIG_OK if vfo.upper() in ("VFOA", "MAIN", "CURRVFO") else RIG_EINVAL
+
+    def get_ptt(self, vfo=None):
+        return [("PTT", int(self.cache.tx))]
+
+    def set_ptt(self, *args):
+        on = int(args[-1]) != 0
+        self.send(b"TX;" if on else b"RX;")
+        self.cache.set(tx=on)
+        return RIG_OK
+
+    async def get_split_vfo(self, vfo=None):
+        try:
+            split = await self.cached("split", b"FT;")
+        except TimeoutError:
+            return RIG_ETIMEOUT
+        return [("Split", int(split)), ("TX VFO", "VFOB" if split else "VFOA")]
+
+    async def set_split_vfo(self, *args):
+        on = int(args[-2] if len(args) > 1 else args[-1]) != 0
+        # the SPLIT button toggles, so go by what the radio says now, not by the cache:
+        # nothing is pushed when split changes on the front panel
+        self.cache.set(split=None)
+        try:
+            split = await self.cached("split", b"FT;")
+        except TimeoutError:
+            return RIG_ETIMEOUT
+        if on != split:
+            self.send(b"SWH13;FT;")
+            self.cache.set(split=on)
+        return RIG_OK
+
+    def dump_state(self):
+        return [("", DUMP_STATE.rstrip("\n"))]
+
+    def chk_vfo(self):
+        return [("ChkVFO", 0)]
+
+    def get_powerstat(self):
+        return [("Power Status", 1)]
+
+    def get_info(self):
+        return [("Info", "Elecraft K3 via P3 interface")]
+
+
+def main():
+    import argparse
+    import queue
+    import socket
+
+    import k3_rig
+    from k3_emulator import K3Emulator
+
+    parser = argparse.ArgumentParser(description="rigctld latency benchmark against the K3 emulator")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200, help="get_freq requests per client")
+    parser.add_argument("--writes", type=int, default=20, help="set_freq requests per client")
+    parser.add_argument("--interval", type=float, default=0.01,
+                        help="s between a client's requests (real clients poll every 0.1-1 s), 0 = flat out")
+    args = parser.parse_args()
+
+    emu = K3Emulator().start()
+    framer = k3_rig.CatFramer()
+    cache = RigCache()
+    def feed(direction, data):
+        if direction == "in":
+            for frame in framer.feed(data):
+                cache.on_reply(frame)
+
+    k3 = k3_rig.SerialWorker(emu.port_name, "38400", lambda data: None)
+    k3.listeners.append(feed)
+    k3.start()
+    server = RigctlServer(k3.send, cache, port=0).start()
+
+    results = queue.SimpleQueue()
+
+    def client(index):
+        with socket.create_connection(("127.0.0.1", server.port)) as sock:
+            f = sock.makefile("rwb", buffering=0)
+            reads, writes = [], []
+            for i in range(args.requests):
+                time.sleep(args.interval)
+                t0 = time.perf_counter()
+                f.write(b"f\n")
+                f.readline()
+                reads.append(time.perf_counter() - t0)
+                if i % max(1, args.requests // max(1, args.writes)) == 0:
+                    t0 = time.perf_counter()
+                    f.write(f"F {14000000 + index * 1000 + i}\n".encode())
+                    f.readline()
+                    writes.append(time.perf_counter() - t0)
+            results.put((reads, writes))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    reads, writes = [], []
+    while not results.empty():
+        r, w = results.get()
+        reads += r
+        writes += w
+    server.stop()
+    k3.stop()
+    emu.stop()
+
+    def pct(xs, q):
+        xs = sorted(xs)
+        return xs[min(len(xs) - 1, int(q * len(xs)))] * 1000 if xs else float("nan")
+
+    print(f"{args.clients} clients, {len(reads)} reads + {len(writes)} writes in {elapsed:.2f} s "
+          f"({(len(reads) + len(writes)) / elapsed:.0f} commands/s), {server.misses} cache misses")
+    for name, xs in (("get_freq", reads), ("set_freq", writes)):
+        print(f"{name:9s} p50 {pct(xs, 0.5):6.3f}  p90 {pct(xs, 0.9):6.3f}  p99 {pct(xs, 0.99):6.3f} ms")
+    print(f"radio saw {emu.commands} commands")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+##
+##    Session record and replay for the P3 interface
+##    SessionRecorder writes the captured frames and every serial byte to and from
+##    the K3, all timestamped, into one file (JPEG frames, raw serial chunks) on a
+##    background thread. SessionPlayer plays it back as a video source and a serial
+##    port the app can't tell from the real ones, in real time or as fast as possible,
+##    so display or parser changes can be measured against the exact same session.
+##
+##    set "record_session": "session.p3s" in config.json to record
+##    python session.py info session.p3s
+##    python session.py replay session.p3s --speed 1      (the app, fed from the file)
+##    python session.py bench session.p3s                 (CAT parser over the recorded replies)
+##    python bench_video.py --session session.p3s         (display path over the recorded frames)
+##
+
+import json
+import logging
+import queue
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+log = logging.getLogger("K3_P3.session")
+
+MAGIC = b"P3SESS01"
+RECORD = struct.Struct("<1sdI")     # kind, seconds since the session started, payload length
+FRAME = b"F"
+SERIAL_OUT = b"O"   # app -> radio
+SERIAL_IN = b"I"    # radio -> app
+JPEG_QUALITY = 90
+MAX_PENDING_FRAMES = 30     # frames waiting for the writer before new ones get dropped
+
+
+class SessionRecorder:
+    """
+    Appends timestamped frames and serial chunks to a session file on its own thread.
+    frame() drops (and counts) frames while the writer is behind; serial data is never dropped.
+    """
+    def __init__(self, path, meta=None, quality=JPEG_QUALITY, lossless=False):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.quality = quality
+        self.lossless = lossless
+        self.frames = 0
+        self.dropped = 0
+        self.serial_bytes = 0
+        self.started = None
+        self._queue = queue.SimpleQueue()
+        self._frame_slots = threading.Semaphore(MAX_PENDING_FRAMES)
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.meta.update(started=time.time(), format="png" if self.lossless else "jpeg")
+        self._thread = threading.Thread(target=self._run, name="session", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5.0)
+            self._thread = None
+
+    def frame(self, frame, stamp=None):
+        # capture frames are new arrays every read, so no copy is needed
+        if not self._frame_slots.acquire(blocking=False):
+            self.dropped += 1
+            return
+        self._queue.put((FRAME, self._since(stamp), frame))
+
+    def serial(self, direction, data, stamp=None):
+        self._queue.put((SERIAL_OUT if direction == "out" else SERIAL_IN, self._since(stamp), bytes(data)))
+
+    def _since(self, stamp):
+        return (stamp if stamp is not None else time.perf_counter()) - self.started
+
+    def _run(self):
+        params = [] if self.lossless else [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        ext = ".png" if self.lossless else ".jpg"
+        with open(self.path, "wb") as f:
+            header = json.dumps(self.meta).encode()
+            f.write(MAGIC + struct.pack("<I", len(header)) + header)
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                kind, when, payload = item
+                if kind == FRAME:
+                    self._frame_slots.release()
+                    ok, encoded = cv2.imencode(ext, payload, params)
+                    if not ok:
+                        continue
+                    payload = encoded.tobytes()
+                    self.frames += 1
+                else:
+                    self.serial_bytes += len(payload)
+                f.write(RECORD.pack(kind, when, len(payload)))
+                f.write(payload)
+        log.info("Session %s: %d frames (%d dropped), %d serial bytes",
+                 self.path, self.frames, self.dropped, self.serial_bytes)
+
+
+class SessionFile:
+    """Index of a session file: where every record is, so frames can be read on demand."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session file")
+        (size,) = struct.unpack("<I", self._file.read(4))
+        self.meta = json.loads(self._file.read(size))
+        frame_times, frame_offsets, frame_sizes = [], [], []
+        self.serial = []        # (time, kind, bytes), serial chunks are small enough to keep
+        while True:
+            head = self._file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break       # end of file, or a record cut short by a crash
+            kind, when, length = RECORD.unpack(head)
+            if kind == FRAME:
+                frame_times.append(when)
+                frame_offsets.append(self._file.tell())
+                frame_sizes.append(length)
+                self._file.seek(length, 1)
+            else:
+                data = self._file.read(length)
+                if len(data) < length:
+                    break
+                self.serial.append((when, kind, data))
+        self.frame_times = np.array(frame_times)
+        self.frame_offsets = frame_offsets
+        self.frame_sizes = frame_sizes
+        self._lock = threading.Lock()
+
+    def duration(self):
+        ends = [self.frame_times[-1]] if len(self.frame_times) else []
+        ends += [self.serial[-1][0]] if self.serial else []
+        return max(ends, default=0.0)
+
+    def frame(self, index):
+        with self._lock:
+            self._file.seek(self.frame_offsets[index])
+            data = self._file.read(self.frame_sizes[index])
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+    def close(self):
+        self._file.close()
+
+
+class SessionPlayer:
+    """
+    Shared clock for a replay. speed 1 is real time, 2 twice as fast, and 0 means
+    as fast as the app reads (then frames and serial keep their own order but not
+    their timing against each other).
+    """
+    def __init__(self, path, speed=1.0, loop=False):
+        self.session = SessionFile(path)
+        self.speed = speed
+        self.loop = loop
+        self._t0 = None
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def now(self):
+        """Session time the replay has reached."""
+        if self._t0 is None:
+            self.start()
+        if not self.speed:
+            return float("inf")
+        return (time.perf_counter() - self._t0) * self.speed
+
+    def wait_until(self, when):
+        if self.speed:
+            delay = when - self.now()
+            if delay > 0:
+                time.sleep(delay / self.speed)
+
+    def capture(self):
+        return ReplayCapture(self)
+
+    def serial(self):
+        return ReplaySerial(self)
+
+
+class ReplayCapture:
+    """VideoCapture look-alike that returns the recorded frames at their recorded times."""
+    def __init__(self, player):
+        self.player = player
+        self.session = player.session
+        self.index = 0
+        self._opened = len(self.session.frame_times) > 0
+        first = self.session.frame(0) if self._opened else None
+        self.height, self.width = first.shape[:2] if first is not None else (0, 0)
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+    def get(self, prop):
+        times = self.session.frame_times
+        fps = (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 0.0
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: fps, cv2.CAP_PROP_FRAME_COUNT: len(times)}.get(prop, 0.0)
+
+    def set(self, prop, value):
+        return False
+
+    def grab(self):
+        return self._opened and self.index < len(self.session.frame_times)
+
+    def read(self, image=None):
+        if not self._opened:
+            return False, None
+        if self.index >= len(self.session.frame_times):
+            if not self.player.loop:
+                return False, None
+            self.index = 0
+            self.player.start()
+        self.player.wait_until(self.session.frame_times[self.index])
+        frame = self.session.frame(self.index)
+        self.index += 1
+        return frame is not None, frame
+
+
+class ReplaySerial:
+    """
+    Serial port look-alike: the radio's recorded replies become readable at their recorded
+    times; whatever the app writes is counted and compared with what was recorded.
+    """
+    def __init__(self, player):
+        self.player = player
+        self.incoming = [(when, data) for when, kind, data in player.session.serial if kind == SERIAL_IN]
+        self.recorded_out = b"".join(data for _, kind, data in player.session.serial if kind == SERIAL_OUT)
+        self.written = bytearray()
+        self.is_open = True
+        self.port = "replay:" + player.session.path
+        self._index = 0
+        self._buffer = bytearray()
+
+    def _due(self):
+        now = self.player.now()
+        while self._index < len(self.incoming) and self.incoming[self._index][0] <= now:
+            self._buffer += self.incoming[self._index][1]
+            self._index += 1
+            if not self.player.speed:
+                break       # one recorded read at a time
+
+    @property
+    def in_waiting(self):
+        self._due()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        self._due()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+    def matches_recording(self):
+        """True while everything written so far is what the app wrote in the recorded session."""
+        return self.recorded_out.startswith(bytes(self.written))
+
+    def close(self):
+        self.is_open = False
+
+
+def bench_parser(session, repeat=20):
+    """The recorded replies through CatFramer and the reply handler lookup, as fast as possible."""
+    from k3_rig import CatFramer, cat_key
+
+    chunks = [data for _, kind, data in session.serial if kind == SERIAL_IN]
+    total = sum(len(c) for c in chunks) * repeat
+    frames = 0
+    cpu = time.process_time()
+    for _ in range(repeat):
+        framer = CatFramer()
+        for chunk in chunks:
+            for frame in framer.feed(chunk):
+                cat_key(frame)
+                frames += 1
+    cpu = time.process_time() - cpu
+    return {"chunks": len(chunks) * repeat, "bytes": total, "replies": frames, "cpu_s": cpu,
+            "mb_per_s": total / cpu / 1e6 if cpu else None}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Look into, replay or benchmark a recorded session")
+    parser.add_argument("command", choices=("info", "replay", "bench"))
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 = as fast as possible")
+    parser.add_argument("--loop", action="store_true", help="start over at the end of the recording")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        session = SessionFile(args.path)
+        times = session.frame_times
+        print(f"{args.path}: {session.duration():.1f} s, {len(times)} frames, "
+              f"{len(session.serial)} serial chunks, recorded {time.ctime(session.meta.get('started', 0))}")
+        if len(times) > 1:
+            gaps = np.diff(times) * 1000
+            print(f"frame interval p50 {np.percentile(gaps, 50):.1f} ms, max {gaps.max():.1f} ms")
+        for kind, name in ((SERIAL_OUT, "to radio"), (SERIAL_IN, "from radio")):
+            print(f"{name:10s} {sum(len(d) for _, k, d in session.serial if k == kind)} bytes")
+        print(json.dumps(session.meta))
+    elif args.command == "bench":
+        result = bench_parser(SessionFile(args.path))
+        print(json.dumps(result, indent=2))
+    else:
+        from ttkthemes import ThemedTk
+        import K3_P3
+
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+        player = SessionPlayer(args.path, args.speed, args.loop)
+        capture, port = player.capture(), player.serial()
+        player.start()
+        root = ThemedTk(theme="black")
+        K3_P3.VideoApp(root, video_source=capture, comm_port=port)
+        root.mainloop()
+        log.info("Replay: app wrote %d bytes, %s the recording", len(port.written),
+                 "matching" if port.matches_recording() else "different from")
+
+
+if __name__ == "__main__":
+    main()
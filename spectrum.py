@@ -0,0 +1,160 @@
+##
+##    Spectrum trace extraction for the P3 interface
+##    Pulls the P3 spectrum trace out of a captured frame as one amplitude per
+##    column (0 = bottom of the spectrum area, 1 = top) and finds the signal
+##    peaks in it, so a click near a signal can snap onto it.
+##    Everything is whole-array NumPy/OpenCV work, no per-pixel Python.
+##
+##    python spectrum.py                     (extraction speed on synthetic frames)
+##
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+SPECTRUM_REGION = (0.0, 0.08, 1.0, 0.45)    # x0, y0, x1, y1 as fractions of the frame
+TRACE_LEVEL = 128       # without a trace colour: anything brighter than this is trace
+TRACE_TOLERANCE = 60    # with a trace colour: how far each channel may be off
+PEAK_PROMINENCE = 0.08  # how far above the noise floor a peak has to be (0..1)
+PEAK_DISTANCE = 3       # columns -- the highest peak within this distance wins
+
+
+def region_slices(shape, region=SPECTRUM_REGION):
+    h, w = shape[:2]
+    x0, y0, x1, y1 = region
+    return slice(int(y0 * h), int(y1 * h)), slice(int(x0 * w), int(x1 * w))
+
+
+def trace_mask(area, color=None, tolerance=TRACE_TOLERANCE, level=TRACE_LEVEL):
+    """255 where a pixel of the spectrum area belongs to the trace."""
+    if color is not None:
+        lo = np.clip(np.array(color, np.int16) - tolerance, 0, 255).astype(np.uint8)
+        hi = np.clip(np.array(color, np.int16) + tolerance, 0, 255).astype(np.uint8)
+        return cv2.inRange(area, lo, hi)
+    gray = cv2.cvtColor(area, cv2.COLOR_BGR2GRAY)
+    return cv2.inRange(gray, level, 255)
+
+
+def extract_trace(frame, region=SPECTRUM_REGION, color=None, tolerance=TRACE_TOLERANCE, level=TRACE_LEVEL):
+    """
+    Per-column trace amplitude, 0..1 (float32). The topmost trace pixel in each column
+    is the reading; columns where no trace was found read 0.
+    """
+    rows, cols = region_slices(frame.shape, region)
+    mask = trace_mask(frame[rows, cols], color, tolerance, level)
+    height = mask.shape[0]
+    top = mask.argmax(axis=0)                   # first trace row in each column
+    found = mask[top, np.arange(mask.shape[1])] > 0
+    amp = 1.0 - top.astype(np.float32) / max(1, height - 1)
+    amp[~found] = 0.0
+    return amp
+
+
+def find_peaks(amp, prominence=PEAK_PROMINENCE, distance=PEAK_DISTANCE):
+    """Columns of the local maxima that stand at least prominence above the noise floor."""
+    if len(amp) < 3:
+        return np.empty(0, np.intp)
+    floor = np.median(amp)
+    padded = np.pad(amp, distance, mode="edge")
+    window_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * distance + 1).max(axis=1)
+    peaks = np.flatnonzero((amp >= window_max) & (amp - floor >= prominence))
+    if len(peaks) > 1:
+        # a flat top gives several equal maxima -- keep the first of each run
+        peaks = peaks[np.r_[True, np.diff(peaks) > distance]]
+    return peaks
+
+
+def snap(column, peaks, radius):
+    """The peak nearest to column if one is within radius columns, otherwise column."""
+    if radius <= 0 or not len(peaks):
+        return column
+    i = np.searchsorted(peaks, column)
+    near = peaks[max(0, i - 1):i + 1]
+    best = near[np.argmin(np.abs(near - column))]
+    return int(best) if abs(best - column) <= radius else column
+
+
+class SpectrumTrace:
+    """
+    Keeps the trace and peaks of the newest frame. update() is meant to run on the
+    capture thread for every frame; snap_x() is called from the UI with label coordinates.
+    """
+    def __init__(self, region=SPECTRUM_REGION, color=None, tolerance=TRACE_TOLERANCE, level=TRACE_LEVEL,
+                 prominence=PEAK_PROMINENCE):
+        self.region = tuple(region)
+        self.color = color
+        self.tolerance = tolerance
+        self.level = level
+        self.prominence = prominence
+        self.amp = None
+        self.peaks = np.empty(0, np.intp)
+        self.stamp = 0.0
+        self.frame_width = 0
+        self.updates = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, frame, stamp=None):
+        started = time.perf_counter()
+        amp = extract_trace(frame, self.region, self.color, self.tolerance, self.level)
+        peaks = find_peaks(amp, self.prominence)
+        self.set(amp, peaks, stamp if stamp is not None else started, frame.shape[1])
+        self.busy_time += time.perf_counter() - started
+
+    def set(self, amp, peaks, stamp, frame_width):
+        """A trace worked out somewhere else (analysis.TraceAnalyzer)."""
+        with self._lock:
+            self.amp, self.peaks = amp, peaks
+            self.stamp = stamp
+            self.frame_width = frame_width
+        self.updates += 1
+
+    def snapshot(self):
+        with self._lock:
+            return self.amp, self.peaks, self.stamp
+
+    def snap_x(self, x, label_width, radius):
+        """
+        Moves a label x coordinate onto the nearest peak within radius label pixels.
+        The label shows the whole frame scaled, so label x maps linearly onto frame columns.
+        """
+        with self._lock:
+            amp, peaks, frame_width = self.amp, self.peaks, self.frame_width
+        if amp is None or radius <= 0 or label_width <= 0:
+            return x
+        x0 = int(self.region[0] * frame_width)
+        per_pixel = frame_width / label_width
+        column = int(x * per_pixel) - x0
+        snapped = snap(column, peaks, radius * per_pixel)
+        if snapped == column:
+            return x
+        return int(round((snapped + x0 + 0.5) / per_pixel))
+
+
+def main():
+    import argparse
+    from k3_emulator import SyntheticP3Capture, P3_SPECTRUM_REGION, P3_TRACE_BGR
+
+    parser = argparse.ArgumentParser(description="Spectrum trace extraction speed")
+    parser.add_argument("--resolutions", default="800x600,1280x720,1920x1080")
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+
+    for size in args.resolutions.split(","):
+        w, h = (int(v) for v in size.split("x"))
+        synth = SyntheticP3Capture(w, h, fps=0)
+        frames = [synth.read()[1] for _ in range(30)]
+        for name, color in (("brightness", None), ("colour", P3_TRACE_BGR)):
+            trace = SpectrumTrace(P3_SPECTRUM_REGION, color)
+            cpu = time.process_time()
+            for i in range(args.frames):
+                trace.update(frames[i % len(frames)])
+            cpu = (time.process_time() - cpu) / args.frames
+            print(f"{size:10s} {name:10s} {cpu * 1000:6.2f} ms/frame ({1 / cpu:6.0f} fps on one core), "
+                  f"{len(trace.peaks)} peaks")
+
+
+if __name__ == "__main__":
+    main()